@@ -0,0 +1,310 @@
+"""
+Benchmarks of the per-query hot paths that run without a server:
+spatial lookup SQL for every lookup type, distance() querysets,
+parameter adapters, geometry conversion and the decoding of result
+rows.  Queries are run against a stand-in for the pyodbc connection,
+which returns canned rows.
+
+Results (microseconds per call, best of three) can be saved, and
+compared with those saved from another version:
+
+    python benchmarks/hotpaths.py --save before.json
+    ... change things ...
+    python benchmarks/hotpaths.py --compare before.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import platform
+import struct
+import subprocess
+import tempfile
+import time
+
+WGS84 = ('GEOGCS["WGS 84", DATUM["World Geodetic System 1984", '
+         'ELLIPSOID["WGS 84", 6378137, 298.257223563]], '
+         'PRIMEM["Greenwich", 0], UNIT["Degree", 0.0174532925199433]]')
+
+# Geography distances need the spatial reference systems, which are
+# read from a snapshot rather than the (absent) server.
+SNAPSHOT = os.path.join(tempfile.gettempdir(), 'django_pyodbc_gis_bench_srids.json')
+with open(SNAPSHOT, 'w') as f:
+    json.dump([{'srid': 4326, 'auth_name': 'EPSG', 'auth_srid': 4326,
+                'well_known_text': WGS84, 'unit_of_measure': 'metre',
+                'unit_conversion_factor': 1.0}], f)
+
+from django.conf import settings
+
+settings.configure(DATABASES={
+    'default': {
+        'ENGINE': 'django_pyodbc_gis', 'NAME': 'bench',
+        'OPTIONS': {'srid_snapshot': SNAPSHOT},
+    },
+    'wkb': {
+        'ENGINE': 'django_pyodbc_gis', 'NAME': 'bench',
+        'OPTIONS': {'srid_snapshot': SNAPSHOT, 'geometry_readback': 'wkb',
+                    'geometry_params': 'wkb'},
+    },
+})
+
+from django.contrib.gis.db import models
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from django.db import connections
+
+from django_pyodbc_gis.manager import MSSqlGeoManager
+from django_pyodbc_gis.operations import MSSqlAdapter, MSSqlWKBAdapter
+from django_pyodbc_gis.serialization import SerializedGeometry
+
+
+class Parcel(models.Model):
+    geom = models.PolygonField(srid=4326)
+    objects = MSSqlGeoManager()
+
+    class Meta:
+        app_label = 'benchmarks'
+
+
+class Place(models.Model):
+    point = models.PointField(srid=4326, geography=True)
+    objects = MSSqlGeoManager()
+
+    class Meta:
+        app_label = 'benchmarks'
+
+
+class FakeCursor(object):
+    """Stands in for a pyodbc cursor, returning the same rows for any query."""
+    description = (('id',), ('geom',))
+    rowcount = -1
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.pos = 0
+
+    def execute(self, sql, params=()):
+        self.pos = 0
+        return self
+
+    def fetchmany(self, size):
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += size
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+    def nextset(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """Stands in for a pyodbc connection."""
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+
+    def cursor(self):
+        return FakeCursor(self.rows)
+
+    def add_output_converter(self, sqltype, func):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def fake_connection(alias, rows=()):
+    connection = connections[alias]
+    connection.connection = FakeConnection(rows)
+    # Otherwise this is asked of the server.
+    connection.__dict__['sql_server_version'] = 2012
+    return connection
+
+
+def make_polygon(n, srid=4326):
+    """A roughly circular polygon with `n` vertices, in lon/lat."""
+    ring = [(144.96 + 0.01 * math.cos(2 * math.pi * i / n),
+             -37.81 + 0.01 * math.sin(2 * math.pi * i / n))
+            for i in range(n)]
+    ring.append(ring[0])
+    return Polygon(ring, srid=srid)
+
+
+def serialize_polygon(polygon):
+    """A polygon in SQL Server's serialization (version 1, valid)."""
+    ring = polygon.exterior_ring.tuple
+    data = struct.pack('<iBBI', polygon.srid, 1, 0x04, len(ring))
+    data += b''.join(struct.pack('<dd', x, y) for x, y in ring)
+    data += struct.pack('<IBi', 1, 2, 0)
+    data += struct.pack('<IiiB', 1, -1, 0, 3)
+    return SerializedGeometry(data)
+
+
+def measure(func, min_time=0.2):
+    """Microseconds per call of func, best of three runs."""
+    number = 1
+    while True:
+        start = time.time()
+        for i in range(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed) + 1)
+    best = elapsed
+    for run in range(2):
+        start = time.time()
+        for i in range(number):
+            func()
+        best = min(best, time.time() - start)
+    return 1e6 * best / number
+
+
+def lookup_benchmarks():
+    connection = fake_connection('default')
+    ops = connection.ops
+    qn = ops.quote_name
+    polygon = make_polygon(50)
+    for model, field_name, functions in (
+            (Parcel, 'geom', ops.geometry_functions),
+            (Place, 'point', ops.geography_functions)):
+        field = model._meta.get_field(field_name)
+        lvalue = (model._meta.db_table, field.column, field.db_type(connection))
+        distance = D(m=100) if field.geography else 0.01
+        for lookup_type in sorted(functions):
+            if lookup_type in ops.distance_functions:
+                value = (polygon, distance)
+            else:
+                value = polygon
+            yield ('lookup %s %s' % (field.db_type(connection), lookup_type),
+                   lambda lookup_type=lookup_type, value=value, field=field, lvalue=lvalue:
+                   ops.spatial_lookup_sql(lvalue, lookup_type, value, field, qn))
+
+    # The same, building the SQL every time, as a baseline for the memo.
+    field = Parcel._meta.get_field('geom')
+    lvalue = (Parcel._meta.db_table, field.column, field.db_type(connection))
+
+    def unmemoized():
+        ops._sql_memo.clear()
+        ops.spatial_lookup_sql(lvalue, 'intersects', polygon, field, qn)
+    yield 'lookup geometry intersects unmemoized', unmemoized
+
+
+def distance_benchmarks():
+    fake_connection('default')
+    point = Point(144.96, -37.81, srid=4326)
+    yield ('distance() geometry',
+           lambda: Parcel.objects.all()._distance_attribute('distance', point))
+    yield ('distance() geography',
+           lambda: Place.objects.all()._distance_attribute('distance', point))
+    yield ('distance() geography compile',
+           lambda: Place.objects.distance(point).query.get_compiler('default').as_sql())
+    yield ('filter(intersects) compile',
+           lambda: Parcel.objects.filter(geom__intersects=point)
+           .query.get_compiler('default').as_sql())
+
+
+def adapter_benchmarks(sizes):
+    for n in sizes:
+        polygon = make_polygon(n)
+        yield ('MSSqlAdapter %d vertices' % n, lambda polygon=polygon: MSSqlAdapter(polygon))
+        yield ('MSSqlWKBAdapter %d vertices' % n,
+               lambda polygon=polygon: MSSqlWKBAdapter(polygon))
+
+
+def convert_benchmarks(sizes):
+    ops = fake_connection('default').ops
+    field = Parcel._meta.get_field('geom')
+    for n in sizes:
+        polygon = make_polygon(n)
+        wkt = polygon.wkt
+        wkb = bytearray(struct.pack('>i', polygon.srid) + bytes(polygon.wkb))
+        native = serialize_polygon(polygon)
+        yield ('convert_geom wkt %d vertices' % n,
+               lambda wkt=wkt: ops.convert_geom(wkt, field))
+        yield ('convert_geom wkb %d vertices' % n,
+               lambda wkb=wkb: ops.convert_geom(wkb, field))
+        yield ('convert_geom native %d vertices' % n,
+               lambda native=native: ops.convert_geom(native, field))
+    envelope = bytearray(make_polygon(4).envelope.wkb)
+    yield ('convert_extent', lambda: ops.convert_extent(envelope))
+
+
+def decode_benchmarks(rows=1000, vertices=50):
+    polygon = make_polygon(vertices)
+    wkb = bytearray(struct.pack('>i', polygon.srid) + bytes(polygon.wkb))
+    for alias, value in (('default', polygon.wkt), ('wkb', wkb)):
+        fake_connection(alias, [(i, value) for i in range(rows)])
+        yield ('decode %d rows %s' % (rows, alias),
+               lambda alias=alias: list(Parcel.objects.using(alias).all()))
+
+
+def run(sizes=(5, 50, 500, 5000)):
+    benchmarks = []
+    for group in (lookup_benchmarks(), distance_benchmarks(),
+                  adapter_benchmarks(sizes), convert_benchmarks(sizes),
+                  decode_benchmarks()):
+        benchmarks.extend(group)
+    results = {}
+    for name, func in benchmarks:
+        results[name] = measure(func)
+        print('%-45s %12.1f us' % (name, results[name]))
+    return results
+
+
+def version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, filename):
+    with open(filename) as f:
+        saved = json.load(f)
+    print()
+    print('Compared with %s (%s):' % (filename, saved['version']))
+    print('%-45s %12s %12s %8s' % ('', 'before us', 'after us', 'change'))
+    for name in sorted(results):
+        before = saved['results'].get(name)
+        if before:
+            print('%-45s %12.1f %12.1f %+7.0f%%' % (
+                name, before, results[name], 100 * (results[name] / before - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--save', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare with results saved earlier')
+    args = parser.parse_args()
+
+    results = run()
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'version': version(), 'python': platform.python_version(),
+                       'results': results}, f, indent=1, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Compares the default WKT readback with the binary one (the
+``geometry_readback`` option): bytes transferred per geometry, and the
+time taken to decode the column values into GEOS geometries.
+
+No server is needed; column values are built locally in the form SQL
+Server returns them (STAsText(), or the SRID-prefixed STAsBinary()).
+
+    python benchmarks/readback.py
+"""
+from __future__ import print_function
+
+import math
+import struct
+import timeit
+
+from django.conf import settings
+
+settings.configure()
+
+from django.contrib.gis.geos import Polygon
+
+from django_pyodbc_gis.operations import MSSqlOperations
+
+
+class FakeConnection(object):
+    settings_dict = {'OPTIONS': {'geometry_readback': 'wkb'}}
+
+
+def make_polygon(n, srid=4326):
+    """A roughly circular polygon with `n` vertices, in lon/lat."""
+    ring = [(144.96 + 0.01 * math.cos(2 * math.pi * i / n),
+             -37.81 + 0.01 * math.sin(2 * math.pi * i / n))
+            for i in range(n)]
+    ring.append(ring[0])
+    return Polygon(ring, srid=srid)
+
+
+def main(sizes=(5, 50, 500, 5000), rows=200):
+    ops = MSSqlOperations(FakeConnection())
+    print('%8s %12s %12s %12s %12s' %
+          ('vertices', 'wkt bytes', 'wkb bytes', 'wkt us/row', 'wkb us/row'))
+    for n in sizes:
+        geom = make_polygon(n)
+        wkt = geom.wkt
+        wkb = bytearray(struct.pack('>i', geom.srid) + bytes(geom.wkb))
+
+        wkt_time = timeit.timeit(lambda: ops.convert_geom(wkt, None),
+                                 number=rows)
+        wkb_time = timeit.timeit(lambda: ops.convert_geom(wkb, None),
+                                 number=rows)
+        print('%8d %12d %12d %12.1f %12.1f' %
+              (n, len(wkt), len(wkb),
+               1e6 * wkt_time / rows, 1e6 * wkb_time / rows))
+
+
+if __name__ == '__main__':
+    main()
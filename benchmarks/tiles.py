@@ -0,0 +1,75 @@
+"""
+Measures vector tile encoding (django_pyodbc_gis.tiles): tiles per
+second for layers of polygons of increasing size.
+
+No server is needed; the rows come from a fake cursor, with the
+geometries serialized as SQL Server returns them, already clipped to
+the tile.  So this times everything but the query itself.
+
+    python benchmarks/tiles.py
+"""
+from __future__ import print_function
+
+import math
+import struct
+import timeit
+
+from django.conf import settings
+
+settings.configure()
+
+from django_pyodbc_gis.tiles import TileLayer, fetch_rows, tile_bounds
+
+
+class FakeCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.pos = 0
+
+    def fetchmany(self, size):
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += size
+        return rows
+
+
+def serialize_polygon(ring, srid=3857):
+    """A polygon in SQL Server's serialization (version 1, valid)."""
+    data = struct.pack('<iBBI', srid, 1, 0x04, len(ring))
+    data += b''.join(struct.pack('<dd', x, y) for x, y in ring)
+    data += struct.pack('<IBi', 1, 2, 0)
+    data += struct.pack('<IiiB', 1, -1, 0, 3)
+    return data
+
+
+def make_rows(features, vertices, z, x, y):
+    """Circular polygons scattered across the tile."""
+    xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+    size = xmax - xmin
+    radius = size / math.sqrt(features) / 3
+    rows = []
+    for i in range(features):
+        cx = xmin + size * ((i * 0.618) % 1)
+        cy = ymin + size * ((i * 0.382) % 1)
+        ring = [(cx + radius * math.cos(2 * math.pi * k / vertices),
+                 cy + radius * math.sin(2 * math.pi * k / vertices))
+                for k in range(vertices)]
+        ring.append(ring[0])
+        rows.append((i + 1, serialize_polygon(ring), 'feature %d' % (i % 10), i % 7))
+    return rows
+
+
+def main(sizes=(5, 50, 500), features=1000, number=5):
+    z, x, y = 14, 14772, 10048
+    layer = TileLayer('bench', 3857, properties=['name', 'kind'])
+    print('%8s %10s %12s %12s' % ('vertices', 'features', 'tile bytes', 'tiles/sec'))
+    for n in sizes:
+        rows = make_rows(features, n, z, x, y)
+        data = layer.encode(fetch_rows(FakeCursor(rows)), z, x, y)
+        seconds = timeit.timeit(
+            lambda: layer.encode(fetch_rows(FakeCursor(rows)), z, x, y),
+            number=number)
+        print('%8d %10d %12d %12.1f' % (n, features, len(data), number / seconds))
+
+
+if __name__ == '__main__':
+    main()
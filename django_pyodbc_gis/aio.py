@@ -0,0 +1,305 @@
+"""
+An asyncio interface to spatial querysets.
+
+pyodbc blocks, so queries run on the worker threads of a bounded
+executor, each of which has its own connections (Django's connections
+are per thread), and the event loop gets awaitables for their results:
+
+    parcel = await Parcel.objects.aget(pk=1)
+    nearest = await Place.objects.anearest(point, 10)
+    async for parcel in Parcel.objects.filter(geom__bbintersects=view).aiter():
+        ...
+
+Independent queries run concurrently, up to the executor's
+`max_workers`, for example the layers of one tile:
+
+    layers = await asyncio.gather(*[
+        aio.executor.submit('default', tile, qs, z, x, y) for qs in querysets])
+
+Cancelling an awaitable (or the task awaiting it) cancels its statement
+on the server too, through ODBC's SQLCancel, which needs pyodbc 4.0.22
+or later.  A stream (aiter(), aiter_geojson()) holds its worker until it
+is exhausted, cancelled or dropped.
+
+The workers can't see uncommitted changes of the calling thread, and
+their connections are closed after each query as at the end of a
+request, unless CONN_MAX_AGE keeps them.  Requires Python 3.5.
+"""
+import threading
+from collections import deque
+
+from django.db import close_old_connections, connections
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+
+def cancel_cursor(cursor):
+    """
+    Cancels the statement running on a pyodbc cursor, if there is one.
+    """
+    cancel = getattr(cursor, 'cancel', None)
+    if cancel is None:
+        return
+    try:
+        cancel()
+    except Exception:
+        # The cursor is closed already, or the driver can't.
+        pass
+
+
+class QueryTask(object):
+    """
+    A piece of database work, run on a worker thread with that thread's
+    connection to the `using` database.
+    """
+
+    def __init__(self, using, func, args=(), kwargs=None):
+        self.using = using
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.cancelled = False
+        self.connection = None
+        self._lock = threading.Lock()
+
+    def run(self):
+        with self._lock:
+            if self.cancelled:
+                return None
+            self.connection = connections[self.using]
+        try:
+            return self.func(*self.args, **self.kwargs)
+        finally:
+            with self._lock:
+                self.connection = None
+            close_old_connections()
+
+    def cancel(self):
+        """
+        Stops the task, and the statement it is running, if any.  May be
+        called from any thread.
+        """
+        with self._lock:
+            self.cancelled = True
+            connection = self.connection
+            cursor = getattr(connection, 'last_cursor', None)
+        if cursor is not None:
+            cancel_cursor(cursor)
+
+
+class QueryExecutor(object):
+    """
+    Runs database work on a pool of `max_workers` threads, for the
+    event loop.
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def pool(self):
+        if asyncio is None or ThreadPoolExecutor is None:
+            raise ImportError('The async interface requires asyncio.')
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.max_workers)
+            return self._pool
+
+    def submit(self, using, func, *args, **kwargs):
+        """
+        Returns an asyncio future for the result of func(*args,
+        **kwargs), run with a connection to the `using` database.
+        """
+        task = QueryTask(using, func, args, kwargs)
+        return self.run(task)
+
+    def run(self, task):
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.pool(), task.run)
+        future.add_done_callback(lambda f: f.cancelled() and task.cancel())
+        return future
+
+    def stream(self, using, func, *args, **kwargs):
+        """
+        Returns an async iterator over the items of the lists (chunks)
+        yielded by the iterable func(*args, **kwargs), run with a
+        connection to the `using` database.
+        """
+        return AsyncStream(self, using, func, args, kwargs)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait)
+
+
+class StreamState(object):
+    """
+    What a stream's worker and its consumer share: the consumer's
+    requests for the next item, and the items delivered early.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.requests = deque()
+        self.buffer = deque()
+        self.closed = False
+        self.finished = False
+        self.ready = threading.Condition()
+
+    def request(self, future):
+        with self.ready:
+            self.requests.append(future)
+            self.ready.notify()
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+    def wait(self):
+        """
+        Returns the consumer's next request, or None once closed.
+        """
+        with self.ready:
+            while not self.requests and not self.closed:
+                self.ready.wait(1.0)
+            if self.closed:
+                return None
+            return self.requests.popleft()
+
+    def deliver(self, future, chunk=None, exception=None):
+        """
+        Completes a request, on the event loop: with the first item of a
+        chunk, keeping the rest for the following requests.
+        """
+        if exception is not None:
+            self.finished = True
+        if future.cancelled():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            self.buffer.extend(chunk[1:])
+            future.set_result(chunk[0])
+
+
+class AsyncStream(object):
+    """
+    An async iterator over the chunks of a blocking iterable, which is
+    read on a worker thread as the items are asked for.
+    """
+
+    def __init__(self, executor, using, func, args, kwargs):
+        self.loop = asyncio.get_event_loop()
+        self.state = StreamState(self.loop)
+        self.task = QueryTask(using, produce, (self.state, func, args, kwargs))
+        self.executor = executor
+        self.future = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        state = self.state
+        result = self.loop.create_future()
+        if state.buffer:
+            result.set_result(state.buffer.popleft())
+            return result
+        if state.finished or state.closed:
+            result.set_exception(StopAsyncIteration())
+            return result
+        if self.future is None:
+            self.future = self.executor.run(self.task)
+        result.add_done_callback(self._cancelled)
+        state.request(result)
+        return result
+
+    def _cancelled(self, result):
+        if result.cancelled():
+            self.aclose()
+
+    def aclose(self):
+        """
+        Stops the stream, and the statement it is running.
+        """
+        state = self.state
+        state.close()
+        self.task.cancel()
+        with state.ready:
+            requests = list(state.requests)
+            state.requests.clear()
+        for request in requests:
+            request.cancel()
+        result = self.loop.create_future()
+        result.set_result(None)
+        return result
+
+    def __del__(self):
+        # The worker would otherwise wait on a consumer that has gone.
+        self.state.close()
+
+
+def produce(state, func, args, kwargs):
+    """
+    Reads the chunks of func(*args, **kwargs) as they are requested.
+    """
+    loop = state.loop
+    iterator = None
+    try:
+        while True:
+            future = state.wait()
+            if future is None:
+                return
+            try:
+                if iterator is None:
+                    iterator = iter(func(*args, **kwargs))
+                chunk = next(iterator)
+                while not chunk:
+                    chunk = next(iterator)
+            except StopIteration:
+                loop.call_soon_threadsafe(state.deliver, future, None, StopAsyncIteration())
+                return
+            except Exception as e:
+                loop.call_soon_threadsafe(state.deliver, future, None, e)
+                return
+            loop.call_soon_threadsafe(state.deliver, future, list(chunk))
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+def chunked(size, func, *args, **kwargs):
+    """
+    Yields lists of up to `size` items of func(*args, **kwargs), which
+    is only called once the first is asked for.
+    """
+    chunk = []
+    for item in func(*args, **kwargs):
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def evaluate(func, *args, **kwargs):
+    """
+    Returns the result of func(*args, **kwargs) as a list.
+    """
+    return list(func(*args, **kwargs))
+
+
+executor = QueryExecutor()
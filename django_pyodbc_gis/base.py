@@ -1,8 +1,17 @@
 from sql_server.pyodbc.base import *
 from sql_server.pyodbc.base import DatabaseWrapper as MSSqlDatabaseWrapper
+from django.contrib.gis.db.models.fields import GeometryField
+from django.db.models.loading import cache as app_cache
+from django.db.utils import DatabaseError
+from django.utils import six
+from django.utils.module_loading import import_by_path
 from django_pyodbc_gis.creation import MSSqlCreation
+from django_pyodbc_gis.instrumentation import InstrumentedCursor
 from django_pyodbc_gis.introspection import MSSqlIntrospection
 from django_pyodbc_gis.operations import MSSqlOperations
+from django_pyodbc_gis.pool import get_pool
+from django_pyodbc_gis.serialization import SQL_SS_UDT, SerializedGeometry
+from django_pyodbc_gis.spatial_refs import srid_cache
 
 
 class DatabaseWrapper(MSSqlDatabaseWrapper):
@@ -12,3 +21,119 @@ class DatabaseWrapper(MSSqlDatabaseWrapper):
         self.creation = MSSqlCreation(self)
         self.ops = MSSqlOperations(self)
         self.introspection = MSSqlIntrospection(self)
+        srid_cache.install(self.alias)
+        # See instrumentation.py.
+        options = self.settings_dict.get('OPTIONS', {})
+        self.capture_plans = options.get('capture_plans', False)
+        self.spatial_labels = None
+        self.spatial_cursor = None
+        self.last_cursor = None
+        # See pool.py.
+        self.pool_options = options.get('pool')
+        self.pooled = None
+        self.warm_up_hook = options.get('warm_up')
+        if isinstance(self.warm_up_hook, six.string_types):
+            self.warm_up_hook = import_by_path(self.warm_up_hook)
+
+    def create_cursor(self):
+        cursor = self.connection.cursor()
+        # So that its statement can be cancelled from another thread;
+        # see aio.py.
+        self.last_cursor = cursor
+        return InstrumentedCursor(cursor, self)
+
+    def get_new_connection(self, conn_params):
+        if self.pool_options is None:
+            return super(DatabaseWrapper, self).get_new_connection(conn_params)
+        # The test runner points the alias at another database.
+        database = (self.alias,) + tuple(conn_params.get(key) for key in
+                                          ('NAME', 'HOST', 'PORT', 'USER'))
+        pool = get_pool(database, self.pool_options)
+        self.pooled = pool.acquire(
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        return self.pooled.connection
+
+    def init_connection_state(self):
+        """
+        A pooled connection keeps the session settings it was given,
+        and what was found out about the driver and server then (the
+        pool's traits) holds for every connection to the database.
+        """
+        pooled = self.pooled
+        if pooled is not None and pooled.initialized and pooled.pool.traits is not None:
+            self.set_traits(pooled.pool.traits)
+            return
+        super(DatabaseWrapper, self).init_connection_state()
+        if pooled is not None:
+            pooled.pool.traits = self.get_traits()
+
+    def get_traits(self):
+        return {
+            'supports_mars': self.supports_mars,
+            'driver_charset': self.driver_charset,
+            'use_legacy_datetime': self.use_legacy_datetime,
+            'can_use_chunked_reads': self.features.can_use_chunked_reads,
+            'has_bulk_insert': self.features.has_bulk_insert,
+            'sql_server_version': self.sql_server_version,
+        }
+
+    def set_traits(self, traits):
+        self.supports_mars = traits['supports_mars']
+        self.driver_charset = traits['driver_charset']
+        if traits['use_legacy_datetime'] and not self.use_legacy_datetime:
+            self.use_legacy_datetime = True
+            self.creation.use_legacy_datetime()
+            self.features.supports_microsecond_precision = False
+        self.features.can_use_chunked_reads = traits['can_use_chunked_reads']
+        self.features.has_bulk_insert = traits['has_bulk_insert']
+        # Otherwise asked of the server, once per wrapper.
+        self.__dict__['sql_server_version'] = traits['sql_server_version']
+
+    def connect(self):
+        super(DatabaseWrapper, self).connect()
+        if self.pooled is None or not self.pooled.initialized:
+            self.warm_up()
+            if self.pooled is not None:
+                self.pooled.initialized = True
+
+    def warm_up(self):
+        """
+        Prepares a new connection for spatial queries, so that the first
+        one costs no more than later ones: registers the output
+        converters, loads the spatial reference systems (once per
+        process) and parses those of the installed models, then calls
+        the ``warm_up`` option's function, if any, with the wrapper.
+        """
+        # pyodbc can't fetch CLR types by itself, so for the native
+        # readback we take the spatial values as they are and leave
+        # decoding to the operations.
+        if self.ops.geometry_readback == 'native':
+            self.connection.add_output_converter(SQL_SS_UDT, SerializedGeometry.from_db)
+        try:
+            srid_cache.preload(self, self.model_srids())
+        except DatabaseError:
+            # They are read when first needed instead.
+            pass
+        if self.warm_up_hook is not None:
+            self.warm_up_hook(self)
+
+    def model_srids(self):
+        """
+        The SRIDs of the geometry fields of the installed models, once
+        they have all been loaded.
+        """
+        if not app_cache.app_cache_ready():
+            return set()
+        return set(f.srid for model in app_cache.get_models()
+                   for f in model._meta.fields if isinstance(f, GeometryField))
+
+    def _close(self):
+        pooled, self.pooled = self.pooled, None
+        if pooled is None:
+            return super(DatabaseWrapper, self)._close()
+        if self.in_atomic_block:
+            # Django keeps the connection until the block is left, so it
+            # can't go to anyone else.
+            pooled.pool.discard(pooled)
+        else:
+            pooled.pool.release(pooled, check=self.errors_occurred)
@@ -0,0 +1,229 @@
+"""
+A result cache for repeated viewport and tile queries.
+
+Entries are keyed on the model, the query's SQL and parameters, and the
+envelope it covers, and evicted least recently used first once there
+are more than ``max_entries`` of them (or more than ``max_bytes`` of
+pickled results).
+
+Entries are invalidated spatially: saving or deleting an instance of a
+cached model evicts only the entries whose envelopes intersect the old
+or new extent of its geometries, as does MSSqlGeoManager.bulk_load()
+for the extent of the loaded rows.  Entries without an envelope, and
+every entry of the model after a queryset update() or a bulk_load()
+with merge_on (which replace geometries we can't see), are evicted by
+any write.  Envelopes are compared in the fields' own SRIDs.
+
+    from django_pyodbc_gis.cache import spatial_cache
+    parcels = spatial_cache.fetch(Parcel.objects.filter(geom__bbintersects=view), view)
+    data = spatial_cache.tile(Parcel.objects.all(), z, x, y)
+"""
+import pickle
+import threading
+import weakref
+from collections import OrderedDict
+
+from django.contrib.gis.db.models.fields import GeometryField
+from django.db.models import signals
+from django.utils import six
+
+
+# Every SpatialCache, for invalidation.
+_caches = weakref.WeakSet()
+
+
+def table_of(model):
+    return model._meta.concrete_model._meta.db_table
+
+
+def envelope_of(value):
+    """
+    Returns the (xmin, ymin, xmax, ymax) of a geometry or 4-tuple, or
+    None for no value or an empty geometry.
+    """
+    if value is None:
+        return None
+    elif isinstance(value, (tuple, list)):
+        return tuple(value)
+    elif value.empty:
+        return None
+    return value.extent
+
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class SpatialCache(object):
+    """
+    A thread-safe LRU cache of query results, invalidated by envelope.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        _caches.add(self)
+
+    def key(self, queryset, envelope=None):
+        """
+        Returns the key for a queryset's results over an envelope.
+        """
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        # Adapters compare by their SRID as well as their WKT.
+        params = tuple((six.text_type(p), getattr(p, 'srid', None)) for p in params)
+        return (table_of(queryset.model), queryset.db, ' '.join(sql.split()),
+                params, envelope_of(envelope))
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, model):
+        """
+        Stores a value under a key (from key()), for a model whose writes
+        invalidate it.
+        """
+        watch(model)
+        size = len(pickle.dumps(value, -1)) if self.max_bytes else 0
+        with self._lock:
+            self.delete(key)
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._entries and (
+                    len(self._entries) > self.max_entries or
+                    (self.max_bytes and self._bytes > self.max_bytes)):
+                self.delete(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def fetch(self, queryset, envelope=None):
+        """
+        Returns the results of a queryset as a list, from the cache if
+        possible.  `envelope` (a geometry or 4-tuple) is the area the
+        results depend on, usually the viewport being filtered on.
+        """
+        key = self.key(queryset, envelope)
+        result = self.get(key)
+        if result is None:
+            result = list(queryset)
+            self.set(key, result, queryset.model)
+        return result
+
+    def tile(self, queryset, z, x, y, **kwargs):
+        """
+        Returns a vector tile (see tiles.tile()), from the cache if
+        possible.
+        """
+        from django_pyodbc_gis.tiles import TileQuery
+
+        query = TileQuery(queryset, **kwargs)
+        envelope = query.envelope(z, x, y)
+        key = self.key(query.queryset, envelope) + (
+            'tile', z, x, y, repr(sorted(kwargs.items())))
+        result = self.get(key)
+        if result is None:
+            result = query.tile(z, x, y)
+            self.set(key, result, query.queryset.model)
+        return result
+
+    def has_entries(self, table, using):
+        with self._lock:
+            return any(key[0] == table and key[1] == using for key in self._entries)
+
+    def invalidate(self, table, using, extents=None):
+        """
+        Evicts the entries of a table whose envelopes intersect any of
+        the extents; all of them if `extents` is None.  Entries without
+        an envelope are always evicted.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] != table or key[1] != using:
+                    continue
+                envelope = key[4]
+                if extents is None or envelope is None or \
+                        any(intersects(envelope, extent) for extent in extents):
+                    self.delete(key)
+
+
+def invalidate(model, using, extents=None):
+    """
+    Evicts the entries of a model (on the `using` database) whose
+    envelopes intersect any of the extents from every cache; all of
+    the model's entries if `extents` is None.
+    """
+    for cache in list(_caches):
+        cache.invalidate(table_of(model), using, extents)
+
+
+def geometry_extents(instance):
+    fields = [f for f in instance._meta.concrete_fields if isinstance(f, GeometryField)]
+    extents = [envelope_of(getattr(instance, f.attname)) for f in fields]
+    return [extent for extent in extents if extent is not None]
+
+
+def stored_extents(sender, instance, using):
+    """
+    Returns the extents of an instance's geometries as they are in the
+    database, if any cache holds entries that writing it could affect.
+    """
+    table = table_of(sender)
+    if instance.pk is None or instance._state.adding or \
+            not any(cache.has_entries(table, using) for cache in list(_caches)):
+        return []
+    fields = [f.name for f in sender._meta.concrete_fields if isinstance(f, GeometryField)]
+    rows = sender._default_manager.using(using).filter(pk=instance.pk).values_list(*fields)
+    extents = [envelope_of(geom) for row in rows for geom in row]
+    return [extent for extent in extents if extent is not None]
+
+
+def _pre_save(sender, instance, raw=False, using=None, **kwargs):
+    instance._cached_extents = stored_extents(sender, instance, using)
+
+
+def _post_save(sender, instance, raw=False, using=None, **kwargs):
+    extents = getattr(instance, '_cached_extents', [])
+    invalidate(sender, using, extents + geometry_extents(instance))
+    instance._cached_extents = []
+
+
+def _post_delete(sender, instance, using=None, **kwargs):
+    # Deletion fetches the instances first, so their geometries are
+    # those in the database.
+    invalidate(sender, using, geometry_extents(instance))
+
+
+def watch(model):
+    """
+    Connects the invalidating signal handlers for a model.  Done as
+    entries are stored, to keep fast deletes for every other model.
+    """
+    uid = 'spatial_cache_%s' % table_of(model)
+    signals.pre_save.connect(_pre_save, sender=model, dispatch_uid=uid)
+    signals.post_save.connect(_post_save, sender=model, dispatch_uid=uid)
+    signals.post_delete.connect(_post_delete, sender=model, dispatch_uid=uid)
+
+
+spatial_cache = SpatialCache()
@@ -0,0 +1,353 @@
+"""
+Columnar fetching for MSSqlGeoQuerySet.to_coords_array() and
+to_geoarrow().
+
+Rather than building a model instance and a GEOS geometry for every
+row, the rows are fetched in chunks and their coordinates copied
+straight into NumPy arrays, using the GeoArrow layout: one array of
+interleaved coordinates, plus an array of offsets for every level of
+nesting.  For example, polygons have ``geom_offsets`` into the rings,
+and ``ring_offsets`` into the coordinates.
+
+Points are selected with STX/STY (Long/Lat for geography).  Anything
+else is selected in SQL Server's own serialization (see
+serialization.py), where the points are already stored as one
+contiguous array.  Only two dimensions are returned.
+"""
+import json
+import struct
+
+from django.db import connections
+from django.utils.datastructures import SortedDict
+
+from django_pyodbc_gis.serialization import (
+    HAS_M, HAS_Z, SINGLE_LINE, SINGLE_POINT)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+# The offset arrays used by each geometry type, outermost first.
+LAYOUTS = {
+    'POINT': (),
+    'LINESTRING': ('geom_offsets',),
+    'POLYGON': ('geom_offsets', 'ring_offsets'),
+    'MULTIPOINT': ('geom_offsets',),
+    'MULTILINESTRING': ('geom_offsets', 'part_offsets'),
+    'MULTIPOLYGON': ('geom_offsets', 'polygon_offsets', 'ring_offsets'),
+}
+
+# Attribute columns that can go into a typed array; everything else
+# (and anything nullable) is kept as objects.
+FIELD_DTYPES = {
+    'AutoField': 'i8',
+    'BigIntegerField': 'i8',
+    'BooleanField': '?',
+    'FloatField': 'f8',
+    'IntegerField': 'i8',
+    'PositiveIntegerField': 'i8',
+    'PositiveSmallIntegerField': 'i8',
+    'SmallIntegerField': 'i8',
+}
+
+if numpy is not None:
+    figure_dtype = numpy.dtype([('attribute', 'u1'), ('offset', '<i4')])
+    shape_dtype = numpy.dtype([('parent', '<i4'), ('figure', '<i4'),
+                               ('type', 'u1')])
+
+
+class Buffer(object):
+    """
+    A NumPy array that can be appended to, doubling its capacity as
+    needed.
+    """
+
+    def __init__(self, dtype, width=None, capacity=1024):
+        shape = (capacity,) if width is None else (capacity, width)
+        self.data = numpy.empty(shape, dtype)
+        self.size = 0
+
+    def reserve(self, n):
+        capacity = len(self.data)
+        if self.size + n > capacity:
+            while self.size + n > capacity:
+                capacity *= 2
+            data = numpy.empty((capacity,) + self.data.shape[1:],
+                               self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+    def append(self, value):
+        self.reserve(1)
+        self.data[self.size] = value
+        self.size += 1
+
+    def extend(self, values):
+        n = len(values)
+        self.reserve(n)
+        self.data[self.size:self.size + n] = values
+        self.size += n
+
+    def array(self):
+        return self.data[:self.size]
+
+
+class CoordinateFetcher(object):
+    """
+    Fetches a geometry column, and any number of attribute columns,
+    from a queryset into arrays.
+    """
+
+    def __init__(self, queryset, field_name=None, fields=()):
+        if numpy is None:
+            raise ImportError('Columnar fetching requires numpy.')
+
+        self.queryset = queryset
+        self.connection = connections[queryset.db]
+        self.geo_field = queryset.query._geo_field(field_name)
+        if not self.geo_field:
+            raise TypeError('Columnar fetching only available on '
+                            'GeometryFields.')
+
+        self.geom_type = self.geo_field.geom_type
+        if self.geom_type not in LAYOUTS:
+            raise TypeError('Columnar fetching is not available for %s '
+                            'fields.' % self.geom_type)
+
+        self.geo_col = queryset._geocol_select(self.geo_field, field_name)
+        self.geography = self.geo_field.geography
+        self.fields = list(fields)
+
+    def as_sql(self):
+        """
+        Returns the SQL and parameters of the columnar query: the
+        geometry expression(s) first, followed by the attribute fields.
+        """
+        if self.geom_type == 'POINT':
+            if self.geography:
+                fmt = ('%s.Long', '%s.Lat')
+            else:
+                fmt = ('%s.STX', '%s.STY')
+        else:
+            fmt = ('CAST(%s AS varbinary(max))',)
+        select = SortedDict(('_geom%d' % i, f % self.geo_col)
+                            for i, f in enumerate(fmt))
+        qs = self.queryset.extra(select=select)
+        qs = qs.values_list(*(list(select) + self.fields))
+        compiler = qs.query.get_compiler(self.queryset.db)
+        # This is executed directly, so any query hints apply.
+        compiler.outermost = True
+        return compiler.as_sql()
+
+    def fetch(self, chunk_size=10000):
+        """
+        Returns a dictionary of arrays: ``coords`` (N x 2), the offset
+        arrays for the field's geometry type (see LAYOUTS), and one
+        array per attribute field.
+        """
+        coords = Buffer('f8', 2, chunk_size)
+        offsets = SortedDict((name, Buffer('i8', capacity=chunk_size))
+                             for name in LAYOUTS[self.geom_type])
+        for buf in offsets.values():
+            buf.append(0)
+
+        opts = self.queryset.model._meta
+        attrs = SortedDict()
+        for name in self.fields:
+            field = opts.get_field(name)
+            dtype = FIELD_DTYPES.get(field.get_internal_type(), object)
+            if field.null:
+                dtype = object
+            attrs[name] = Buffer(dtype, capacity=chunk_size)
+
+        # Points take two columns, everything else one.
+        ngeom = 2 if self.geom_type == 'POINT' else 1
+        append = getattr(self, '_append_%s' % self.geom_type.lower())
+
+        sql, params = self.as_sql()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                if self.geom_type == 'POINT':
+                    append(rows, coords)
+                else:
+                    for row in rows:
+                        append(row[0], coords, offsets)
+                for i, buf in enumerate(attrs.values()):
+                    buf.extend(self._column(rows, ngeom + i, buf.data.dtype))
+        finally:
+            cursor.close()
+
+        result = SortedDict([('coords', coords.array())])
+        for name, buf in offsets.items():
+            result[name] = buf.array()
+        for name, buf in attrs.items():
+            result[name] = buf.array()
+        return result
+
+    def _column(self, rows, index, dtype):
+        if dtype == object:
+            return [row[index] for row in rows]
+        return numpy.fromiter((row[index] for row in rows), dtype, len(rows))
+
+    # Per geometry type routines.  NULLs (and empty points) become NaN
+    # points or empty geometries, since the offsets can't express them.
+    # Empty geometries have no figures, and so no rings or parts.
+
+    def _append_point(self, rows, coords):
+        coords.reserve(len(rows))
+        block = coords.data[coords.size:coords.size + len(rows)]
+        for axis in (0, 1):
+            block[:, axis] = numpy.fromiter(
+                (numpy.nan if row[axis] is None else row[axis]
+                 for row in rows), 'f8', len(rows))
+        coords.size += len(rows)
+
+    def _append_linestring(self, value, coords, offsets):
+        if value is not None:
+            xy, figures, shapes = self._parse(value)
+            coords.extend(xy)
+        offsets['geom_offsets'].append(coords.size)
+
+    _append_multipoint = _append_linestring
+
+    def _append_polygon(self, value, coords, offsets):
+        base = coords.size
+        rings = offsets['ring_offsets']
+        if value is not None:
+            xy, figures, shapes = self._parse(value)
+            coords.extend(xy)
+            if len(figures):
+                rings.extend(self._ends(figures, len(xy)) + base)
+        offsets['geom_offsets'].append(rings.size - 1)
+
+    def _append_multilinestring(self, value, coords, offsets):
+        base = coords.size
+        parts = offsets['part_offsets']
+        if value is not None:
+            xy, figures, shapes = self._parse(value)
+            coords.extend(xy)
+            if len(figures):
+                starts = self._children(figures, shapes)
+                points = numpy.append(figures, len(xy))
+                parts.extend(points[numpy.append(starts[1:], len(figures))] + base)
+        offsets['geom_offsets'].append(parts.size - 1)
+
+    def _append_multipolygon(self, value, coords, offsets):
+        base = coords.size
+        rings = offsets['ring_offsets']
+        polygons = offsets['polygon_offsets']
+        if value is not None:
+            ring_base = rings.size - 1
+            xy, figures, shapes = self._parse(value)
+            coords.extend(xy)
+            if len(figures):
+                rings.extend(self._ends(figures, len(xy)) + base)
+                starts = self._children(figures, shapes)
+                polygons.extend(numpy.append(starts[1:], len(figures)) + ring_base)
+        offsets['geom_offsets'].append(polygons.size - 1)
+
+    # Helpers for reading the serialized instances.
+
+    def _parse(self, value):
+        return parse(value, self.geography)
+
+    def _ends(self, figures, npoints):
+        """Returns where each figure's points end."""
+        return numpy.append(figures[1:], npoints)
+
+    def _children(self, figures, shapes):
+        """
+        Returns the first figure of each member of a multi-geometry.
+        A single geometry is treated as a collection of one.
+        """
+        if shapes is None or len(shapes) == 1:
+            return numpy.zeros(1, 'i8')
+        starts = shapes['figure'][1:].astype('i8')
+        # Empty members have no figures; they start where the next
+        # non-empty one does.
+        if (starts < 0).any():
+            following = len(figures)
+            for i in range(len(starts) - 1, -1, -1):
+                if starts[i] < 0:
+                    starts[i] = following
+                else:
+                    following = starts[i]
+        return starts
+
+
+def parse(value, geography=False):
+    """
+    Returns the (N x 2) coordinates, the point offsets of the figures
+    and the shape table (None for a single point or line) of a
+    serialized instance (see [MS-SSCLRT]).  Requires numpy.
+    """
+    flags = bytearray(value[5:6])[0]
+    if flags & SINGLE_POINT:
+        npoints, pos = 1, 6
+    elif flags & SINGLE_LINE:
+        npoints, pos = 2, 6
+    else:
+        npoints, = struct.unpack_from('<I', value, 6)
+        pos = 10
+    xy = numpy.frombuffer(value, '<f8', 2 * npoints, pos)
+    xy = xy.reshape(npoints, 2)
+    if geography:
+        xy = xy[:, ::-1]
+
+    if flags & (SINGLE_POINT | SINGLE_LINE):
+        figures = numpy.zeros(1, 'i8')
+        shapes = None
+    else:
+        pos += 16 * npoints
+        if flags & HAS_Z:
+            pos += 8 * npoints
+        if flags & HAS_M:
+            pos += 8 * npoints
+        nfigures, = struct.unpack_from('<I', value, pos)
+        figures = numpy.frombuffer(value, figure_dtype, nfigures, pos + 4)
+        figures = figures['offset'].astype('i8')
+        pos += 4 + 5 * nfigures
+        nshapes, = struct.unpack_from('<I', value, pos)
+        shapes = numpy.frombuffer(value, shape_dtype, nshapes, pos + 4)
+    return xy, figures, shapes
+
+
+def to_geoarrow(arrays, geom_type, srid=None):
+    """
+    Returns a pyarrow Table built from the output of
+    CoordinateFetcher.fetch(), with the geometry in a GeoArrow
+    extension column (interleaved coordinates) called ``geometry``.
+    """
+    if pyarrow is None:
+        raise ImportError('to_geoarrow() requires pyarrow.')
+
+    arrays = arrays.copy()
+    values = pyarrow.FixedSizeListArray.from_arrays(
+        pyarrow.array(arrays.pop('coords').ravel()), 2)
+    for name in reversed(LAYOUTS[geom_type]):
+        offsets = pyarrow.array(arrays.pop(name).astype('i4'))
+        values = pyarrow.ListArray.from_arrays(offsets, values)
+
+    metadata = {
+        b'ARROW:extension:name': ('geoarrow.%s' % geom_type.lower()).encode(),
+        b'ARROW:extension:metadata': json.dumps(
+            {'crs': 'EPSG:%d' % srid} if srid else {}).encode(),
+    }
+    fields = [pyarrow.field('geometry', values.type, metadata=metadata)]
+    columns = [values]
+    for name, array in arrays.items():
+        columns.append(pyarrow.array(array))
+        fields.append(pyarrow.field(name, columns[-1].type))
+    return pyarrow.Table.from_arrays(columns, schema=pyarrow.schema(fields))
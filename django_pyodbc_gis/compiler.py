@@ -1,12 +1,219 @@
+import re
+
+from django.contrib.gis.db.models.fields import GeometryField
 from django.contrib.gis.db.models.sql.compiler import GeoSQLCompiler as BaseGeoSQLCompiler
+from django.contrib.gis.db.models.sql.conversion import GeomField
+from django.db.models.sql.constants import SINGLE
+from django.utils import six
 from sql_server.pyodbc import compiler
 
+from django_pyodbc_gis.instrumentation import finish_query, labelled
+from django_pyodbc_gis.operations import MSSqlAdapter, MSSqlWKBAdapter, binary_types
+from django_pyodbc_gis.where import MEMBERS_SQL
+
 
 SQLCompiler = compiler.SQLCompiler
 
+# A geometry parameter with its constructor (see get_geom_placeholder()),
+# possibly unpacked into the members of a set lookup (see where.py), or
+# any other parameter, or an escaped percent sign.
+_members_start, _members_end = (re.escape(part) for part in MEMBERS_SQL.split('%s'))
+PARAMETER = re.compile(r'(?P<members>' + _members_start + r')?'
+                       r'(?P<geometry>(?P<ns>geometry|geography)'
+                       r'::STGeomFrom\w+\(%s,-?\d+\))'
+                       r'(?(members)' + _members_end + r')|%s|%%')
+
+# Fills a table variable with the members of a geometry collection.
+MEMBERS_TABLE_SQL = (
+    'DECLARE %(name)s TABLE (geom %(ns)s); '
+    'DECLARE %(name)s_all %(ns)s = %(geometry)s; '
+    'INSERT INTO %(name)s (geom) SELECT %(name)s_all.STGeometryN(n) FROM '
+    '(SELECT TOP (%(name)s_all.STNumGeometries()) '
+    'ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) AS n '
+    'FROM sys.all_columns AS a CROSS JOIN sys.all_columns AS b) AS numbers;')
+
+
+def declare_geometries(sql, params):
+    """
+    Binds each geometry that the SQL has as a parameter more than once
+    (such as a distance() from the geometry of a distance_lte lookup) to
+    a variable declared ahead of the statement, so that SQL Server only
+    receives and parses it the once.  The members of the geometry sets
+    of set lookups go into table variables likewise, rather than being
+    unpacked by the statement itself.
+    """
+    matches = [m for m in PARAMETER.finditer(sql) if m.group(0) != '%%']
+    keys, counts, members = [], {}, set()
+    for m, param in zip(matches, params):
+        key = None
+        if m.group('ns') and isinstance(param, (MSSqlAdapter, MSSqlWKBAdapter)):
+            key = (m.group(0), param)
+            counts[key] = counts.get(key, 0) + 1
+            if m.group('members'):
+                members.add(key)
+        keys.append(key)
+    if not members and all(count == 1 for count in six.itervalues(counts)):
+        return sql, params
+
+    names, declarations, declared = {}, [], []
+    parts, remaining, pos = [], [], 0
+    for m, param, key in zip(matches, params, keys):
+        if key is None or (counts[key] == 1 and key not in members):
+            remaining.append(param)
+            continue
+        if key not in names:
+            if key in members:
+                names[key] = '@members%d' % (len(names) + 1)
+                declarations.append(MEMBERS_TABLE_SQL % {
+                    'name': names[key], 'ns': m.group('ns'),
+                    'geometry': m.group('geometry')})
+            else:
+                names[key] = '@geom%d' % (len(names) + 1)
+                declarations.append('DECLARE %s %s = %s;' % (
+                    names[key], m.group('ns'), m.group('geometry')))
+            declared.append(param)
+        parts.append(sql[pos:m.start()])
+        parts.append(names[key])
+        pos = m.end()
+    parts.append(sql[pos:])
+    sql = ''.join(parts)
+    if members:
+        # Otherwise the INSERTs' row counts come ahead of the results.
+        declarations = ['SET NOCOUNT ON;'] + declarations + ['SET NOCOUNT OFF;']
+    return ' '.join(declarations + [sql]), tuple(declared + remaining)
+
 
 class GeoSQLCompiler(BaseGeoSQLCompiler, SQLCompiler):
-    pass
+
+    # Query hints (OPTION) may only be given for the statement that is
+    # actually executed, not for subqueries, which are compiled by
+    # compilers of their own.
+    outermost = False
+
+    def execute_sql(self, *args, **kwargs):
+        self.outermost = True
+        with labelled(self.connection, self.query):
+            result = super(GeoSQLCompiler, self).execute_sql(*args, **kwargs)
+        if (args[0] if args else kwargs.get('result_type')) == SINGLE:
+            # Only the one row is fetched, so the rows never run out.
+            finish_query(self.connection)
+        return result
+
+    def as_sql(self, with_limits=True, with_col_aliases=False):
+        sql, params = super(GeoSQLCompiler, self).as_sql(with_limits, with_col_aliases)
+        query_hints = getattr(self.query, 'query_hints', None)
+        if sql and query_hints and self.outermost:
+            sql = '%s OPTION (%s)' % (sql, ', '.join(query_hints))
+        return self.declare(sql, params)
+
+    def declare(self, sql, params):
+        # Variables can only be declared ahead of the whole statement.
+        if sql and self.outermost:
+            return declare_geometries(sql, params)
+        return sql, params
+
+    def get_from_clause(self):
+        """
+        As the base class's, but with the table hints requested with
+        spatial_index_hint() (see table_reference()).
+        """
+        if not getattr(self.query, 'index_hints', None):
+            return super(GeoSQLCompiler, self).get_from_clause()
+
+        result = []
+        qn = self.quote_name_unless_alias
+        qn2 = self.connection.ops.quote_name
+        first = True
+        from_params = []
+        for alias in self.query.tables:
+            if not self.query.alias_refcount[alias]:
+                continue
+            try:
+                name, alias, join_type, lhs, join_cols, _, join_field = self.query.alias_map[alias]
+            except KeyError:
+                # Extra tables can end up in self.tables, but not in the
+                # alias_map if they aren't in a join.
+                continue
+            table = self.table_reference(name, alias)
+            if join_type and not first:
+                extra_cond = join_field.get_extra_restriction(
+                    self.query.where_class, alias, lhs)
+                if extra_cond:
+                    extra_sql, extra_params = extra_cond.as_sql(qn, self.connection)
+                    extra_sql = 'AND (%s)' % extra_sql
+                    from_params.extend(extra_params)
+                else:
+                    extra_sql = ''
+                result.append('%s %s ON (' % (join_type, table))
+                for index, (lhs_col, rhs_col) in enumerate(join_cols):
+                    if index != 0:
+                        result.append(' AND ')
+                    result.append('%s.%s = %s.%s' %
+                                  (qn(lhs), qn2(lhs_col), qn(alias), qn2(rhs_col)))
+                result.append('%s)' % extra_sql)
+            else:
+                connector = '' if first else ', '
+                result.append('%s%s' % (connector, table))
+            first = False
+        for t in self.query.extra_tables:
+            alias, unused = self.query.table_alias(t)
+            # Only add the alias if it's not already present (see the
+            # base class).
+            if alias not in self.query.alias_map or self.query.alias_refcount[alias] == 1:
+                connector = '' if first else ', '
+                result.append('%s%s' % (connector, self.table_reference(alias, alias)))
+                first = False
+        return result, from_params
+
+    def table_reference(self, name, alias):
+        """
+        Returns a table's entry in the FROM clause: its name, its alias
+        and, for the tables given to spatial_index_hint(), a
+        WITH (INDEX(...)) hint.
+        """
+        reference = self.quote_name_unless_alias(name)
+        if alias != name:
+            reference += ' %s' % alias
+        index_name = self.query.index_hints.get(name)
+        if index_name:
+            reference += ' WITH (INDEX(%s))' % self.connection.ops.quote_name(index_name)
+        return reference
+
+    def get_field_select(self, field, alias=None, column=None):
+        """
+        Geometry fields with a third dimension are selected with the
+        Z/M-aware format, if the backend has one.
+        """
+        select_zm = self.connection.ops.select_zm
+        if select_zm and getattr(field, 'dim', 2) == 3 and \
+                field not in self.query.custom_select:
+            return select_zm % self._field_column(field, alias, column)
+        return super(GeoSQLCompiler, self).get_field_select(field, alias, column)
+
+    def resolve_columns(self, row, fields=()):
+        """
+        Binary geometries (see the ``geometry_readback`` option) are
+        decoded here; the base class would hand them straight to the
+        Geometry constructor, which only understands text.
+        """
+        ops = self.connection.ops
+        if ops.geometry_readback == 'wkt':
+            return super(GeoSQLCompiler, self).resolve_columns(row, fields)
+
+        extra_fields = [self.query.extra_select_fields.get(alias)
+                        for alias in self.query.extra_select]
+        row = list(row)
+        decoded = {}
+        for i, field in enumerate(extra_fields + list(fields)):
+            if i < len(row) and isinstance(field, (GeomField, GeometryField)) \
+                    and isinstance(row[i], binary_types):
+                decoded[i] = ops.convert_geom(row[i], field)
+                row[i] = None
+
+        values = list(super(GeoSQLCompiler, self).resolve_columns(row, fields))
+        for i, geom in six.iteritems(decoded):
+            values[i] = geom
+        return tuple(values)
 
 
 class SQLInsertCompiler(compiler.SQLInsertCompiler, GeoSQLCompiler):
@@ -14,15 +221,21 @@ class SQLInsertCompiler(compiler.SQLInsertCompiler, GeoSQLCompiler):
 
 
 class SQLDeleteCompiler(compiler.SQLDeleteCompiler, GeoSQLCompiler):
-    pass
+
+    def as_sql(self):
+        return self.declare(*super(SQLDeleteCompiler, self).as_sql())
 
 
 class SQLUpdateCompiler(compiler.SQLUpdateCompiler, GeoSQLCompiler):
-    pass
+
+    def as_sql(self):
+        return self.declare(*super(SQLUpdateCompiler, self).as_sql())
 
 
 class SQLAggregateCompiler(compiler.SQLAggregateCompiler, GeoSQLCompiler):
-    pass
+
+    def as_sql(self, qn=None):
+        return self.declare(*super(SQLAggregateCompiler, self).as_sql(qn))
 
 
 class SQLDateCompiler(compiler.SQLDateCompiler, GeoSQLCompiler):
@@ -1,6 +1,26 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import six
 from sql_server.pyodbc.creation import DatabaseCreation
 
 
+# The settings that may be given for a field's spatial index, by passing
+# a dictionary as its `spatial_index` argument instead of True; see
+# http://technet.microsoft.com/en-us/library/bb934196.aspx
+#
+#   tessellation:     'auto' (the default) or 'grid'
+#   bounding_box:     (xmin, ymin, xmax, ymax), geometry only; defaults
+#                     to the field's extent
+#   grids:            densities ('LOW', 'MEDIUM' or 'HIGH') for up to four
+#                     levels; implies the 'grid' tessellation
+#   cells_per_object, data_compression, fillfactor
+#   online:           only False; SQL Server can't build spatial indexes
+#                     online
+SPATIAL_INDEX_OPTIONS = (
+    'tessellation', 'bounding_box', 'grids', 'cells_per_object',
+    'data_compression', 'fillfactor', 'online',
+)
+
+
 class MSSqlCreation(DatabaseCreation):
     """
     This class encapsulates all backend-specific differences that pertain to
@@ -9,6 +29,89 @@ class MSSqlCreation(DatabaseCreation):
     destruction of test databases.
     """
 
+    def spatial_index_name(self, db_table, column):
+        """
+        Returns the name given to the spatial index of a column.
+        """
+        return '%s_%s_id' % (db_table, column)
+
+    def spatial_index_options(self, f):
+        """
+        Returns the spatial index settings given for a geometry field.
+        """
+        if not isinstance(f.spatial_index, dict):
+            return {}
+        unknown = set(f.spatial_index) - set(SPATIAL_INDEX_OPTIONS)
+        if unknown:
+            raise ImproperlyConfigured('Unknown spatial index options for '
+                                       '%s: %s' % (f.name, ', '.join(sorted(unknown))))
+        return dict(f.spatial_index)
+
+    def sql_spatial_index(self, model, f, style, options=None, drop_existing=False):
+        """
+        Returns the CREATE SPATIAL INDEX statement for a geometry field,
+        using the field's own index settings unless `options` are given.
+        """
+        qn = self.connection.ops.quote_name
+        db_table = model._meta.db_table
+        if options is None:
+            options = self.spatial_index_options(f)
+
+        kind = 'GEOGRAPHY' if f.geography else 'GEOMETRY'
+        grids = options.get('grids')
+        tessellation = options.get('tessellation', 'grid' if grids else 'auto')
+        if tessellation == 'auto' and not grids:
+            using = '%s_AUTO_GRID' % kind
+        elif tessellation == 'grid':
+            using = '%s_GRID' % kind
+        else:
+            raise ImproperlyConfigured('Invalid spatial index tessellation for '
+                                       '%s: %r (GRIDS need the grid tessellation)'
+                                       % (f.name, tessellation))
+
+        settings = []
+        if f.geography:
+            # Geography grids always cover the whole globe.
+            if 'bounding_box' in options:
+                raise ImproperlyConfigured('Geography spatial indexes have no '
+                                           'bounding box (%s).' % f.name)
+        else:
+            extent = tuple(float(v) for v in options.get('bounding_box', f._extent))
+            settings.append(('BOUNDING_BOX', str(extent)))
+        if grids:
+            if isinstance(grids, six.string_types) or len(grids) > 4:
+                raise ImproperlyConfigured('Spatial index grids for %s must be '
+                                           'a sequence of up to four densities.' % f.name)
+            settings.append(('GRIDS', '(%s)' % ', '.join(
+                'LEVEL_%d = %s' % (level, density.upper())
+                for level, density in enumerate(grids, 1))))
+        if options.get('cells_per_object') is not None:
+            settings.append(('CELLS_PER_OBJECT', str(int(options['cells_per_object']))))
+        if options.get('data_compression') is not None:
+            settings.append(('DATA_COMPRESSION', options['data_compression'].upper()))
+        if options.get('fillfactor') is not None:
+            settings.append(('FILLFACTOR', str(int(options['fillfactor']))))
+        if options.get('online'):
+            raise ImproperlyConfigured('Spatial indexes can only be built '
+                                       'offline (%s).' % f.name)
+        elif options.get('online') is not None:
+            settings.append(('ONLINE', 'OFF'))
+        if drop_existing:
+            settings.append(('DROP_EXISTING', 'ON'))
+
+        idx_name = self.spatial_index_name(db_table, f.column)
+        sql = (style.SQL_KEYWORD('CREATE SPATIAL INDEX ') +
+               style.SQL_TABLE(qn(idx_name)) +
+               style.SQL_KEYWORD(' ON ') +
+               style.SQL_TABLE(qn(db_table)) + '(' +
+               style.SQL_FIELD(qn(f.column)) + ') ' +
+               style.SQL_KEYWORD('USING %s' % using))
+        if settings:
+            sql += (style.SQL_KEYWORD(' WITH ') + '(' +
+                    ', '.join(style.SQL_KEYWORD(name) + ' = ' + value
+                              for name, value in settings) + ' )')
+        return sql
+
     def sql_indexes_for_field(self, model, f, style):
         from django.contrib.gis.db.models.fields import GeometryField
         output = super(MSSqlCreation, self).sql_indexes_for_field(model, f, style)
@@ -32,16 +135,6 @@ class MSSqlCreation(DatabaseCreation):
             # Spatial index; see:
             # http://technet.microsoft.com/en-us/library/bb934196.aspx
             if f.spatial_index:
-                idx_name = '%s_%s_id' % (db_table, f.column)
-                extent = str(f._extent)
-                output.append(style.SQL_KEYWORD('CREATE SPATIAL INDEX ') +
-                              style.SQL_TABLE(qn(idx_name)) +
-                              style.SQL_KEYWORD(' ON ') +
-                              style.SQL_TABLE(qn(db_table)) + '(' +
-                              style.SQL_FIELD(qn(f.column)) + ') ' +
-                              style.SQL_KEYWORD('USING GEOMETRY_AUTO_GRID ') +
-                              style.SQL_KEYWORD('WITH ') + '(' +
-                              style.SQL_KEYWORD('BOUNDING_BOX') + ' = ' +
-                              extent + ' )')
+                output.append(self.sql_spatial_index(model, f, style))
 
         return output
@@ -0,0 +1,89 @@
+"""
+Streaming GeoJSON export, for MSSqlGeoQuerySet.iter_geojson().
+
+The geometries are fetched in SQL Server's own serialization and
+written out as GeoJSON directly (see serialization.to_geojson()), a
+chunk of rows at a time, without creating model instances or GEOS
+geometries.  The output is produced as it is fetched, so memory use
+doesn't grow with the size of the layer, and the first bytes are
+ready before the query has even run.
+"""
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+
+from django_pyodbc_gis.serialization import to_geojson
+
+
+class GeoJSONExporter(object):
+    """
+    Writes a queryset out as a GeoJSON FeatureCollection, or as
+    newline-delimited GeoJSON features.
+    """
+
+    def __init__(self, queryset, field_name=None, properties=(), precision=None):
+        self.queryset = queryset
+        self.connection = connections[queryset.db]
+        self.geo_field = queryset.query._geo_field(field_name)
+        if not self.geo_field:
+            raise TypeError('GeoJSON export only available on GeometryFields.')
+        self.geo_col = queryset._geocol_select(self.geo_field, field_name)
+        self.properties = list(properties)
+        self.precision = precision
+        self.encoder = DjangoJSONEncoder(separators=(',', ':'))
+
+    def as_sql(self):
+        """
+        Returns the SQL and parameters of the export query: the
+        primary key, the geometry and then the properties.
+        """
+        qs = self.queryset.extra(select={
+            '_geom': 'CAST(%s AS varbinary(max))' % self.geo_col})
+        qs = qs.values_list(*(['pk', '_geom'] + self.properties))
+        compiler = qs.query.get_compiler(self.queryset.db)
+        # This is executed directly, so any query hints apply.
+        compiler.outermost = True
+        return compiler.as_sql()
+
+    def iter_features(self, chunk_size=1000):
+        """
+        Yields the features of each chunk of rows, as a list of strings.
+        """
+        sql, params = self.as_sql()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [self.feature(row) for row in rows]
+        finally:
+            cursor.close()
+
+    def feature(self, row):
+        if row[1] is None:
+            geometry = 'null'
+        else:
+            geometry = to_geojson(row[1], self.geo_field.geography, self.precision)
+        properties = dict(zip(self.properties, row[2:]))
+        return '{"type":"Feature","id":%s,"geometry":%s,"properties":%s}' % (
+            self.encoder.encode(row[0]), geometry, self.encoder.encode(properties))
+
+    def iter_geojson(self, chunk_size=1000):
+        """
+        Yields a FeatureCollection as bytes.
+        """
+        yield b'{"type":"FeatureCollection","features":['
+        separator = ''
+        for features in self.iter_features(chunk_size):
+            yield (separator + ','.join(features)).encode('utf-8')
+            separator = ','
+        yield b']}'
+
+    def iter_ndjson(self, chunk_size=1000):
+        """
+        Yields one feature per line, as bytes.
+        """
+        for features in self.iter_features(chunk_size):
+            yield ''.join(feature + '\n' for feature in features).encode('utf-8')
@@ -0,0 +1,327 @@
+"""
+Instrumentation of spatial queries.
+
+Every query with a spatial lookup or aggregate is recorded once it has
+been executed and its rows fetched.  The record holds the lookup types
+and aggregates, the shape of the SQL, the bytes of parameters sent,
+the execution time and the rows fetched.  Each record is sent with the
+``spatial_query`` signal and added to the ``stats`` registry, which
+keeps totals by lookup type and aggregate:
+
+    from django_pyodbc_gis.instrumentation import stats
+    stats.snapshot()['lookup:intersects']['time']
+
+With the ``capture_plans`` option (or ``connection.capture_plans =
+True``), the actual execution plan of each of these queries is also
+captured, using SET STATISTICS XML ON.  Any scan of a table whose
+spatial index the query could have used is reported with the
+``spatial_scan`` signal.  The rows then have to be fetched all at
+once, ahead of the plan, so this is meant for diagnosis.
+
+A record is published once its rows have run out (a fetch that returns
+nothing), or when the cursor is closed or executes something else.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from xml.etree import ElementTree
+
+from django.contrib.gis.db.models.sql.aggregates import GeoAggregate
+from django.contrib.gis.db.models.sql.where import GeoConstraint
+from django.utils import six, tree
+from sql_server.pyodbc.base import CursorWrapper
+
+from django_pyodbc_gis import signals
+
+
+SHOWPLAN_COLUMN = 'Microsoft SQL Server 2005 XML Showplan'
+SHOWPLAN_NS = '{http://schemas.microsoft.com/sqlserver/2004/07/showplan}'
+
+
+class QueryRecord(object):
+    """
+    The measurements of one spatial query.
+    """
+
+    def __init__(self, labels, tables, sql, params):
+        # 'lookup:<type>' and 'aggregate:<name>'.
+        self.labels = labels
+        # The spatially indexed tables that the lookups are on.
+        self.tables = tables
+        self.sql = ' '.join(sql.split())
+        self.param_bytes = sum(payload_size(p) for p in params)
+        self.duration = 0.0
+        self.rows = 0
+        self.plan = None
+        self.scans = []
+
+
+class StatsRegistry(object):
+    """
+    Totals of the spatial query records, by label.  The most frequent
+    SQL shapes are kept too, up to `max_shapes` of them per label.
+    """
+
+    def __init__(self, max_shapes=20):
+        self.max_shapes = max_shapes
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            for label in record.labels:
+                stats = self._stats.setdefault(label, {
+                    'count': 0, 'time': 0.0, 'max_time': 0.0, 'rows': 0,
+                    'param_bytes': 0, 'plans': 0, 'scans': 0, 'shapes': {}})
+                stats['count'] += 1
+                stats['time'] += record.duration
+                stats['max_time'] = max(stats['max_time'], record.duration)
+                stats['rows'] += record.rows
+                stats['param_bytes'] += record.param_bytes
+                stats['plans'] += record.plan is not None
+                stats['scans'] += bool(record.scans)
+                shapes = stats['shapes']
+                if record.sql in shapes or len(shapes) < self.max_shapes:
+                    shapes[record.sql] = shapes.get(record.sql, 0) + 1
+
+    def snapshot(self):
+        """
+        Returns a copy of the totals, as {label: {name: value}}.
+        """
+        with self._lock:
+            return dict((label, dict(stats, shapes=dict(stats['shapes'])))
+                        for label, stats in six.iteritems(self._stats))
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+stats = StatsRegistry()
+
+
+def payload_size(param):
+    """
+    The bytes sent for a parameter; text goes as UTF-16.
+    """
+    if param is None:
+        return 0
+    elif isinstance(param, (six.binary_type, bytearray, memoryview)):
+        return len(param)
+    elif isinstance(param, six.text_type):
+        return 2 * len(param)
+    return 8
+
+
+def spatial_labels(query):
+    """
+    Returns the labels of the spatial lookups and aggregates of a
+    query, and the spatially indexed tables of its lookups.
+    """
+    labels, tables = set(), set()
+
+    def walk(node):
+        for child in node.children:
+            if isinstance(child, tree.Node):
+                walk(child)
+            elif isinstance(child, tuple) and isinstance(child[0], GeoConstraint):
+                labels.add('lookup:%s' % child[1])
+                field = child[0].field
+                if field.spatial_index:
+                    tables.add(field.model._meta.db_table)
+
+    walk(query.where)
+    for aggregate in query.aggregate_select.values():
+        if isinstance(aggregate, GeoAggregate):
+            labels.add('aggregate:%s' % aggregate.__class__.__name__)
+    return sorted(labels), tables
+
+
+@contextmanager
+def labelled(connection, query=None, labels=None):
+    """
+    Marks the next statement executed on the connection, within the
+    block, as the query's, or with the given (labels, tables).
+    """
+    labels, tables = labels or spatial_labels(query)
+    previous = getattr(connection, 'spatial_labels', None)
+    connection.spatial_labels = (labels, tables) if labels else None
+    try:
+        yield
+    finally:
+        connection.spatial_labels = previous
+
+
+def find_scans(plan, tables):
+    """
+    Returns those of the tables that are scanned in an XML plan.
+    """
+    try:
+        root = ElementTree.fromstring(plan)
+    except ElementTree.ParseError:
+        return []
+    quoted = dict(('[%s]' % table, table) for table in tables)
+    scans = []
+    for relop in root.iter(SHOWPLAN_NS + 'RelOp'):
+        if 'Scan' not in relop.get('PhysicalOp', ''):
+            continue
+        # The operator's own object, not those of the operators below.
+        for operator in relop:
+            for obj in operator.findall(SHOWPLAN_NS + 'Object'):
+                table = quoted.get(obj.get('Table'))
+                if table and table not in scans:
+                    scans.append(table)
+    return scans
+
+
+class InstrumentedCursor(CursorWrapper):
+    """
+    Records the statements that are labelled as spatial queries.
+    """
+    record = None
+    buffer = None
+
+    def execute(self, sql, params=()):
+        self.finish()
+        self.unbuffer()
+        labels = getattr(self.connection, 'spatial_labels', None)
+        if not labels:
+            return super(InstrumentedCursor, self).execute(sql, params)
+        self.connection.spatial_labels = None
+
+        record = QueryRecord(labels[0], labels[1], sql, params)
+        capture = getattr(self.connection, 'capture_plans', False)
+        if capture:
+            self.cursor.execute('SET STATISTICS XML ON')
+        start = time.time()
+        try:
+            result = super(InstrumentedCursor, self).execute(sql, params)
+            if capture:
+                self.buffer_results(record)
+        finally:
+            record.duration = time.time() - start
+            if capture:
+                self.cursor.execute('SET STATISTICS XML OFF')
+
+        self.record = record
+        self.connection.spatial_cursor = self
+        # Statements without rows are done with already.
+        if self.description is None:
+            if not capture:
+                record.rows = self.cursor.rowcount
+            self.finish()
+        return result
+
+    def buffer_results(self, record):
+        """
+        Fetches the rows, to get at the plan that follows them.
+        """
+        cursor = self.cursor
+        description, rows, plans = None, None, []
+        while True:
+            if cursor.description:
+                if cursor.description[0][0] == SHOWPLAN_COLUMN:
+                    plans.extend(row[0] for row in cursor.fetchall())
+                elif rows is None:
+                    description, rows = cursor.description, cursor.fetchall()
+            elif rows is None:
+                record.rows = cursor.rowcount
+            if not cursor.nextset():
+                break
+
+        if plans:
+            record.plan = plans[0] if len(plans) == 1 else plans
+            for plan in plans:
+                record.scans.extend(t for t in find_scans(plan, record.tables)
+                                    if t not in record.scans)
+        self.buffer = deque(rows or [])
+        # Shadows the cursor's own, which now describes the plan.
+        self.description = description
+
+    def fetched(self, rows, done):
+        if self.record is not None:
+            self.record.rows += rows
+            if done:
+                self.finish()
+
+    # Once the rows are buffered the cursor itself has moved on to the
+    # plan (and SET STATISTICS XML OFF), so they are served from the
+    # buffer alone, until the next statement.
+
+    def fetchone(self):
+        if self.buffer is None:
+            row = super(InstrumentedCursor, self).fetchone()
+        else:
+            row = self.format_row(self.buffer.popleft()) if self.buffer else None
+        self.fetched(row is not None, row is None)
+        return row
+
+    def fetchmany(self, chunk):
+        if self.buffer is None:
+            rows = super(InstrumentedCursor, self).fetchmany(chunk)
+        else:
+            rows = [self.buffer.popleft() for i in range(min(chunk, len(self.buffer)))]
+            rows = self.format_rows(rows)
+        self.fetched(len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        if self.buffer is None:
+            rows = super(InstrumentedCursor, self).fetchall()
+        else:
+            rows = self.format_rows(list(self.buffer))
+            self.buffer.clear()
+        self.fetched(len(rows), True)
+        return rows
+
+    def __iter__(self):
+        # Not through fetchone(), whose nextset() discards the other rows.
+        if self.buffer is None:
+            rows = iter(self.cursor)
+        else:
+            rows = self.drain()
+        for row in rows:
+            self.fetched(1, False)
+            yield row
+        self.fetched(0, True)
+
+    def drain(self):
+        while self.buffer:
+            yield self.format_row(self.buffer.popleft())
+
+    def close(self):
+        self.finish()
+        self.unbuffer()
+        super(InstrumentedCursor, self).close()
+
+    def finish(self):
+        """
+        Publishes the current record, if there is one.
+        """
+        record, self.record = self.record, None
+        if record is None:
+            return
+        if getattr(self.connection, 'spatial_cursor', None) is self:
+            self.connection.spatial_cursor = None
+        stats.add(record)
+        sender = self.connection.__class__
+        signals.spatial_query.send(sender=sender, connection=self.connection,
+                                   record=record)
+        if record.scans:
+            signals.spatial_scan.send(sender=sender, connection=self.connection,
+                                      record=record, tables=record.scans)
+
+    def unbuffer(self):
+        self.buffer = None
+        self.__dict__.pop('description', None)
+
+
+def finish_query(connection):
+    """
+    Publishes the record of the connection's last spatial query, for
+    results that are not read to the end, such as a single row.
+    """
+    cursor = getattr(connection, 'spatial_cursor', None)
+    if cursor is not None:
+        cursor.finish()
@@ -0,0 +1,210 @@
+"""
+Spatial joins, for MSSqlGeoQuerySet.spatial_join().
+
+The two querysets become derived tables of their keys and geometries,
+joined with a single spatial predicate:
+
+    SELECT l.[_join_key], r.[_join_key]
+    FROM (...) AS l INNER JOIN (...) AS r
+    ON r.[_join_geom].STIntersects(l.[_join_geom]) = 1
+
+SQL Server inlines the derived tables, so this is a join of the tables
+themselves.  The spatial index can only be used to probe the side whose
+column the method is called on, so that is the side with a spatial
+index (the right one, if both have), with the predicate turned around
+where it isn't symmetric.  The probed side can be forced onto its
+index with `hint`.
+
+The pairs are streamed a chunk at a time, as keys or as instances.
+Alternatively, the left queryset can be annotated with the key of an
+object it is joined to, as a correlated subquery.
+"""
+from django.db import connections
+
+from django_pyodbc_gis.compiler import declare_geometries
+from django_pyodbc_gis.instrumentation import labelled
+
+
+# The predicates a join can be on, as (method, method with the sides
+# swapped).  Disjoint ones would be nearly a cross product, which no
+# index helps with.
+PREDICATES = {
+    'contains': ('STContains', 'STWithin'),
+    'crosses': ('STCrosses', 'STCrosses'),
+    'equals': ('STEquals', 'STEquals'),
+    'intersects': ('STIntersects', 'STIntersects'),
+    'overlaps': ('STOverlaps', 'STOverlaps'),
+    'touches': ('STTouches', 'STTouches'),
+    'within': ('STWithin', 'STContains'),
+}
+
+
+class JoinSide(object):
+    """
+    One of the querysets of a join, with its geometry field.
+    """
+
+    def __init__(self, queryset, field_name=None):
+        self.queryset = queryset
+        self.geo_field = queryset.query._geo_field(field_name)
+        if not self.geo_field:
+            raise TypeError('Spatial joins are only available on GeometryFields.')
+        self.field_name = field_name or self.geo_field.name
+        self.geo_col = queryset._geocol_select(self.geo_field, field_name)
+
+    def as_sql(self, connection, hint=False):
+        """
+        Returns the SQL and parameters of a derived table of the keys
+        and geometries, as _join_key and _join_geom.
+        """
+        qs = self.queryset.order_by()
+        if hint:
+            qs = qs.spatial_index_hint(self.field_name)
+        opts = qs.model._meta
+        qn = connection.ops.quote_name
+        key_col = '%s.%s' % (qn(opts.db_table), qn(opts.pk.column))
+        qs = qs.extra(select={'_join_key': key_col, '_join_geom': self.geo_col})
+        qs = qs.values_list('_join_key', '_join_geom')
+        sql, params = qs.query.get_compiler(connection=connection).as_sql()
+        return sql, list(params)
+
+
+class SpatialJoin(object):
+    """
+    The pairs of objects of two querysets whose geometries satisfy a
+    spatial predicate, or lie within `distance` of each other.
+    Iterating over it yields (left, right) instances.
+    """
+
+    def __init__(self, left, right, predicate='intersects', distance=None,
+                 field_name=None, other_field_name=None, hint=False):
+        if left.db != right.db:
+            raise ValueError('Spatial joins must be within one database.')
+        if predicate not in PREDICATES:
+            raise ValueError('Unknown spatial join predicate: %r' % predicate)
+        if distance is not None and predicate != 'intersects':
+            raise ValueError('A spatial join within a distance takes no other predicate.')
+        self.left = JoinSide(left, field_name)
+        self.right = JoinSide(right, other_field_name)
+        self.connection = connections[left.db]
+
+        left_field, right_field = self.left.geo_field, self.right.geo_field
+        if left_field.geography != right_field.geography or \
+                left_field.srid != right_field.srid:
+            raise ValueError('The geometries of a spatial join must be of '
+                             'the same type and SRID.')
+        if left_field.geography and predicate not in \
+                self.connection.ops.geography_functions:
+            raise ValueError('%s is not available for geography.' % predicate)
+        self.predicate = predicate
+        self.hint = hint
+        self.distance_params = []
+        if distance is not None:
+            self.distance_params = self.connection.ops.get_distance(
+                right_field, [distance], 'dwithin')
+
+        # The probed side is the one with the spatial index.
+        self.probe_left = left_field.spatial_index and not right_field.spatial_index
+
+    def condition(self, left_geom, right_geom, probe_left=False):
+        """
+        Returns the SQL of the join condition between two geometries,
+        calling the method on the probed one.
+        """
+        method, swapped = PREDICATES[self.predicate]
+        if probe_left:
+            probed, other = left_geom, right_geom
+        else:
+            probed, other, method = right_geom, left_geom, swapped
+        if self.distance_params:
+            return '%s.STDistance(%s) <= %%s' % (probed, other)
+        return '%s.%s(%s) = 1' % (probed, method, other)
+
+    def as_sql(self):
+        """
+        Returns the SQL and parameters of the join, selecting the keys
+        of each pair.
+        """
+        left_sql, left_params = self.left.as_sql(
+            self.connection, self.hint and self.probe_left)
+        right_sql, right_params = self.right.as_sql(
+            self.connection, self.hint and not self.probe_left)
+        sql = ('SELECT l.[_join_key], r.[_join_key] FROM (%s) AS l '
+               'INNER JOIN (%s) AS r ON %s' % (
+                   left_sql, right_sql,
+                   self.condition('l.[_join_geom]', 'r.[_join_geom]', self.probe_left)))
+        params = left_params + right_params + self.distance_params
+        query_hints = self.left.queryset.query.query_hints
+        if query_hints:
+            sql = '%s OPTION (%s)' % (sql, ', '.join(query_hints))
+        return declare_geometries(sql, params)
+
+    def keys(self, chunk_size=1000):
+        """
+        Yields the (left, right) primary keys of the pairs.
+        """
+        sql, params = self.as_sql()
+        labels = (['join:%s' % self.predicate], self.tables())
+        cursor = self.connection.cursor()
+        try:
+            with labelled(self.connection, labels=labels):
+                cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield tuple(row)
+        finally:
+            cursor.close()
+
+    def pairs(self, chunk_size=1000):
+        """
+        Yields the (left, right) instances of the pairs, fetching those
+        of each chunk of keys in one query per side.
+        """
+        keys = self.keys(chunk_size)
+        if not self.connection.features.can_use_chunked_reads:
+            # Without MARS, no other query can run while the keys are
+            # being read.
+            keys = list(keys)
+        chunk = []
+        for pair in keys:
+            chunk.append(pair)
+            if len(chunk) == chunk_size:
+                for result in self.resolve(chunk):
+                    yield result
+                chunk = []
+        for result in self.resolve(chunk):
+            yield result
+
+    def resolve(self, chunk):
+        if not chunk:
+            return []
+        lefts = self.left.queryset.in_bulk(set(pair[0] for pair in chunk))
+        rights = self.right.queryset.in_bulk(set(pair[1] for pair in chunk))
+        return [(lefts[l], rights[r]) for l, r in chunk
+                if l in lefts and r in rights]
+
+    def __iter__(self):
+        return self.pairs()
+
+    def annotate(self, model_att='join_key'):
+        """
+        Returns the left queryset with the primary key of the joined
+        right object (the smallest, if there are several) attached as
+        `model_att`, or None where there isn't one.
+        """
+        # Each left row probes the right side, whatever the indexes.
+        right_sql, right_params = self.right.as_sql(self.connection, self.hint)
+        sql = ('(SELECT TOP 1 r.[_join_key] FROM (%s) AS r WHERE %s '
+               'ORDER BY r.[_join_key])' % (
+                   right_sql, self.condition(self.left.geo_col, 'r.[_join_geom]')))
+        return self.left.queryset.extra(
+            select={model_att: sql},
+            select_params=right_params + self.distance_params)
+
+    def tables(self):
+        return set(side.geo_field.model._meta.db_table
+                   for side in (self.left, self.right)
+                   if side.geo_field.spatial_index)
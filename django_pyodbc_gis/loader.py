@@ -0,0 +1,208 @@
+"""
+Bulk loading for MSSqlGeoManager.bulk_load().
+
+bulk_create() sends every geometry as WKT, with a constructor call per
+row, and SQL Server's limit on parameters per statement keeps the
+batches small.  Here the rows are streamed, with their geometries as
+WKB, into a temporary staging table using executemany()
+(fast_executemany, where pyodbc supports it).  A single set-based
+statement then converts the geometries and inserts the rows into the
+target table, or MERGEs them into it.
+
+STGeomFromWKB() only reads 2D WKB, and GEOS writes the WKB of
+geometries with a Z coordinate in 3D, so those are staged as WKT, in a
+second column for each geometry field.
+
+The spatial indexes of the target can be disabled for the load and
+rebuilt afterwards, which is much quicker for very large loads than
+maintaining them row by row.
+"""
+from itertools import islice
+
+from django.contrib.gis.db.models.fields import GeometryField
+from django.db import connections, transaction
+from django.db.models import AutoField
+
+from django_pyodbc_gis import cache
+
+
+class BulkLoader(object):
+    """
+    Loads model instances into their table through a staging table.
+    The primary key is left to the database (auto fields are never
+    loaded), and the instances are not updated.
+    """
+
+    def __init__(self, model, using, merge_on=None, rebuild_index=False):
+        self.model = model
+        self.using = using
+        self.connection = connections[using]
+        opts = model._meta
+        self.fields = [f for f in opts.local_concrete_fields
+                       if not isinstance(f, AutoField)]
+        self.geo_fields = [f for f in self.fields if isinstance(f, GeometryField)]
+        self.merge_on = [opts.get_field(name) for name in merge_on or ()]
+        self.rebuild_index = rebuild_index
+        # The extent of the loaded geometries, for the spatial cache.
+        self.extent = None
+
+        qn = self.connection.ops.quote_name
+        self.table = qn(opts.db_table)
+        self.stage = qn('#stage_%s' % opts.db_table)
+
+    def load(self, objs, batch_size=10000):
+        """
+        Loads an iterable of instances, `batch_size` rows at a time, and
+        returns the number of rows inserted (or merged).
+        """
+        indexes = self.spatial_indexes() if self.rebuild_index else []
+        cursor = self.connection.cursor()
+        try:
+            for index in indexes:
+                cursor.execute('ALTER INDEX %s ON %s DISABLE' % (index, self.table))
+            with transaction.atomic(using=self.using):
+                cursor.execute(self.create_stage_sql())
+                try:
+                    self.fill_stage(cursor, objs, batch_size)
+                    cursor.execute(self.merge_sql() if self.merge_on else self.insert_sql())
+                    rowcount = cursor.rowcount
+                finally:
+                    cursor.execute('DROP TABLE %s' % self.stage)
+            # A merge replaces geometries whose extents we don't know.
+            if self.merge_on:
+                cache.invalidate(self.model, self.using)
+            else:
+                cache.invalidate(self.model, self.using,
+                                 [self.extent] if self.extent else [])
+            return rowcount
+        finally:
+            for index in indexes:
+                cursor.execute('ALTER INDEX %s ON %s REBUILD' % (index, self.table))
+            cursor.close()
+
+    def spatial_indexes(self):
+        qn = self.connection.ops.quote_name
+        db_table = self.model._meta.db_table
+        creation = self.connection.creation
+        return [qn(creation.spatial_index_name(db_table, f.column))
+                for f in self.geo_fields if f.spatial_index]
+
+    def wkt_column(self, f):
+        """
+        The staging column for the geometries of `f` that have a Z
+        coordinate.
+        """
+        return self.connection.ops.quote_name('%s__wkt' % f.column)
+
+    def stage_columns(self):
+        qn = self.connection.ops.quote_name
+        columns = []
+        for f in self.fields:
+            columns.append(qn(f.column))
+            if isinstance(f, GeometryField):
+                columns.append(self.wkt_column(f))
+        return columns
+
+    def create_stage_sql(self):
+        """
+        The staging table has the columns of the target table, except
+        that each geometry is either WKB or, in the extra column, WKT.
+        """
+        qn = self.connection.ops.quote_name
+        columns = []
+        for f in self.fields:
+            if isinstance(f, GeometryField):
+                columns.append('CAST(NULL AS varbinary(max)) AS %s' % qn(f.column))
+                columns.append('CAST(NULL AS nvarchar(max)) AS %s' % self.wkt_column(f))
+            else:
+                columns.append(qn(f.column))
+        return 'SELECT TOP 0 %s INTO %s FROM %s' % (
+            ', '.join(columns), self.stage, self.table)
+
+    def fill_stage(self, cursor, objs, batch_size):
+        columns = self.stage_columns()
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            self.stage, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+
+        # The pyodbc cursor is wrapped by both Django and the backend.
+        raw = cursor
+        while hasattr(raw, 'cursor'):
+            raw = raw.cursor
+        if hasattr(raw, 'fast_executemany'):
+            raw.fast_executemany = True
+
+        rows = (self.row(obj) for obj in objs)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            cursor.executemany(sql, batch)
+
+    def row(self, obj):
+        values = []
+        for f in self.fields:
+            value = f.pre_save(obj, True)
+            if isinstance(f, GeometryField):
+                geom = f.get_prep_value(value)
+                if geom is None:
+                    values.extend([None, None])
+                    continue
+                self.add_extent(geom)
+                if geom.hasz:
+                    values.extend([None, geom.wkt])
+                else:
+                    values.extend([bytearray(geom.wkb), None])
+            else:
+                values.append(f.get_db_prep_save(value, connection=self.connection))
+        return values
+
+    def add_extent(self, geom):
+        if geom.empty:
+            return
+        extent = geom.extent
+        if self.extent is not None:
+            extent = (min(extent[0], self.extent[0]), min(extent[1], self.extent[1]),
+                      max(extent[2], self.extent[2]), max(extent[3], self.extent[3]))
+        self.extent = extent
+
+    def select_columns(self):
+        """
+        The staging table's columns, with the geometries converted.
+        """
+        qn = self.connection.ops.quote_name
+        columns = []
+        for f in self.fields:
+            column = 'stage.%s' % qn(f.column)
+            if isinstance(f, GeometryField):
+                ns = 'geography' if f.geography else 'geometry'
+                wkt = 'stage.%s' % self.wkt_column(f)
+                column = ('CASE WHEN %s IS NOT NULL THEN %s::STGeomFromWKB(%s, %d) '
+                          'WHEN %s IS NOT NULL THEN %s::STGeomFromText(%s, %d) END AS %s' % (
+                              column, ns, column, f.srid,
+                              wkt, ns, wkt, f.srid, qn(f.column)))
+            columns.append(column)
+        return ', '.join(columns)
+
+    def insert_sql(self):
+        qn = self.connection.ops.quote_name
+        return 'INSERT INTO %s (%s) SELECT %s FROM %s AS stage' % (
+            self.table, ', '.join(qn(f.column) for f in self.fields),
+            self.select_columns(), self.stage)
+
+    def merge_sql(self):
+        """
+        Updates the rows that match on the `merge_on` fields, and
+        inserts the rest.
+        """
+        qn = self.connection.ops.quote_name
+        on = ' AND '.join('target.%s = source.%s' % (qn(f.column), qn(f.column))
+                          for f in self.merge_on)
+        update = ', '.join('%s = source.%s' % (qn(f.column), qn(f.column))
+                           for f in self.fields if f not in self.merge_on)
+        columns = ', '.join(qn(f.column) for f in self.fields)
+        values = ', '.join('source.%s' % qn(f.column) for f in self.fields)
+        sql = 'MERGE INTO %s AS target USING (SELECT %s FROM %s AS stage) AS source ON %s' % (
+            self.table, self.select_columns(), self.stage, on)
+        if update:
+            sql += ' WHEN MATCHED THEN UPDATE SET %s' % update
+        return sql + ' WHEN NOT MATCHED THEN INSERT (%s) VALUES (%s);' % (columns, values)
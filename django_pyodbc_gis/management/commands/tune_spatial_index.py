@@ -0,0 +1,196 @@
+import math
+from optparse import make_option
+
+from django.contrib.gis.db.models.fields import GeometryField
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import get_model
+
+
+# Cells per axis at each grid level: 4x4, 8x8 and 16x16, i.e. 2, 3 and 4
+# bits of subdivision per level.
+GRID_DENSITIES = {2: 'LOW', 3: 'MEDIUM', 4: 'HIGH'}
+
+
+def grid_levels(divisions):
+    """
+    Returns the four grid densities whose combined subdivision (per
+    axis) comes closest to `divisions`, filling the levels from the top
+    down.  None means as fine as possible.
+    """
+    if not divisions:
+        bits = 16
+    else:
+        bits = min(max(int(round(math.log(divisions, 2))), 8), 16)
+    levels = [2] * 4
+    for i in range(bits - 8):
+        levels[i % 4] += 1
+    return tuple(GRID_DENSITIES[n] for n in levels)
+
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName> <field_name>'
+    help = ('Measures the extent and object sizes of a geometry column, and '
+            'recommends a spatial index tuned to them.  With --apply the '
+            'index is (re)built with those settings.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database to tune the index in. '
+                    'Defaults to the "default" database.'),
+        make_option('--apply', action='store_true', dest='apply', default=False,
+                    help='Rebuild the spatial index with the recommended settings.'),
+        make_option('--cells-per-object', type='int', dest='cells_per_object',
+                    help='CELLS_PER_OBJECT for the index.'),
+        make_option('--data-compression', dest='data_compression',
+                    help='DATA_COMPRESSION for the index: NONE, ROW or PAGE.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: tune_spatial_index %s' % self.args)
+        model, field = self.get_field(*args)
+        connection = connections[options['database']]
+
+        stats = self.measure(connection, model, field)
+        if not stats['count'] or stats['extent'] is None:
+            raise CommandError('There are no geometries in %s.%s to measure.'
+                               % (model._meta.db_table, field.column))
+        self.report(stats, field)
+
+        index_options = connection.creation.spatial_index_options(field)
+        index_options.update(self.recommend(stats, field))
+        for name in ('cells_per_object', 'data_compression'):
+            if options[name] is not None:
+                index_options[name] = options[name]
+
+        exists = self.index_exists(connection, model, field)
+        sql = connection.creation.sql_spatial_index(
+            model, field, no_style(), index_options, drop_existing=exists)
+        self.stdout.write('%s;' % sql)
+
+        if options['apply']:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql)
+            finally:
+                cursor.close()
+            self.stdout.write('Spatial index %s.' % ('rebuilt' if exists else 'created'))
+
+    def get_field(self, label, field_name):
+        try:
+            app_label, model_name = label.split('.')
+        except ValueError:
+            raise CommandError('Models are given as app_label.ModelName, not %r.' % label)
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError('Unknown model: %s' % label)
+        field = model._meta.get_field(field_name)
+        if not isinstance(field, GeometryField):
+            raise CommandError('%s.%s is not a geometry field.' % (label, field_name))
+        return model, field
+
+    def measure(self, connection, model, field):
+        """
+        Returns the number of (non-NULL) objects, their average number
+        of points and size, and the extent of the whole column.  For
+        geography, sizes are the angles of the bounding circles.
+        """
+        qn = connection.ops.quote_name
+        names = {
+            'table': qn(model._meta.db_table),
+            'col': '%s.%s' % (qn(model._meta.db_table), qn(field.column)),
+        }
+        cursor = connection.cursor()
+        try:
+            if field.geography:
+                cursor.execute(
+                    'SELECT COUNT(*), AVG(CAST(%(col)s.STNumPoints() AS float)), '
+                    'AVG(%(col)s.EnvelopeAngle()) '
+                    'FROM %(table)s WHERE %(col)s IS NOT NULL' % names)
+                count, npoints, angle = cursor.fetchone()
+                cursor.execute(
+                    'SELECT geography::EnvelopeAggregate(%(col)s).EnvelopeAngle() '
+                    'FROM %(table)s' % names)
+                extent, = cursor.fetchone()
+                return {'count': count, 'npoints': npoints,
+                        'size': (angle or 0.0, angle or 0.0), 'extent': extent}
+
+            cursor.execute(
+                'SELECT COUNT(*), AVG(CAST(%(col)s.STNumPoints() AS float)), '
+                'AVG(env.e.STPointN(3).STX - env.e.STPointN(1).STX), '
+                'AVG(env.e.STPointN(3).STY - env.e.STPointN(1).STY) '
+                'FROM %(table)s CROSS APPLY (SELECT %(col)s.STEnvelope() AS e) AS env '
+                'WHERE %(col)s IS NOT NULL' % names)
+            count, npoints, width, height = cursor.fetchone()
+            cursor.execute(
+                'SELECT agg.e.STPointN(1).STX, agg.e.STPointN(1).STY, '
+                'agg.e.STPointN(3).STX, agg.e.STPointN(3).STY '
+                'FROM (SELECT geometry::EnvelopeAggregate(%(col)s) AS e '
+                'FROM %(table)s) AS agg' % names)
+            x0, y0, x1, y1 = cursor.fetchone()
+        finally:
+            cursor.close()
+
+        extent = None
+        if x0 is not None:
+            extent = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+        return {'count': count, 'npoints': npoints,
+                'size': (width or 0.0, height or 0.0), 'extent': extent}
+
+    def recommend(self, stats, field):
+        """
+        Returns index settings for the measured column: the bounding box
+        is fitted to the data (geometry only), and the grids are chosen
+        so that the finest cells are about the size of a typical object,
+        or of the spacing between them for points.
+        """
+        if field.geography:
+            # Each hemisphere is tessellated, 180 degrees across; the
+            # angles are radii.
+            span = 180.0
+            spread = min(2 * (stats['extent'] or 90.0), span)
+            size = 2 * max(stats['size'])
+            area = spread ** 2
+            options = {}
+        else:
+            xmin, ymin, xmax, ymax = stats['extent']
+            # Leave a margin for new objects at the edges; SQL Server
+            # also refuses an empty box.
+            margin = 0.01 * max(xmax - xmin, ymax - ymin) or 1.0
+            xmin, ymin = xmin - margin, ymin - margin
+            xmax, ymax = xmax + margin, ymax + margin
+            span = max(xmax - xmin, ymax - ymin)
+            size = max(stats['size'])
+            area = (xmax - xmin) * (ymax - ymin)
+            options = {'bounding_box': (xmin, ymin, xmax, ymax)}
+
+        if not size:
+            size = math.sqrt(area / stats['count'])
+        options['tessellation'] = 'grid'
+        options['grids'] = grid_levels(span / size if size else None)
+        return options
+
+    def report(self, stats, field):
+        self.stdout.write('-- %d objects, %.1f points on average' %
+                          (stats['count'], stats['npoints'] or 0))
+        if field.geography:
+            self.stdout.write('-- bounding circles: %.6g degrees on average, '
+                              '%.6g for the column' %
+                              (stats['size'][0], stats['extent'] or 0))
+        else:
+            self.stdout.write('-- extent: (%.6g, %.6g, %.6g, %.6g)' % stats['extent'])
+            self.stdout.write('-- objects: %.6g x %.6g on average' % stats['size'])
+
+    def index_exists(self, connection, model, field):
+        db_table = model._meta.db_table
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT COUNT(*) FROM sys.indexes '
+                           'WHERE object_id = OBJECT_ID(%s) AND name = %s',
+                           [db_table, connection.creation.spatial_index_name(db_table, field.column)])
+            return bool(cursor.fetchone()[0])
+        finally:
+            cursor.close()
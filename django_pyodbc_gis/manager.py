@@ -1,3 +1,5 @@
+import math
+
 from django.db import connections
 from django.db.models.query import QuerySet, ValuesQuerySet, ValuesListQuerySet
 
@@ -14,6 +16,16 @@ from django.utils import six
 from django.contrib.gis.db.models import GeoManager
 from django.contrib.gis.db.models.query import GeoQuerySet
 
+from django_pyodbc_gis import aio, cache, parallel
+from django_pyodbc_gis.columnar import CoordinateFetcher, to_geoarrow
+from django_pyodbc_gis.export import GeoJSONExporter
+from django_pyodbc_gis.join import SpatialJoin
+from django_pyodbc_gis.loader import BulkLoader
+from django_pyodbc_gis.query import MSSqlGeoQuery
+
+# The length of the equator in Web Mercator, in metres.
+EARTH_CIRCUMFERENCE = 2 * math.pi * 6378137
+
 # This code patches the GeoQuerySet as provided by Django 1.6.1
 #
 # MSSQL requires syntax unsupported by the current core libraries
@@ -28,6 +40,212 @@ from django.contrib.gis.db.models.query import GeoQuerySet
 
 class MSSqlGeoQuerySet(GeoQuerySet):
 
+    def __init__(self, model=None, query=None, using=None):
+        super(MSSqlGeoQuerySet, self).__init__(
+            model=model, query=query or MSSqlGeoQuery(model), using=using)
+
+    def update(self, **kwargs):
+        rows = super(MSSqlGeoQuerySet, self).update(**kwargs)
+        # The rows' geometries may have changed, from and to anywhere.
+        cache.invalidate(self.model, self.db)
+        return rows
+    update.alters_data = True
+
+    def to_coords_array(self, field_name=None, fields=(), chunk_size=10000):
+        """
+        Returns the geometries as NumPy arrays in the GeoArrow layout
+        (interleaved coordinates plus offset arrays), without creating
+        model instances or geometries.  Any `fields` given are returned
+        as arrays of their own.  Requires numpy.
+        """
+        fetcher = CoordinateFetcher(self, field_name, fields)
+        return fetcher.fetch(chunk_size)
+
+    def to_geoarrow(self, field_name=None, fields=(), chunk_size=10000):
+        """
+        As to_coords_array(), but returns a pyarrow Table with a
+        GeoArrow geometry column.  Requires numpy and pyarrow.
+        """
+        fetcher = CoordinateFetcher(self, field_name, fields)
+        return to_geoarrow(fetcher.fetch(chunk_size), fetcher.geom_type,
+                           fetcher.geo_field.srid)
+
+    def iter_geojson(self, field_name=None, properties=(), chunk_size=1000,
+                     precision=None, ndjson=False):
+        """
+        Streams the queryset as a GeoJSON FeatureCollection (or as
+        newline-delimited features, with `ndjson`), yielding bytes for
+        each chunk of rows; suitable for a StreamingHttpResponse.  The
+        `properties` are field names, and coordinates may be rounded
+        to `precision` decimal places.
+        """
+        exporter = GeoJSONExporter(self, field_name, properties, precision)
+        if ndjson:
+            return exporter.iter_ndjson(chunk_size)
+        return exporter.iter_geojson(chunk_size)
+
+    # Async variants of the terminal methods, which run on the worker
+    # threads of aio.executor and return awaitables; see aio.py.
+
+    def aget(self, *args, **kwargs):
+        return aio.executor.submit(self.db, self.get, *args, **kwargs)
+
+    def acount(self):
+        return aio.executor.submit(self.db, self.count)
+
+    def aaggregate(self, *args, **kwargs):
+        return aio.executor.submit(self.db, self.aggregate, *args, **kwargs)
+
+    def anearest(self, geom, k, max_distance=None, **kwargs):
+        return aio.executor.submit(self.db, aio.evaluate, self.nearest,
+                                   geom, k, max_distance, **kwargs)
+
+    def aiter(self, chunk_size=100):
+        """
+        Returns an async iterator over the objects, which are fetched
+        `chunk_size` at a time.
+        """
+        return aio.executor.stream(self.db, aio.chunked, chunk_size, self.iterator)
+
+    def aiter_geojson(self, field_name=None, properties=(), chunk_size=1000,
+                      precision=None, ndjson=False):
+        """
+        As iter_geojson(), but returns an async iterator.
+        """
+        return aio.executor.stream(self.db, aio.chunked, 1, self.iter_geojson, field_name,
+                                   properties, chunk_size, precision, ndjson)
+
+    def nearest(self, geom, k, max_distance=None, **kwargs):
+        """
+        Returns the `k` objects nearest to the given geometry, closest
+        first, optionally only those within `max_distance`.  The
+        distance is attached as with distance().
+
+        The query takes the form SQL Server needs in order to use its
+        nearest neighbour plan on the spatial index:
+
+          SELECT TOP k ..., col.STDistance(@g) AS distance ...
+          WHERE col.STDistance(@g) IS NOT NULL ORDER BY distance
+
+        As with any slice, the result can't be filtered further.
+        """
+        field_name = kwargs.get('field_name', None)
+        model_att = kwargs.get('model_att', None) or 'distance'
+        qs = self.distance(geom, **kwargs)
+
+        connection = connections[self.db]
+        geo_field = qs.query._geo_field(field_name)
+        if max_distance is not None:
+            # This is a dwithin lookup, which also qualifies the query
+            # for the nearest neighbour plan.
+            lookup = '%s__dwithin' % (field_name or geo_field.name)
+            qs = qs.filter(**{lookup: (geom, max_distance)})
+        else:
+            geom = geo_field.get_prep_value(geom)
+            geo_col = qs._geocol_select(geo_field, field_name)
+            placeholder = geo_field.get_placeholder(geom, connection)
+            qs = qs.extra(where=['%s.STDistance(%s) IS NOT NULL' % (geo_col, placeholder)],
+                          params=geo_field.get_db_prep_lookup('contains', geom, connection=connection))
+        return qs.order_by(model_att)[:k]
+
+    def reduce(self, tolerance=None, field_name=None, zoom=None, tile_size=256, **kwargs):
+        """
+        Attaches the geometry as simplified by SQL Server's Reduce()
+        (Douglas-Peucker) in a `reduce` attribute.  The `tolerance` is
+        in the units of the field's SRID; alternatively it can be taken
+        from a web map `zoom` level, as the size of one pixel (of a
+        `tile_size` tile) at that zoom.  Defer the field itself to avoid
+        fetching the full geometry as well.
+        """
+        if tolerance is None:
+            if zoom is None:
+                raise TypeError('reduce() needs a tolerance or a zoom level.')
+            geo_field = self.query._geo_field(field_name)
+            if not geo_field:
+                raise TypeError('Reduce output only available on GeometryFields.')
+            tolerance = self._zoom_tolerance(geo_field, zoom, tile_size)
+
+        s = {'select_field': GeomField(),
+             'method_call': True,
+             'procedure_fmt': '%(tolerance)r',
+             'procedure_args': {'tolerance': float(tolerance)},
+             }
+        return self._spatial_attribute('reduce', s, field_name=field_name, **kwargs)
+
+    def _zoom_tolerance(self, geo_field, zoom, tile_size=256):
+        """
+        Returns the size of a pixel at the given (Web Mercator) zoom
+        level, at the equator, in the units of the field's SRID.
+        """
+        connection = connections[self.db]
+        pixels = tile_size * 2 ** zoom
+        if geo_field.geography:
+            return EARTH_CIRCUMFERENCE / pixels / connection.ops.geography_unit_factor(geo_field)
+        elif geo_field.geodetic(connection):
+            return 360.0 / pixels
+        # Metres per unit; GeoDjango has it as a string without GDAL.
+        units = float(geo_field.units(connection) or 1.0)
+        return EARTH_CIRCUMFERENCE / pixels / units
+
+    def partitioned_aggregate(self, *args, **kwargs):
+        """
+        As aggregate(), for the Union, Collect and Extent aggregates,
+        but split into partitions that are aggregated concurrently and
+        then merged; see parallel.py.  The keyword arguments
+        `partitions` (8), `workers` (4), `split` ('keys' or 'tiles') and
+        `field_name` (for tiles) control the partitioning.  The result
+        also has the per-partition `timings`.
+        """
+        options = dict((name, kwargs.pop(name)) for name in
+                       ('partitions', 'workers', 'split', 'field_name')
+                       if name in kwargs)
+        for arg in args:
+            kwargs[arg.default_alias] = arg
+        return parallel.aggregate(self, kwargs, **options)
+
+    def spatial_index_hint(self, field_name, index_name=None):
+        """
+        Forces SQL Server to use the spatial index on the given geometry
+        field, with a WITH (INDEX(...)) table hint; the optimizer tends
+        to ignore it once joins or other predicates are involved.  The
+        index name defaults to the one syncdb gives it.
+        """
+        geo_field = self.query._geo_field(field_name)
+        if not geo_field:
+            raise TypeError('Spatial index hints only available on GeometryFields.')
+        db_table = geo_field.model._meta.db_table
+        if index_name is None:
+            creation = connections[self.db].creation
+            index_name = creation.spatial_index_name(db_table, geo_field.column)
+
+        clone = self._clone()
+        clone.query.index_hints[db_table] = index_name
+        return clone
+
+    def spatial_join(self, other, predicate='intersects', distance=None,
+                     field_name=None, other_field_name=None, hint=False):
+        """
+        Joins the objects to those of another GeoQuerySet whose
+        geometries satisfy the `predicate` ('intersects', 'within',
+        'contains', ...), or lie within `distance` of theirs, in a
+        single query; see join.py.  Iterating over the result yields
+        (object, other object) pairs; its keys() yields their primary
+        keys, and annotate(model_att) attaches the key of the joined
+        object to these ones instead.  With `hint` the probed side is
+        held to its spatial index.
+        """
+        return SpatialJoin(self, other, predicate, distance, field_name,
+                           other_field_name, hint)
+
+    def query_options(self, *hints):
+        """
+        Adds query hints, such as 'MAXDOP 4' or 'RECOMPILE', to the
+        OPTION clause of the statement.
+        """
+        clone = self._clone()
+        clone.query.query_hints.extend(hints)
+        return clone
+
     def _distance_attribute(self, func, geom=None, tolerance=0.05, spheroid=False, **kwargs):
         """
         DRY routine for GeoQuerySet distance attribute routines.
@@ -280,6 +498,13 @@ class MSSqlGeoQuerySet(GeoQuerySet):
             sel_fld = settings['select_field']
             if isinstance(sel_fld, GeomField) and backend.select:
                 self.query.custom_select[model_att] = backend.select
+            #############################################################################
+            # NOTE: Added for MSSql
+            # Natively serialized values can only be decoded knowing
+            # whether they are geometry or geography.
+            if isinstance(sel_fld, GeomField):
+                sel_fld.geography = geo_field.geography
+            #############################################################################
             if connection.ops.oracle:
                 sel_fld.empty_strings_allowed = False
             self.query.extra_select_fields[model_att] = sel_fld
@@ -295,3 +520,39 @@ class MSSqlGeoManager(GeoManager):
 
     def get_queryset(self):
         return MSSqlGeoQuerySet(self.model, using=self._db)
+
+    def partitioned_aggregate(self, *args, **kwargs):
+        return self.get_queryset().partitioned_aggregate(*args, **kwargs)
+
+    def spatial_join(self, *args, **kwargs):
+        return self.get_queryset().spatial_join(*args, **kwargs)
+
+    def aget(self, *args, **kwargs):
+        return self.get_queryset().aget(*args, **kwargs)
+
+    def acount(self):
+        return self.get_queryset().acount()
+
+    def aaggregate(self, *args, **kwargs):
+        return self.get_queryset().aaggregate(*args, **kwargs)
+
+    def anearest(self, *args, **kwargs):
+        return self.get_queryset().anearest(*args, **kwargs)
+
+    def aiter(self, *args, **kwargs):
+        return self.get_queryset().aiter(*args, **kwargs)
+
+    def aiter_geojson(self, *args, **kwargs):
+        return self.get_queryset().aiter_geojson(*args, **kwargs)
+
+    def bulk_load(self, objs, batch_size=10000, merge_on=None, rebuild_index=False):
+        """
+        Inserts an iterable of instances through a staging table, which
+        is much faster than bulk_create() for large loads; see
+        loader.py.  With `merge_on` (field names) rows matching on those
+        fields are updated instead.  With `rebuild_index` the spatial
+        indexes are disabled during the load and rebuilt after it.
+        Returns the number of rows affected.
+        """
+        loader = BulkLoader(self.model, self.db, merge_on, rebuild_index)
+        return loader.load(objs, batch_size)
@@ -1,13 +1,19 @@
+import struct
+from collections import OrderedDict
 from decimal import Decimal
 
+from django.contrib.gis import memoryview
 from django.contrib.gis.db.backends.base import BaseSpatialOperations
 from django.contrib.gis.db.backends.util import SpatialFunction
 from django.contrib.gis.geometry.backend import Geometry
 from django.contrib.gis.measure import Distance
+from django.core.exceptions import ImproperlyConfigured
 from django.utils import six
 from sql_server.pyodbc.operations import DatabaseOperations
 
 from .models import SpatialRefSys
+from .serialization import SerializedGeometry, decode
+from .spatial_refs import srid_cache
 
 
 class MSSqlBoolMethod(SpatialFunction):
@@ -21,7 +27,9 @@ class MSSqlBoolMethod(SpatialFunction):
 
 
 class MSSqlDistanceFunc(SpatialFunction):
-    """Implements distance comparison lookups, eg distance_lte"""
+    """Implements distance comparison lookups, eg distance_lte.  The
+    col.STDistance(geom) <= d form is also the one that SQL Server can
+    use the spatial index for, which makes it our dwithin."""
 
     sql_template = ('%(geo_col)s.%(function)s(%(geometry)s) '
                     '%(operator)s %(result)s')
@@ -36,16 +44,47 @@ class MSSqlBBBoolMethod(MSSqlBoolMethod):
     """SQL Server has no native bounding-box methods, but we can emulate
     them with a slightly more complicated expression.  The call will
     be translated into something like
-    col.STEnvelope().STOverlaps(geom.STEnvelope())
-    where STEnvelope() first simplifies the geometries to their
-    bounding rectangles."""
-
-    sql_template = '%(geo_col)s.STEnvelope().%(function)s(%(geometry)s.STEnvelope()) = 1'
+    col.Filter(geom.STEnvelope()) = 1 AND
+    col.STEnvelope().STOverlaps(geom.STEnvelope()) = 1
+    The second half, which compares the bounding rectangles, does wrap
+    the column in STEnvelope(), so on its own it could only be answered
+    by a scan.  The first half calls Filter() on the bare column, which
+    SQL Server answers with a seek on the spatial index; as the two are
+    ANDed, the rectangles are only compared for the rows the seek
+    finds.  Filter() only finds objects that reach into the envelope of
+    the geometry, which is what the spatial index records."""
+
+    sql_template = ('(%(geo_col)s.Filter(%(geometry)s.STEnvelope()) = 1 AND '
+                    '%(geo_col)s.STEnvelope().%(function)s'
+                    '(%(geometry)s.STEnvelope()) = 1)')
 
     def __init__(self, function, **kwargs):
         super(MSSqlBoolMethod, self).__init__(function, **kwargs)
 
 
+class MSSqlEnvelopeBoolMethod(MSSqlBoolMethod):
+    """Compares the column with the bounding rectangle of the geometry,
+    eg col.STWithin(geom.STEnvelope()) = 1.  Being within a rectangle
+    is the same as having a bounding box within it, so this gives us
+    `contained` without touching the column."""
+
+    sql_template = '%(geo_col)s.%(function)s(%(geometry)s.STEnvelope()) = 1'
+
+
+class MSSqlFilter(MSSqlBoolMethod):
+    """The spatial index primary filter on its own, eg
+    col.Filter(geom.STEnvelope()) = 1.  This is true for anything in
+    the index cells touched by the geometry's bounding rectangle, so it
+    may include some false positives, but it is as cheap as a spatial
+    lookup gets (and exact where there is no index).  Geography has no
+    envelopes, so there we filter with the geometry itself."""
+
+    def __init__(self, envelope=True):
+        super(MSSqlFilter, self).__init__('Filter')
+        if envelope:
+            self.sql_template = '%(geo_col)s.Filter(%(geometry)s.STEnvelope()) = 1'
+
+
 class MSSqlAdapter(str):
     """This adapter works around an apparent bug in the pyodbc driver
     itself.  We only require the wkt adapter, but if we use
@@ -64,6 +103,13 @@ class MSSqlAdapter(str):
         return super(MSSqlAdapter, self).__eq__(other) and \
             self.srid == other.srid
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # Equal adapters are bound once; see compiler.declare_geometries().
+        return hash((str.__hash__(self), self.srid))
+
     def prepare_database_save(self, unused):
         return self
 
@@ -71,11 +117,70 @@ class MSSqlAdapter(str):
 # Valid distance types and substitutions
 dtypes = (Decimal, Distance, float) + six.integer_types
 
+# Types that pyodbc hands back for varbinary columns.  On python 2 a
+# plain str is text (WKT), so only bytearray/buffer count as binary.
+if six.PY3:
+    binary_types = (bytes, bytearray, memoryview)
+else:
+    binary_types = (bytearray, memoryview)
+
+
+class MSSqlWKBAdapter(bytes if six.PY3 else bytearray):
+    """The binary counterpart of MSSqlAdapter, for use with
+    STGeomFromWKB (the ``geometry_params`` option).  For the same
+    pyodbc reason the adapter *is* the parameter type, so that it gets
+    bound as varbinary.
+
+    GEOS writes the WKB of geometries with a Z value in three
+    dimensions, which STGeomFromWKB rejects (it only reads 2D WKB), so
+    those fall back to the WKT adapter (get_geom_placeholder() does
+    likewise)."""
+
+    def __new__(cls, geom):
+        if geom.hasz:
+            return MSSqlAdapter(geom)
+        if six.PY3:
+            geobin = bytes.__new__(cls, geom.wkb)
+        else:
+            geobin = bytearray.__new__(cls)
+            geobin.extend(bytes(geom.wkb))
+        geobin.srid = geom.srid
+        return geobin
+
+    def __init__(self, geom):
+        # Everything is done in __new__ (bytearray would otherwise try
+        # to initialise itself from the geometry).
+        pass
+
+    def __eq__(self, other):
+        if not isinstance(other, MSSqlWKBAdapter):
+            return False
+        return bytes(self) == bytes(other) and self.srid == other.srid
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((bytes(self), self.srid))
+
+    def prepare_database_save(self, unused):
+        return self
+
 
 class MSSqlOperations(DatabaseOperations, BaseSpatialOperations):
 
     name = 'SQL Server'
     select = '%s.STAsText()'
+    select_zm = None
+
+    # Binary readback (the ``geometry_readback`` option).  STAsBinary()
+    # doesn't carry the SRID, so we prepend STSrid as a big-endian int
+    # to keep it to a single column.  The select formats only let us
+    # substitute the column once, hence the derived table.
+    select_wkb = ('(SELECT CAST(wkb.g.STSrid AS binary(4)) + '
+                  'wkb.g.STAsBinary() FROM (SELECT %s AS g) AS wkb)')
+    select_wkb_zm = ('(SELECT CAST(wkb.g.STSrid AS binary(4)) + '
+                     'wkb.g.AsBinaryZM() FROM (SELECT %s AS g) AS wkb)')
 
     Adapter = MSSqlAdapter
     Adaptor = Adapter  # Backwards-compatibility alias.
@@ -127,8 +232,9 @@ class MSSqlOperations(DatabaseOperations, BaseSpatialOperations):
 
     geometry_functions = {
         'bbcontains': MSSqlBBBoolMethod('STContains'),
+        'bbintersects': MSSqlFilter(),
         'bboverlaps': MSSqlBBBoolMethod('STOverlaps'),
-        'contained': MSSqlBBBoolMethod('STWithin'),
+        'contained': MSSqlEnvelopeBoolMethod('STWithin'),
         'contains': MSSqlBoolMethod('STContains'),
         'crosses': MSSqlBoolMethod('STCrosses'),
         'disjoint': MSSqlBoolMethod('STDisjoint'),
@@ -144,10 +250,12 @@ class MSSqlOperations(DatabaseOperations, BaseSpatialOperations):
         'distance_gte': (MSSqlDistanceFunc('>='), dtypes),
         'distance_lt': (MSSqlDistanceFunc('<'), dtypes),
         'distance_lte': (MSSqlDistanceFunc('<='), dtypes),
+        'dwithin': (MSSqlDistanceFunc('<='), dtypes),
     }
     geometry_functions.update(distance_functions)
 
     geography_functions = {
+        'bbintersects': MSSqlFilter(envelope=False),
         'contains': MSSqlBoolMethod('STContains'),
         'disjoint': MSSqlBoolMethod('STDisjoint'),
         'equals': MSSqlBoolMethod('STEquals'),
@@ -163,55 +271,135 @@ class MSSqlOperations(DatabaseOperations, BaseSpatialOperations):
     extent = 'EnvelopeAggregate'
     unionagg = 'UnionAggregate'
     distance = 'STDistance'
+    reduce = 'Reduce'
+
+    # The most pieces of lookup SQL to keep; see _memoized().
+    sql_memo_size = 1024
 
     valid_aggregates = dict([(k, None) for k in
                              ('Collect', 'Extent', 'Union')])
 
+    def __init__(self, connection):
+        super(MSSqlOperations, self).__init__(connection)
+        self._sql_memo = OrderedDict()
+        options = connection.settings_dict.get('OPTIONS', {})
+
+        geometry_params = options.get('geometry_params', 'wkt')
+        if geometry_params == 'wkb':
+            self.Adapter = self.Adaptor = MSSqlWKBAdapter
+        elif geometry_params != 'wkt':
+            raise ImproperlyConfigured("Unknown geometry_params mode: %s" %
+                                       geometry_params)
+        self.geometry_params = geometry_params
+
+        readback = options.get('geometry_readback', 'wkt')
+        if readback == 'wkb':
+            self.select = self.select_wkb
+            self.select_zm = self.select_wkb_zm
+        elif readback == 'native':
+            # Columns come back as SQL Server serialized them; see
+            # DatabaseWrapper.get_new_connection().
+            self.select = '%s'
+        elif readback != 'wkt':
+            raise ImproperlyConfigured("Unknown geometry_readback mode: %s" %
+                                       readback)
+        self.geometry_readback = readback
+
     def spatial_lookup_sql(self, lvalue, lookup_type, value, field, qn):
         alias, col, db_type = lvalue
 
         geo_col = '%s.%s' % (qn(alias), qn(col))
 
         if field.geography:
-            if lookup_type not in self.geography_functions:
+            op = self.geography_functions.get(lookup_type)
+            if op is None:
                 raise TypeError("Got invalid lookup_type for geography: %s" %
                                 lookup_type)
         else:
-            if lookup_type not in self.geometry_functions:
+            op = self.geometry_functions.get(lookup_type)
+            if op is None:
                 raise TypeError("Got invalid lookup_type for geometry: %s" %
                                 lookup_type)
 
         if lookup_type == 'isnull':
             return "%s IS %sNULL" % (geo_col, ('' if value else 'NOT ')), []
 
-        else:
-            if field.geography:
-                op = self.geography_functions[lookup_type]
-            else:
-                op = self.geometry_functions[lookup_type]
+        # if lookup_type is a tuple then we expect the value to be
+        # a tuple as well:
+        if isinstance(op, tuple):
+            dist_op, arg_type = op
 
-            # if lookup_type is a tuple then we expect the value to be
-            # a tuple as well:
-            if isinstance(op, tuple):
-                dist_op, arg_type = op
+            # Ensuring that a tuple _value_ was passed in from the user
+            if not isinstance(value, tuple):
+                raise ValueError('Tuple required for `%s` lookup type.' %
+                                 lookup_type)
+            if len(value) != 2:
+                raise ValueError('2-element tuple required for %s lookup type.' %
+                                 lookup_type)
 
-                # Ensuring that a tuple _value_ was passed in from the user
-                if not isinstance(value, tuple):
-                    raise ValueError('Tuple required for `%s` lookup type.' %
-                                     lookup_type)
-                if len(value) != 2:
-                    raise ValueError('2-element tuple required for %s lookup type.' %
-                                     lookup_type)
+            # Ensuring the argument type matches what we expect.
+            if not isinstance(value[1], arg_type):
+                raise ValueError('Argument type should be %s, got %s instead.' %
+                                 (arg_type, type(value[1])))
 
-                # Ensuring the argument type matches what we expect.
-                if not isinstance(value[1], arg_type):
-                    raise ValueError('Argument type should be %s, got %s instead.' %
-                                     (arg_type, type(value[1])))
+            return self._spatial_sql(dist_op, geo_col, field, value[0])
 
-                geom = value[0]
-                return dist_op.as_sql(geo_col, self.get_geom_placeholder(field, geom))
+        return self._spatial_sql(op, geo_col, field, value)
 
-            return op.as_sql(geo_col, self.get_geom_placeholder(field, value))
+    def _spatial_sql(self, op, geo_col, field, geom):
+        """
+        Returns the SQL and any extra parameters for a spatial lookup.
+        The lookup only supplies the geometry parameter once, so
+        templates that refer to it more often (the bounding-box ones)
+        need copies of it.
+
+        The SQL only depends on the lookup, the field, the kind of
+        placeholder and the column, so it is built once for each of
+        those (see _memoized()).
+        """
+        if hasattr(geom, 'expression'):
+            return op.as_sql(geo_col, self.get_geom_placeholder(field, geom))
+
+        key = ('lookup', op, field.geography, field.srid,
+               self._geom_constructor(geom), geo_col)
+        try:
+            sql, refs = self._sql_memo[key]
+        except KeyError:
+            sql, params = op.as_sql(geo_col, self.get_geom_placeholder(field, geom))
+            refs = op.sql_template.count('%(geometry)s')
+            sql, refs = self._memoized(key, (sql, refs))
+        return sql, [self.Adapter(geom)] * (refs - 1)
+
+    # The set lookups (see where.py), and the method each member is
+    # tested with.
+    set_functions = {
+        'intersects_any': 'STIntersects',
+        'within_any': 'STWithin',
+    }
+
+    def spatial_set_sql(self, lvalue, lookup_type, value, field, qn):
+        """
+        Returns the SQL and parameters for a set lookup, a semi-join
+        with the members of the GeometrySet `value`.  The members are
+        what the spatial index is probed with.
+        """
+        alias, col, db_type = lvalue
+        geo_col = '%s.%s' % (qn(alias), qn(col))
+        members, params = value.as_sql(self.connection)
+        sql = 'EXISTS (SELECT 1 FROM %s WHERE %s.%s(members.geom) = 1)' % (
+            members, geo_col, self.set_functions[lookup_type])
+        return sql, params
+
+    def _memoized(self, key, value):
+        """
+        Keeps a piece of generated SQL for reuse, the oldest making way
+        once there are `sql_memo_size` of them.  Operations belong to a
+        connection, which belongs to a thread, so there is no locking.
+        """
+        if len(self._sql_memo) >= self.sql_memo_size:
+            self._sql_memo.popitem(last=False)
+        self._sql_memo[key] = value
+        return value
 
     def check_aggregate_support(self, aggregate):
         """
@@ -237,47 +425,83 @@ class MSSqlOperations(DatabaseOperations, BaseSpatialOperations):
         # for a geography or geometry (which requires digging into the
         # Aggregate), but the function name is the same for both:
         ns = 'geography' if agg.source.geography else 'geometry'
-        sql_template = ns + '::%(function)s(%(field)s).ToString()'
+        if agg.is_extent:
+            # The envelope is returned as WKB (see convert_extent()).
+            # Geography envelopes are circles, so their points are taken
+            # as geometry (Long/Lat) for a rectangular one.
+            if agg.source.geography:
+                field = 'geometry::STGeomFromWKB(%(field)s.STAsBinary(), %(field)s.STSrid)'
+            else:
+                field = '%(field)s'
+            sql_template = 'geometry::%(function)s(' + field + ').STAsBinary()'
+        else:
+            # Geometry aggregates are always returned as binary, since
+            # the WKT of a union can run to megabytes.
+            sql_template = ns + '::%(function)s(%(field)s)'
+            if self.geometry_readback == 'native':
+                select = self.select
+            elif getattr(agg.source, 'dim', 2) == 3:
+                select = self.select_wkb_zm
+            else:
+                select = self.select_wkb
+            sql_template = select % sql_template
         sql_function = getattr(self, agg_name)
         return sql_template, sql_function
 
-    def convert_extent(self, poly):
+    def convert_extent(self, wkb):
         """
-        Returns a 4-tuple extent for the `Extent` aggregate by converting
-        the bounding box text returned by SQL Server (`poly` argument), for
-        example: "POLYGON ((0 0, 2 0, 2 3, 0 3, 0 0))".
+        Returns a 4-tuple extent for the `Extent` aggregate, from the
+        WKB of the envelope computed by SQL Server (a polygon, or a
+        point if there was only the one).
         """
-        crnrs = poly[10:-2].split(',')
-        xmin, ymin = map(float, crnrs[0].strip().split(' '))
-        xmax, ymax = map(float, crnrs[2].strip().split(' '))
-        return xmin, ymin, xmax, ymax
+        if not wkb:
+            return None
+        envelope = Geometry(memoryview(bytes(wkb)))
+        if envelope.empty:
+            return None
+        return envelope.extent
 
-    def convert_geom(self, hex, geo_field):
+    def convert_geom(self, value, geo_field):
         """
-        Converts the geometry returned from aggregate queries.
+        Converts the geometry returned from aggregate queries, and
+        binary geometries in general.  Text is assumed to be WKT, and
+        binary to be the SRID-prefixed WKB from the binary select
+        unless it came through the native output converter.
         """
-        if hex:
-            return Geometry(hex)
-        else:
+        if not value:
             return None
+        elif isinstance(value, Geometry):
+            return value
+        elif isinstance(value, SerializedGeometry):
+            return decode(value, getattr(geo_field, 'geography', False))
+        elif isinstance(value, binary_types):
+            srid, = struct.unpack('>i', bytes(value[:4]))
+            return Geometry(memoryview(bytes(value[4:])), srid)
+        else:
+            return Geometry(value)
 
     # GeometryField operations
     def geo_db_type(self, f):
-        # We only have the one geometry type (especially since we
-        # don't currently support geography):
+        # The geometry type is a property of the instance, so there is
+        # only the one type of column for each:
+        if f.geography:
+            return 'geography'
         return 'geometry'
 
     def get_distance(self, f, value, lookup_type):
         """
         Returns the distance parameters for the given geometry field,
         lookup value, and lookup type.  This is based on the Spatialite
-        backend, since we don't currently support geography operations.
+        backend; geography distances are in the unit of measure of the
+        field's SRID (almost always metres).
         """
         if not value:
             return []
         value = value[0]
         if isinstance(value, Distance):
-            if f.geodetic(self.connection):
+            if f.geography:
+                dist_param = value.m / self.geography_unit_factor(f)
+            elif f.geodetic(self.connection):
                 raise ValueError('The SQL Server backend does not support '
                                  'distance queries on geometry fields with '
                                  'a geodetic coordinate system. Distance '
@@ -289,19 +513,46 @@ class MSSqlOperations(DatabaseOperations, BaseSpatialOperations):
             dist_param = value
         return [dist_param]
 
+    def geography_unit_factor(self, f):
+        """
+        Returns the number of metres in the unit of measure of the
+        given geography field.
+        """
+        ref = srid_cache.get(self.connection, f.srid)
+        if ref is None:
+            raise SpatialRefSys.DoesNotExist('Unknown SRID: %s' % f.srid)
+        return ref.unit_conversion_factor
+
     def get_geom_placeholder(self, f, value):
         """
         Because SQL Server does not support spatial transformations,
         there is no need to modify the placeholder based on the
         contents of the given value.  We do need to specify the SRID
         however, since this argument is required.
+
+        The value is either the geometry itself (lookups) or its
+        adapter (inserts and updates); with binary parameters, either
+        of those may still need to go as text (see MSSqlWKBAdapter).
         """
         if hasattr(value, 'expression'):
-            placeholder = self.get_expression_column(value)
-        else:
+            return self.get_expression_column(value)
+
+        key = ('placeholder', f.geography, self._geom_constructor(value), f.srid)
+        try:
+            return self._sql_memo[key]
+        except KeyError:
             ns = 'geography' if f.geography else 'geometry'
-            placeholder = '%s::STGeomFromText(%%s,%s)' % (ns, f.srid)
-        return placeholder
+            return self._memoized(key, '%s::%s(%%s,%s)' % (ns, key[2], f.srid))
+
+    def _geom_constructor(self, value):
+        """
+        The constructor that the parameter for a geometry goes through.
+        """
+        if self.geometry_params == 'wkb' and \
+                not getattr(value, 'hasz', False) and \
+                not isinstance(value, MSSqlAdapter):
+            return 'STGeomFromWKB'
+        return 'STGeomFromText'
 
     # Routines for getting the OGC-compliant models --- SQL Server
     # does not have OGC-compliant tables
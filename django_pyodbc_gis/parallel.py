@@ -0,0 +1,197 @@
+"""
+Partitioned aggregates, for MSSqlGeoQuerySet.partitioned_aggregate().
+
+UnionAggregate and CollectionAggregate run as a single serial
+statement, which over a large table can take longer than any sensible
+timeout.  Here the queryset is split into partitions, either ranges of
+the primary key or tiles of the geometry field's extent.  The partial
+aggregates are run concurrently, each worker thread having its own
+database connection, and the results merged in Python: the union of
+the partial unions, the members of all the partial collections, and
+the minimum and maximum of the partial extents.
+
+Every partition's aggregate query is timed, and the timings are
+returned with the result.
+
+Each worker uses a connection of its own, so the partitions can't see
+uncommitted changes made by the calling thread.
+"""
+import math
+import threading
+import time
+
+from django.contrib.gis.db.models.aggregates import Collect, Extent, Union
+from django.contrib.gis.geos import GeometryCollection
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils.six.moves import queue
+
+
+# Partitioning schemes.
+KEYS = 'keys'
+TILES = 'tiles'
+
+
+class AggregateResult(dict):
+    """
+    The merged aggregates, as returned by aggregate(), together with
+    the per-partition ``timings``: a list of (partition, seconds).
+    """
+
+    def __init__(self, values, timings):
+        super(AggregateResult, self).__init__(values)
+        self.timings = timings
+
+
+def key_partitions(queryset, partitions):
+    """
+    Returns (label, queryset) pairs splitting the queryset into
+    (roughly) equal ranges of its integer primary key.
+    """
+    bounds = queryset.aggregate(lo=Min('pk'), hi=Max('pk'))
+    lo, hi = bounds['lo'], bounds['hi']
+    if lo is None:
+        return [('pk: all', queryset)]
+
+    step = max(int(math.ceil((hi - lo + 1) / float(partitions))), 1)
+    result = []
+    for start in range(lo, hi + 1, step):
+        qs = queryset.filter(pk__gte=start, pk__lt=start + step)
+        result.append(('pk: %d-%d' % (start, min(start + step, hi + 1) - 1), qs))
+    return result
+
+
+def tile_partitions(queryset, partitions, field_name=None):
+    """
+    Returns (label, queryset) pairs splitting the queryset into tiles
+    of the geometry field's extent.  Each object belongs to the tile
+    holding the lower left corner of its envelope (the centre of its
+    bounding circle, for geography).  Objects without one (NULL or
+    empty geometries) go to the first tile.
+    """
+    geo_field = queryset.query._geo_field(field_name)
+    if not geo_field:
+        raise TypeError('Tile partitions are only available on GeometryFields.')
+    field_name = field_name or geo_field.name
+    extent = queryset.aggregate(extent=Extent(field_name))['extent']
+    if extent is None:
+        return [('tiles: all', queryset)]
+
+    geo_col = queryset._geocol_select(geo_field, field_name)
+    if geo_field.geography:
+        x, y = '%s.EnvelopeCenter().Long' % geo_col, '%s.EnvelopeCenter().Lat' % geo_col
+    else:
+        x = '%s.STEnvelope().STPointN(1).STX' % geo_col
+        y = '%s.STEnvelope().STPointN(1).STY' % geo_col
+
+    nx = int(math.ceil(math.sqrt(partitions)))
+    ny = int(math.ceil(partitions / float(nx)))
+    xmin, ymin, xmax, ymax = extent
+    xs = _edges(xmin, xmax, nx)
+    ys = _edges(ymin, ymax, ny)
+
+    result = []
+    for i in range(nx):
+        for j in range(ny):
+            where, params = [], []
+            for expr, lo, hi in ((x, xs[i], xs[i + 1]), (y, ys[j], ys[j + 1])):
+                if lo is not None:
+                    where.append('%s >= %%s' % expr)
+                    params.append(lo)
+                if hi is not None:
+                    where.append('%s < %%s' % expr)
+                    params.append(hi)
+            where = ' AND '.join(where) or '1 = 1'
+            if i == j == 0:
+                where = '(%s) OR %s IS NULL' % (where, x)
+            label = 'tile: %d,%d' % (i, j)
+            result.append((label, queryset.extra(where=[where], params=params)))
+    return result
+
+
+def _edges(lo, hi, n):
+    """Tile edges from lo to hi, leaving the outer ones open."""
+    width = (hi - lo) / float(n)
+    return [None] + [lo + k * width for k in range(1, n)] + [None]
+
+
+def merge(aggregate, values):
+    """
+    Merges the partial results of a Union, Collect or Extent aggregate.
+    """
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+
+    if isinstance(aggregate, Extent):
+        return (min(v[0] for v in values), min(v[1] for v in values),
+                max(v[2] for v in values), max(v[3] for v in values))
+    elif isinstance(aggregate, Union):
+        result = values[0]
+        for value in values[1:]:
+            result = result.union(value)
+        return result
+    elif isinstance(aggregate, Collect):
+        members = []
+        for value in values:
+            if isinstance(value, GeometryCollection):
+                members.extend(value)
+            else:
+                members.append(value)
+        return GeometryCollection(members, srid=values[0].srid)
+    raise TypeError('%s aggregates can not be partitioned.' % aggregate.name)
+
+
+def aggregate(queryset, aggregates, partitions=8, workers=4, split=KEYS,
+              field_name=None):
+    """
+    Runs the aggregates (a dictionary of alias: aggregate) over the
+    partitions of the queryset, `workers` at a time, and returns the
+    merged AggregateResult.
+    """
+    for agg in aggregates.values():
+        if not isinstance(agg, (Union, Collect, Extent)):
+            raise TypeError('%s aggregates can not be partitioned.' % agg.name)
+
+    if split == KEYS:
+        parts = key_partitions(queryset, partitions)
+    elif split == TILES:
+        parts = tile_partitions(queryset, partitions, field_name)
+    else:
+        raise ValueError('Unknown partitioning: %r' % split)
+
+    tasks = queue.Queue()
+    for index, part in enumerate(parts):
+        tasks.put((index,) + part)
+    partials = [None] * len(parts)
+    timings = [None] * len(parts)
+    errors = []
+
+    def work():
+        try:
+            while not errors:
+                try:
+                    index, label, qs = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.time()
+                partials[index] = qs.aggregate(**aggregates)
+                timings[index] = (label, time.time() - start)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # The connection belongs to this thread, which is finished.
+            connections[queryset.db].close()
+
+    threads = [threading.Thread(target=work)
+               for i in range(max(min(workers, len(parts)), 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    result = dict((alias, merge(agg, [partial[alias] for partial in partials]))
+                  for alias, agg in aggregates.items())
+    return AggregateResult(result, timings)
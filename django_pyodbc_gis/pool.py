@@ -0,0 +1,213 @@
+"""
+A pool of pyodbc connections, for the ``pool`` option:
+
+    'OPTIONS': {
+        'pool': {'min_size': 2, 'max_size': 20, 'max_idle': 300,
+                 'timeout': 30, 'check_idle': 30},
+    }
+
+Closing a connection (at the end of a request, or when CONN_MAX_AGE
+runs out) returns it to the pool, rolled back, for the next connection
+to the same database in the process.  Each pool holds at most
+`max_size` connections, in use or idle; asking for another waits up to
+`timeout` seconds for one to be returned.  Idle connections are closed
+once they have been idle for `max_idle` seconds, except for the last
+`min_size` of them.  One that has been idle for more than `check_idle`
+seconds is checked with SELECT 1 before it is handed out, as is one
+returned after a database error.
+
+Connections keep their session, and with it what their first user set
+up: the session settings, the geometry output converters and anything
+done by the ``warm_up`` hook (see DatabaseWrapper.warm_up()).  SET
+options and temporary tables carry over likewise.
+
+A forked process starts with pools of its own, leaving its parent's
+connections alone.
+"""
+import os
+import threading
+import time
+
+from sql_server.pyodbc.base import Database
+
+
+class PooledConnection(object):
+    """
+    A pyodbc connection of a pool, with its bookkeeping.
+    """
+
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+        self.created = self.returned = time.time()
+        # Whether a DatabaseWrapper has set it up yet; see
+        # DatabaseWrapper.init_connection_state().
+        self.initialized = False
+
+    def is_usable(self):
+        cursor = None
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT 1').fetchall()
+        except Database.Error:
+            return False
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Database.Error:
+                    pass
+        return True
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Database.Error:
+            pass
+
+
+class ConnectionPool(object):
+    """
+    The connections to one database.  Thread-safe.
+    """
+
+    def __init__(self, min_size=0, max_size=10, max_idle=300, timeout=30,
+                 check_idle=30):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('A pool needs 0 <= min_size <= max_size and max_size >= 1.')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.check_idle = check_idle
+        # What DatabaseWrapper.init_connection_state() found out about
+        # the driver and server, for the connections that don't run it.
+        self.traits = None
+        self.pid = os.getpid()
+        self._idle = []
+        self._size = 0
+        self._available = threading.Condition()
+
+    def acquire(self, connect):
+        """
+        Returns an idle PooledConnection, or a new one from connect() if
+        there is room for it.
+        """
+        deadline = time.time() + self.timeout
+        with self._available:
+            while True:
+                self._evict()
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # Reserved, and connected outside the lock.
+                    self._size += 1
+                    pooled = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Database.OperationalError(
+                        'No connection was free in the pool within %s seconds.' % self.timeout)
+                self._available.wait(remaining)
+
+        if pooled is None:
+            try:
+                return PooledConnection(self, connect())
+            except Exception:
+                self._discarded()
+                raise
+        if time.time() - pooled.returned > self.check_idle and not pooled.is_usable():
+            pooled.close()
+            self._discarded()
+            return self.acquire(connect)
+        return pooled
+
+    def release(self, pooled, check=False):
+        """
+        Returns a connection to the pool, or closes it if it is broken
+        (only checked for if `check` is true).
+        """
+        if self.pid != os.getpid():
+            # The parent's, after a fork; closing it would end the
+            # parent's session too.
+            return
+        try:
+            if not pooled.connection.autocommit:
+                pooled.connection.rollback()
+        except Database.Error:
+            check = True
+        if check and not pooled.is_usable():
+            self.discard(pooled)
+            return
+        pooled.returned = time.time()
+        with self._available:
+            self._idle.append(pooled)
+            self._available.notify()
+
+    def discard(self, pooled):
+        """
+        Closes a connection instead of returning it.
+        """
+        pooled.close()
+        self._discarded()
+
+    def _discarded(self):
+        with self._available:
+            self._size -= 1
+            self._available.notify()
+
+    def _evict(self):
+        # The idle list is oldest first, as connections are taken from
+        # the end of it; those past max_idle are closed.
+        now = time.time()
+        while len(self._idle) > self.min_size and \
+                now - self._idle[0].returned > self.max_idle:
+            self._idle.pop(0).close()
+            self._size -= 1
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for pooled in idle:
+            pooled.close()
+
+    def __len__(self):
+        return self._size
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database, options):
+    """
+    Returns this process's pool for a database (any hashable that
+    identifies it), creating it with the given settings (those of the
+    ``pool`` option) if need be.
+    """
+    key = (database, os.getpid())
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                for other in [k for k in _pools if k[0] == database]:
+                    # The parent's, after a fork.
+                    del _pools[other]
+                pool = _pools[key] = ConnectionPool(**options)
+    return pool
+
+
+def close_pools():
+    """
+    Closes the idle connections of every pool of this process.
+    """
+    with _pools_lock:
+        pools = [pool for key, pool in _pools.items() if key[1] == os.getpid()]
+    for pool in pools:
+        pool.close()
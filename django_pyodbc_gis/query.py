@@ -0,0 +1,30 @@
+from django.contrib.gis.db.models.sql.query import ALL_TERMS, GeoQuery
+
+from django_pyodbc_gis.where import MSSqlGeoWhereNode, SET_LOOKUPS
+
+
+# Spatial lookups that only this backend provides; the query has to know
+# about them, or they would be taken for related field names.
+MSSQL_TERMS = set([
+    'bbintersects',
+]) | SET_LOOKUPS
+
+
+class MSSqlGeoQuery(GeoQuery):
+    """
+    A single spatial SQL query for SQL Server.
+    """
+    query_terms = ALL_TERMS | MSSQL_TERMS
+
+    def __init__(self, model, where=MSSqlGeoWhereNode):
+        super(MSSqlGeoQuery, self).__init__(model, where)
+        # Table hints, keyed by table name: {db_table: index_name}.
+        self.index_hints = {}
+        # Query hints, for the OPTION clause.
+        self.query_hints = []
+
+    def clone(self, *args, **kwargs):
+        obj = super(MSSqlGeoQuery, self).clone(*args, **kwargs)
+        obj.index_hints = self.index_hints.copy()
+        obj.query_hints = self.query_hints[:]
+        return obj
@@ -0,0 +1,299 @@
+"""
+Decoder for SQL Server's own serialization of geometry and geography
+instances, as documented in [MS-SSCLRT]:
+
+http://msdn.microsoft.com/en-us/library/ee320529.aspx
+
+This is what the server sends when a spatial column is selected as-is
+(the ``'native'`` geometry_readback mode), so there is no per-row
+conversion for it to do.  We translate instances into EWKB for GEOS.
+
+Points are stored as X/Y pairs for geometry, but Lat/Long for
+geography, and any Z and M values follow in arrays of their own.  GEOS
+has no use for measures so they are dropped, as are arcs (SQL Server
+2012 curves), which it can't represent either.
+
+If numpy is available it is used to re-order the coordinate arrays;
+otherwise this is done with struct.
+"""
+import struct
+
+from django.contrib.gis import memoryview
+from django.contrib.gis.geometry.backend import Geometry
+from django.utils import six
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# The ODBC type code that SQL Server reports for CLR types.
+SQL_SS_UDT = -151
+
+# Serialization property flags.
+HAS_Z = 0x01
+HAS_M = 0x02
+SINGLE_POINT = 0x08
+SINGLE_LINE = 0x10
+
+# Open GIS types, which luckily match the WKB type codes.  Anything
+# above MULTIPOLYGON (bar the collection) is a curve or the full globe.
+POINT, LINESTRING, POLYGON = 1, 2, 3
+MULTIPOINT, MULTILINESTRING, MULTIPOLYGON = 4, 5, 6
+GEOMETRYCOLLECTION = 7
+
+# EWKB flags
+WKB_Z = 0x80000000
+WKB_SRID = 0x20000000
+
+
+class SerializedGeometry(bytes if six.PY3 else bytearray):
+    """A spatial value exactly as SQL Server serialized it.  Decoding
+    is left to convert_geom(), since only the field knows whether the
+    value is a geometry or a geography."""
+
+    @classmethod
+    def from_db(cls, value):
+        """The pyodbc output converter for SQL_SS_UDT columns."""
+        if value is None:
+            return None
+        return cls(value)
+
+
+def decode(data, geography=False):
+    """
+    Returns the GEOS geometry for the given serialized instance.
+    """
+    srid, ewkb = to_ewkb(data, geography)
+    return Geometry(memoryview(ewkb), srid)
+
+
+def to_ewkb(data, geography=False):
+    """
+    Returns the SRID and the EWKB for the given serialized instance.
+    """
+    srid, writer = _read(data, geography, _Writer)
+    return srid, writer.write(srid)
+
+
+def to_geojson(data, geography=False, precision=None):
+    """
+    Returns the GeoJSON geometry object, as a string, for the given
+    serialized instance; coordinates may be rounded to `precision`
+    decimal places.
+    """
+    srid, writer = _read(data, geography, _GeoJSONWriter)
+    return writer.write(precision)
+
+
+def _read(data, geography, writer_class):
+    """
+    Reads the serialized instance, returning its SRID and a writer of
+    the given class for it.
+    """
+    data = bytes(data)
+    srid, version, flags = struct.unpack_from('<iBB', data)
+    pos = 6
+
+    if flags & SINGLE_POINT:
+        npoints = 1
+    elif flags & SINGLE_LINE:
+        npoints = 2
+    else:
+        npoints, = struct.unpack_from('<I', data, pos)
+        pos += 4
+
+    has_z = bool(flags & HAS_Z)
+    coords = _coordinates(data, pos, npoints, has_z, geography)
+    pos += 16 * npoints
+    if has_z:
+        pos += 8 * npoints
+    if flags & HAS_M:
+        pos += 8 * npoints
+
+    if flags & SINGLE_POINT:
+        figures = [0]
+        shapes = [(-1, 0, POINT)]
+    elif flags & SINGLE_LINE:
+        figures = [0]
+        shapes = [(-1, 0, LINESTRING)]
+    else:
+        nfigures, = struct.unpack_from('<I', data, pos)
+        pos += 4
+        # Each figure is an attribute byte followed by its point offset;
+        # the attribute only matters for curves.
+        figures = [struct.unpack_from('<i', data, pos + 5 * i + 1)[0]
+                   for i in range(nfigures)]
+        pos += 5 * nfigures
+        nshapes, = struct.unpack_from('<I', data, pos)
+        pos += 4
+        shapes = [struct.unpack_from('<iiB', data, pos + 9 * i)
+                  for i in range(nshapes)]
+
+    return srid, writer_class(coords, has_z, npoints, figures, shapes)
+
+
+def _coordinates(data, pos, npoints, has_z, geography):
+    """
+    Returns the coordinates as little-endian doubles, interleaved in
+    WKB order (X Y [Z]).
+    """
+    if not (has_z or geography):
+        # Already in the right order, as it happens.
+        return data[pos:pos + 16 * npoints]
+
+    if numpy is not None:
+        xy = numpy.frombuffer(data, '<f8', 2 * npoints, pos)
+        xy = xy.reshape(npoints, 2)
+        if geography:
+            xy = xy[:, ::-1]
+        if has_z:
+            z = numpy.frombuffer(data, '<f8', npoints, pos + 16 * npoints)
+            xy = numpy.column_stack((xy, z))
+        return numpy.ascontiguousarray(xy, '<f8').tobytes()
+
+    xy = struct.unpack_from('<%dd' % (2 * npoints), data, pos)
+    if geography:
+        axes = [xy[1::2], xy[0::2]]
+    else:
+        axes = [xy[0::2], xy[1::2]]
+    if has_z:
+        axes.append(struct.unpack_from('<%dd' % npoints, data,
+                                       pos + 16 * npoints))
+    ordered = [v for coord in zip(*axes) for v in coord]
+    return struct.pack('<%dd' % len(ordered), *ordered)
+
+
+class _Writer(object):
+    """
+    Walks the figure and shape tables, writing out the EWKB.
+    """
+
+    def __init__(self, coords, has_z, npoints, figures, shapes):
+        self.coords = coords
+        self.stride = 24 if has_z else 16
+        self.zflag = WKB_Z if has_z else 0
+        self.npoints = npoints
+        self.figures = figures
+        self.shapes = shapes
+        self.children = [[] for shape in shapes]
+        for i, (parent, figure, shape_type) in enumerate(shapes):
+            if parent >= 0:
+                self.children[parent].append(i)
+
+    def write(self, srid):
+        return self._shape(0, srid)
+
+    def _header(self, shape_type, srid=None):
+        if srid is None:
+            return struct.pack('<BI', 1, shape_type | self.zflag)
+        return struct.pack('<BIi', 1, shape_type | self.zflag | WKB_SRID, srid)
+
+    def _points(self, figure):
+        """Returns the count and coordinates of the figure's points."""
+        start = self.figures[figure]
+        if figure + 1 < len(self.figures):
+            end = self.figures[figure + 1]
+        else:
+            end = self.npoints
+        return end - start, self.coords[start * self.stride:end * self.stride]
+
+    def _figures(self, index):
+        """Returns the range of figures belonging to a (leaf) shape."""
+        start = self.shapes[index][1]
+        if start < 0:
+            return range(0)
+        for parent, figure, shape_type in self.shapes[index + 1:]:
+            if figure >= 0:
+                return range(start, figure)
+        return range(start, len(self.figures))
+
+    def _shape(self, index, srid=None):
+        shape_type = self.shapes[index][2]
+        header = self._header(shape_type, srid)
+
+        if shape_type == POINT:
+            figures = self._figures(index)
+            if not figures:
+                # WKB has no empty point; GEOS reads NaN as empty.
+                nan = float('nan')
+                return header + struct.pack('<%dd' % (self.stride // 8),
+                                            *([nan] * (self.stride // 8)))
+            return header + self._points(figures[0])[1]
+
+        elif shape_type == LINESTRING:
+            figures = self._figures(index)
+            if not figures:
+                return header + struct.pack('<I', 0)
+            count, coords = self._points(figures[0])
+            return header + struct.pack('<I', count) + coords
+
+        elif shape_type == POLYGON:
+            figures = self._figures(index)
+            parts = [struct.pack('<I', len(figures))]
+            for figure in figures:
+                count, coords = self._points(figure)
+                parts.append(struct.pack('<I', count))
+                parts.append(coords)
+            return header + b''.join(parts)
+
+        elif MULTIPOINT <= shape_type <= GEOMETRYCOLLECTION:
+            children = self.children[index]
+            parts = [struct.pack('<I', len(children))]
+            parts.extend(self._shape(child) for child in children)
+            return header + b''.join(parts)
+
+        raise ValueError('Unsupported SQL Server spatial type: %d '
+                         '(curves and FullGlobe have no GEOS equivalent)' %
+                         shape_type)
+
+
+class _GeoJSONWriter(_Writer):
+    """
+    Walks the figure and shape tables, writing out GeoJSON.
+    """
+
+    types = {
+        POINT: 'Point', LINESTRING: 'LineString', POLYGON: 'Polygon',
+        MULTIPOINT: 'MultiPoint', MULTILINESTRING: 'MultiLineString',
+        MULTIPOLYGON: 'MultiPolygon', GEOMETRYCOLLECTION: 'GeometryCollection',
+    }
+
+    def write(self, precision=None):
+        if precision is None:
+            self.number = repr
+        else:
+            self.number = lambda v: repr(round(v, precision))
+        return self._geometry(0)
+
+    def _geometry(self, index):
+        shape_type = self.shapes[index][2]
+        if shape_type not in self.types:
+            raise ValueError('Unsupported SQL Server spatial type: %d '
+                             '(curves and FullGlobe have no GeoJSON equivalent)' %
+                             shape_type)
+        if shape_type == GEOMETRYCOLLECTION:
+            return '{"type":"GeometryCollection","geometries":[%s]}' % ','.join(
+                self._geometry(child) for child in self.children[index])
+        return '{"type":"%s","coordinates":%s}' % (
+            self.types[shape_type], self._coords(index))
+
+    def _coords(self, index):
+        shape_type = self.shapes[index][2]
+        if shape_type == POINT:
+            figures = self._figures(index)
+            return self._positions(figures[0])[0] if figures else '[]'
+        elif shape_type == LINESTRING:
+            figures = self._figures(index)
+            return '[%s]' % ','.join(self._positions(figures[0])) if figures else '[]'
+        elif shape_type == POLYGON:
+            return '[%s]' % ','.join('[%s]' % ','.join(self._positions(figure))
+                                     for figure in self._figures(index))
+        return '[%s]' % ','.join(self._coords(child) for child in self.children[index])
+
+    def _positions(self, figure):
+        count, coords = self._points(figure)
+        dims = self.stride // 8
+        values = [self.number(v) for v in struct.unpack('<%dd' % (count * dims), coords)]
+        return ['[%s]' % ','.join(values[i:i + dims]) for i in range(0, len(values), dims)]
@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+
+# Sent once a query with spatial lookups or aggregates has been
+# executed and its rows fetched; see instrumentation.py.
+spatial_query = Signal(providing_args=['connection', 'record'])
+
+# Sent when the captured plan of such a query scans a table whose
+# spatial index it could have used.
+spatial_scan = Signal(providing_args=['connection', 'record', 'tables'])
@@ -0,0 +1,167 @@
+"""
+A process-wide cache of the spatial reference systems that SQL Server
+knows about (sys.spatial_reference_systems).
+
+GeoDjango looks SRIDs up one at a time, then parses their WKT to find
+the units and spheroid, and distance queries need these every time.
+Here the whole table is read in one query, the first time any SRID is
+needed, and each SRID is parsed once.  The table can also be read from
+a snapshot file (the ``srid_snapshot`` option; see write_snapshot()),
+so that no catalog query is needed at all.  Django's own cache, used
+by get_srid_info() and hence GeometryField.units_name() and
+geodetic(), is answered from this one too.
+
+refresh() throws everything away, e.g. after a spatial reference
+system has been added.  Fields that have already looked up their
+units keep them.
+"""
+import json
+import threading
+
+from django.contrib.gis.db.models import fields
+from django.db import connections
+
+from django_pyodbc_gis.models import SpatialRefSys
+
+
+class SpatialReference(object):
+    """
+    The parsed metadata of a spatial reference system.
+    """
+
+    def __init__(self, ref):
+        self.srid = ref.srid
+        self.units, self.units_name = ref.units
+        self.spheroid = SpatialRefSys.get_spheroid(ref.wkt)
+        self.geodetic = self.units_name in fields.GeometryField.geodetic_units
+        self.unit_of_measure = ref.unit_of_measure
+        self.unit_conversion_factor = ref.unit_conversion_factor or 1.0
+        self._ref = ref
+
+    @property
+    def srs(self):
+        """A GDAL SpatialReference, if GDAL is installed."""
+        return self._ref.srs
+
+    def srid_info(self):
+        """The (units, units_name, spheroid) of get_srid_info()."""
+        return self.units, self.units_name, self.spheroid
+
+
+class SRIDCache(object):
+    """
+    The spatial reference systems of each database, keyed by alias.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rows = {}
+        self._refs = {}
+
+    def get(self, connection, srid):
+        """
+        Returns the SpatialReference for the given SRID, or None if the
+        database doesn't know it.
+        """
+        refs = self._refs.get(connection.alias, {})
+        if srid in refs:
+            return refs[srid]
+        with self._lock:
+            rows = self._load(connection)
+            refs = self._refs.setdefault(connection.alias, {})
+            if srid not in refs:
+                refs[srid] = SpatialReference(rows[srid]) if srid in rows else None
+            return refs[srid]
+
+    def preload(self, connection, srids=()):
+        """
+        Reads the spatial reference systems of a database now, if they
+        haven't been already, and parses those of the given SRIDs.
+        """
+        with self._lock:
+            self._load(connection)
+        for srid in srids:
+            self.get(connection, srid)
+
+    def refresh(self, using=None):
+        """
+        Forgets the spatial reference systems of the given database, or
+        of all of them; they are read again when next needed.
+        """
+        with self._lock:
+            if using is None:
+                self._rows.clear()
+                self._refs.clear()
+            else:
+                self._rows.pop(using, None)
+                self._refs.pop(using, None)
+
+    def install(self, using):
+        """
+        Makes get_srid_info() use this cache for the given database.
+        """
+        if not isinstance(fields._srid_cache.get(using), DjangoSRIDInfo):
+            fields._srid_cache[using] = DjangoSRIDInfo(self, using)
+
+    def _load(self, connection):
+        rows = self._rows.get(connection.alias)
+        if rows is None:
+            snapshot = connection.settings_dict.get('OPTIONS', {}).get('srid_snapshot')
+            if snapshot:
+                refs = read_snapshot(snapshot)
+            else:
+                refs = SpatialRefSys.objects.using(connection.alias).all()
+            rows = self._rows[connection.alias] = dict((ref.srid, ref) for ref in refs)
+        return rows
+
+
+class DjangoSRIDInfo(dict):
+    """
+    Takes the place of a database's dictionary in Django's SRID cache
+    (see get_srid_info()), answering from an SRIDCache instead.  Only
+    SRIDs the database doesn't know fall through to Django's own query.
+    """
+
+    def __init__(self, cache, using):
+        super(DjangoSRIDInfo, self).__init__()
+        self.cache = cache
+        self.using = using
+
+    def _lookup(self, srid):
+        ref = self.cache.get(connections[self.using], srid)
+        return ref and ref.srid_info()
+
+    def __contains__(self, srid):
+        return dict.__contains__(self, srid) or self._lookup(srid) is not None
+
+    def __getitem__(self, srid):
+        if dict.__contains__(self, srid):
+            return dict.__getitem__(self, srid)
+        info = self._lookup(srid)
+        if info is None:
+            raise KeyError(srid)
+        return info
+
+
+def read_snapshot(filename):
+    """
+    Returns the SpatialRefSys objects saved by write_snapshot().
+    """
+    with open(filename) as f:
+        return [SpatialRefSys(**row) for row in json.load(f)]
+
+
+def write_snapshot(filename, using='default'):
+    """
+    Saves the spatial reference systems of the given database, for the
+    ``srid_snapshot`` option.
+    """
+    names = [f.attname for f in SpatialRefSys._meta.fields]
+    rows = SpatialRefSys.objects.using(using).values(*names)
+    with open(filename, 'w') as f:
+        json.dump(list(rows), f, indent=1)
+
+
+# The cache for this process.
+srid_cache = SRIDCache()
+refresh = srid_cache.refresh
@@ -0,0 +1,422 @@
+"""
+Mapbox Vector Tiles (https://github.com/mapbox/vector-tile-spec) from
+an MSSqlGeoQuerySet.
+
+For each tile the query selects only the objects whose index cells
+touch the tile (the ``bbintersects`` lookup, so the spatial index is
+used), clipped to the tile and its buffer with STIntersection() and
+reduced to the tile's resolution with Reduce(), all on the server.
+The geometries come back in SQL Server's own serialization, and their
+points are projected (for lon/lat data) and quantized to tile space as
+whole numpy arrays before being encoded.
+
+Only Web Mercator and lon/lat (WGS84) data can be tiled, since SQL
+Server can't transform geometries.
+
+    from django_pyodbc_gis.tiles import tile
+    data = tile(Parcel.objects.all(), z, x, y, properties=['code'])
+"""
+import math
+import struct
+
+from django.contrib.gis.geos import Polygon
+from django.db import connections
+from django.utils import six
+
+from django_pyodbc_gis.columnar import numpy, parse
+from django_pyodbc_gis.manager import MSSqlGeoQuerySet
+from django_pyodbc_gis.query import MSSqlGeoQuery
+from django_pyodbc_gis import serialization
+
+
+# Tile coordinates run from 0 to EXTENT, and geometries are clipped
+# BUFFER units outside that.
+EXTENT = 4096
+BUFFER = 64
+
+EARTH_RADIUS = 6378137.0
+# Half the width of the Web Mercator world, in metres.
+ORIGIN = math.pi * EARTH_RADIUS
+MAX_LATITUDE = 85.0511287798
+
+WEB_MERCATOR_SRIDS = (3857, 3785, 900913, 102100, 102113)
+WGS84_SRID = 4326
+
+# The edges of geography polygons are great circle arcs, so the edges
+# of a tile that follow parallels are broken into pieces no longer than
+# this, in degrees.
+PARALLEL_STEP = 1.0
+
+# MVT geometry types and commands.
+MVT_POINT, MVT_LINESTRING, MVT_POLYGON = 1, 2, 3
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+
+# The MVT type of each SQL Server shape type.
+MVT_TYPES = {
+    serialization.POINT: MVT_POINT,
+    serialization.LINESTRING: MVT_LINESTRING,
+    serialization.POLYGON: MVT_POLYGON,
+}
+
+
+def tile_bounds(z, x, y):
+    """
+    Returns the Web Mercator bounds of a tile, in metres.
+    """
+    size = 2 * ORIGIN / 2 ** z
+    xmin = -ORIGIN + x * size
+    ymax = ORIGIN - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def mercator(xy):
+    """
+    Projects an (N x 2) array of lon/lat to Web Mercator.
+    """
+    result = numpy.empty(xy.shape)
+    result[:, 0] = numpy.radians(xy[:, 0]) * EARTH_RADIUS
+    lat = numpy.clip(xy[:, 1], -MAX_LATITUDE, MAX_LATITUDE)
+    result[:, 1] = numpy.log(numpy.tan(numpy.radians(90 + lat) / 2)) * EARTH_RADIUS
+    return result
+
+
+def lonlat(x, y):
+    """
+    Returns the lon/lat of a Web Mercator point.
+    """
+    lon = math.degrees(x / EARTH_RADIUS)
+    lat = math.degrees(2 * math.atan(math.exp(y / EARTH_RADIUS)) - math.pi / 2)
+    return lon, lat
+
+
+def parallel(x0, x1, y, step=PARALLEL_STEP):
+    """
+    Returns points along the parallel at latitude y, from longitude x0
+    to x1, no more than `step` degrees apart.
+    """
+    n = max(int(math.ceil(abs(x1 - x0) / step)), 1)
+    return [(x0 + (x1 - x0) * i / n, y) for i in range(n + 1)]
+
+
+# Protocol buffer encoding; see vector_tile.proto in the specification.
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _key(field, wire_type):
+    return _varint(field << 3 | wire_type)
+
+
+def _message(field, data):
+    return _key(field, 2) + _varint(len(data)) + data
+
+
+def _packed(field, values):
+    return _message(field, b''.join(_varint(v) for v in values))
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def encode_value(value):
+    """
+    Returns a Value message for a property value; anything but a
+    number, boolean or string is sent as its text.
+    """
+    if isinstance(value, bool):
+        return _key(7, 0) + _varint(int(value))
+    elif isinstance(value, six.integer_types):
+        if value >= 0:
+            return _key(5, 0) + _varint(value)
+        return _key(6, 0) + _varint(_zigzag(value))
+    elif isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    return _message(1, six.text_type(value).encode('utf-8'))
+
+
+def encode_tile(layers):
+    """
+    Returns the tile made up of the given (encoded) layers.
+    """
+    return b''.join(_message(3, layer) for layer in layers)
+
+
+class TileLayer(object):
+    """
+    Encodes rows of (id, serialized geometry, properties...) as a
+    vector tile layer.
+    """
+
+    def __init__(self, name, srid, geography=False, properties=(), extent=EXTENT):
+        if srid in WEB_MERCATOR_SRIDS:
+            self.project = False
+        elif geography or srid == WGS84_SRID:
+            self.project = True
+        else:
+            raise ValueError('Only Web Mercator and WGS84 data can be tiled, '
+                             'not SRID %s.' % srid)
+        self.name = name
+        self.geography = geography
+        self.properties = list(properties)
+        self.extent = extent
+
+    def encode(self, rows, z, x, y):
+        xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+        scale = self.extent / (xmax - xmin)
+        keys, values = {}, {}
+        features = []
+        for row in rows:
+            if row[1] is None:
+                continue
+            xy, figures, shapes = parse(row[1], self.geography)
+            if not len(xy):
+                continue
+            if self.project:
+                xy = mercator(xy)
+
+            # Tile space has y downwards.
+            points = numpy.empty(xy.shape, 'i8')
+            points[:, 0] = numpy.rint((xy[:, 0] - xmin) * scale)
+            points[:, 1] = numpy.rint((ymax - xy[:, 1]) * scale)
+
+            geom_type, geometry = self.geometry(points, figures, shapes)
+            if not geometry:
+                continue
+
+            feature = []
+            if isinstance(row[0], six.integer_types) and row[0] >= 0:
+                feature.append(_key(1, 0) + _varint(row[0]))
+            tags = []
+            for name, value in zip(self.properties, row[2:]):
+                if value is not None:
+                    tags.append(keys.setdefault(name, len(keys)))
+                    tags.append(values.setdefault(encode_value(value), len(values)))
+            if tags:
+                feature.append(_packed(2, tags))
+            feature.append(_key(3, 0) + _varint(geom_type))
+            feature.append(_packed(4, geometry))
+            features.append(_message(2, b''.join(feature)))
+
+        layer = [_key(15, 0) + _varint(2),
+                 _message(1, self.name.encode('utf-8'))]
+        layer.extend(features)
+        layer.extend(_message(3, key.encode('utf-8'))
+                     for key in sorted(keys, key=keys.get))
+        layer.extend(_message(4, value) for value in sorted(values, key=values.get))
+        layer.append(_key(5, 0) + _varint(self.extent))
+        return b''.join(layer)
+
+    def geometry(self, points, figures, shapes):
+        """
+        Returns the MVT type and geometry commands of an instance.  Of
+        a collection (which clipping can produce) only the parts of the
+        highest dimension are kept.
+        """
+        parts = self.parts(len(points), figures, shapes)
+        if not parts:
+            return None, []
+        geom_type = max(parts)
+        bounds = numpy.append(figures, len(points))
+
+        commands = []
+        cursor = numpy.zeros(2, 'i8')
+        if geom_type == MVT_POINT:
+            ranges = [f for figure_range in parts[MVT_POINT] for f in figure_range]
+            pts = numpy.concatenate([points[bounds[f]:bounds[f + 1]] for f in ranges])
+            commands.append(MOVE_TO | len(pts) << 3)
+            commands.extend(self.deltas(pts, cursor))
+            return geom_type, commands
+
+        for figure_range in parts[geom_type]:
+            for i, f in enumerate(figure_range):
+                pts = self.dedupe(points[bounds[f]:bounds[f + 1]])
+                if geom_type == MVT_LINESTRING:
+                    if len(pts) < 2:
+                        continue
+                else:
+                    if len(pts) > 1 and (pts[0] == pts[-1]).all():
+                        pts = pts[:-1]
+                    area = self.area(pts) if len(pts) >= 3 else 0
+                    if not area:
+                        if i == 0:
+                            # Without its exterior, the holes go too.
+                            break
+                        continue
+                    # Exterior rings have a positive area, holes negative.
+                    if (area > 0) != (i == 0):
+                        pts = pts[::-1]
+                commands.append(MOVE_TO | 1 << 3)
+                deltas = self.deltas(pts, cursor)
+                commands.extend(deltas[:2])
+                commands.append(LINE_TO | (len(pts) - 1) << 3)
+                commands.extend(deltas[2:])
+                if geom_type == MVT_POLYGON:
+                    commands.append(CLOSE_PATH | 1 << 3)
+                cursor = pts[-1]
+        return geom_type, commands
+
+    def parts(self, npoints, figures, shapes):
+        """
+        Returns the figure ranges of the points, lines and polygons of
+        an instance, by MVT type.
+        """
+        if shapes is None:
+            shape_type = MVT_POINT if npoints == 1 else MVT_LINESTRING
+            return {shape_type: [range(1)]}
+
+        parts = {}
+        starts = shapes['figure']
+        for i, (parent, figure, shape_type) in enumerate(shapes.tolist()):
+            if figure < 0 or shape_type not in MVT_TYPES:
+                continue
+            following = starts[i + 1:][starts[i + 1:] >= 0]
+            end = following[0] if len(following) else len(figures)
+            parts.setdefault(MVT_TYPES[shape_type], []).append(range(figure, end))
+        return parts
+
+    def dedupe(self, pts):
+        """Drops repeated points, which quantization creates."""
+        if len(pts) < 2:
+            return pts
+        keep = numpy.ones(len(pts), bool)
+        keep[1:] = (pts[1:] != pts[:-1]).any(axis=1)
+        return pts[keep]
+
+    def area(self, pts):
+        """Twice the signed area of a ring (surveyor's formula)."""
+        x, y = pts[:, 0], pts[:, 1]
+        return int((x * numpy.roll(y, -1) - numpy.roll(x, -1) * y).sum())
+
+    def deltas(self, pts, cursor):
+        """The zigzag-encoded moves between the points, from cursor."""
+        moves = numpy.diff(numpy.vstack((cursor, pts)), axis=0)
+        return ((moves << 1) ^ (moves >> 63)).ravel().tolist()
+
+
+class TileQuery(object):
+    """
+    Builds and runs the query for tiles of a queryset's geometry field.
+    """
+
+    def __init__(self, queryset, field_name=None, properties=(), layer=None,
+                 extent=EXTENT, buffer=BUFFER):
+        if isinstance(queryset, type):
+            queryset = MSSqlGeoQuerySet(queryset)
+        if not isinstance(queryset.query, MSSqlGeoQuery):
+            raise TypeError('Tiles can only be made from an MSSqlGeoQuerySet.')
+        self.queryset = queryset
+        self.geo_field = queryset.query._geo_field(field_name)
+        if not self.geo_field:
+            raise TypeError('Tiles are only available on GeometryFields.')
+        self.field_name = field_name or self.geo_field.name
+        self.geo_col = queryset._geocol_select(self.geo_field, field_name)
+        self.properties = list(properties)
+        self.buffer = buffer
+        self.layer = TileLayer(layer or queryset.model._meta.db_table,
+                               self.geo_field.srid, self.geo_field.geography,
+                               properties, extent)
+
+    def envelope(self, z, x, y):
+        """
+        Returns the tile, with its buffer, as a polygon in the field's
+        SRID (counter-clockwise, as geography needs).  For geography the
+        top and bottom edges are densified, so that they follow the
+        parallels rather than cutting across them.
+        """
+        xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+        margin = (xmax - xmin) * self.buffer / self.layer.extent
+        xmin, ymin = max(xmin - margin, -ORIGIN), max(ymin - margin, -ORIGIN)
+        xmax, ymax = min(xmax + margin, ORIGIN), min(ymax + margin, ORIGIN)
+        if self.layer.project:
+            (xmin, ymin), (xmax, ymax) = lonlat(xmin, ymin), lonlat(xmax, ymax)
+        if self.geo_field.geography:
+            bottom, top = parallel(xmin, xmax, ymin), parallel(xmax, xmin, ymax)
+        else:
+            bottom, top = [(xmin, ymin), (xmax, ymin)], [(xmax, ymax), (xmin, ymax)]
+        return Polygon(bottom + top + bottom[:1], srid=self.geo_field.srid)
+
+    def tolerance(self, z, x, y):
+        """
+        Returns the size of one tile unit, in the field's units.
+        """
+        xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+        unit = (xmax - xmin) / self.layer.extent
+        if self.geo_field.geography:
+            # Mercator metres are stretched by 1 / cos(latitude).
+            lat = math.radians(lonlat(0, (ymin + ymax) / 2)[1])
+            return unit * math.cos(lat)
+        elif self.layer.project:
+            return unit * 180 / ORIGIN
+        return unit
+
+    def as_sql(self, z, x, y):
+        """
+        Returns the SQL and parameters of the tile's query.  Geography
+        tiles more than 180 degrees wide (zoom 0 and 1) would need an
+        envelope of a hemisphere or more, so they aren't filtered, and
+        the whole world (zoom 0) isn't clipped either.
+        """
+        envelope = self.envelope(z, x, y)
+        xmin, ymin, xmax, ymax = envelope.extent
+        geography = self.geo_field.geography
+        qs = self.queryset
+        if not (geography and xmax - xmin > 180):
+            qs = qs.filter(**{'%s__bbintersects' % self.field_name: envelope})
+        if geography and xmax - xmin >= 360:
+            clipped, params = self.geo_col, []
+        else:
+            connection = connections[qs.db]
+            placeholder = self.geo_field.get_placeholder(envelope, connection)
+            params = self.geo_field.get_db_prep_lookup('contains', envelope,
+                                                       connection=connection)
+            clipped = '%s.STIntersection(%s)' % (self.geo_col, placeholder)
+        clipped = 'CAST(%s.Reduce(%r) AS varbinary(max))' % (
+            clipped, self.tolerance(z, x, y))
+        qs = qs.extra(select={'_tile_geom': clipped}, select_params=params)
+        qs = qs.values_list(*(['pk', '_tile_geom'] + self.properties))
+        compiler = qs.query.get_compiler(qs.db)
+        # This is executed directly, so any query hints apply.
+        compiler.outermost = True
+        return compiler.as_sql()
+
+    def tile(self, z, x, y, chunk_size=1000):
+        """
+        Returns the encoded tile.
+        """
+        sql, params = self.as_sql(z, x, y)
+        cursor = connections[self.queryset.db].cursor()
+        try:
+            cursor.execute(sql, params)
+            layer = self.layer.encode(fetch_rows(cursor, chunk_size), z, x, y)
+        finally:
+            cursor.close()
+        return encode_tile([layer])
+
+
+def fetch_rows(cursor, chunk_size=1000):
+    """
+    Yields the rows of an executed cursor, fetching them in chunks.
+    """
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def tile(queryset, z, x, y, field_name=None, properties=(), layer=None,
+         extent=EXTENT, buffer=BUFFER):
+    """
+    Returns the vector tile z/x/y of a queryset (or model), with its
+    geometries in a single layer named after the table (or `layer`).
+    """
+    query = TileQuery(queryset, field_name, properties, layer, extent, buffer)
+    return query.tile(z, x, y)
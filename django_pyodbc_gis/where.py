@@ -0,0 +1,94 @@
+from django.contrib.gis.db.models.fields import GeometryField
+from django.contrib.gis.db.models.sql.where import GeoConstraint, GeoWhereNode
+from django.contrib.gis.geos import GeometryCollection
+from django.db.models.sql.where import Constraint
+
+
+# Lookups against a set of geometries: a list of them, or a queryset.
+SET_LOOKUPS = set([
+    'intersects_any',
+    'within_any',
+])
+
+# A derived table of the members of a geometry collection, numbered
+# with a CROSS APPLY.  compiler.declare_geometries() swaps it for a
+# table variable when it can.
+MEMBERS_SQL = (
+    '(SELECT collection.g.STGeometryN(numbers.n) AS geom '
+    'FROM (SELECT %s AS g) AS collection CROSS APPLY '
+    '(SELECT TOP (collection.g.STNumGeometries()) '
+    'ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) AS n '
+    'FROM sys.all_columns AS a CROSS JOIN sys.all_columns AS b) AS numbers)')
+
+
+class GeometrySet(object):
+    """
+    The value of a set lookup.  A list of geometries is sent as a
+    single collection, whose members the statement unpacks (see
+    MEMBERS_SQL).  A queryset becomes a derived table of its
+    geometries.
+    """
+
+    def __init__(self, field, value):
+        self.field = field
+        self.queryset = None
+        self.collection = None
+        if hasattr(value, 'query'):
+            if not hasattr(value, '_geocol_select'):
+                raise ValueError('A set lookup takes geometries or a GeoQuerySet.')
+            self.queryset = value
+            geo_field = value.query._geo_field()
+            if not geo_field:
+                raise ValueError('A queryset for a set lookup needs a geometry field.')
+            if geo_field.geography != field.geography or geo_field.srid != field.srid:
+                raise ValueError('The geometries of a set lookup must be of the '
+                                 'same type and SRID as the field.')
+        else:
+            geoms = [field.get_prep_value(geom) for geom in value]
+            srids = set(geom.srid for geom in geoms)
+            if len(srids) > 1:
+                raise ValueError('The geometries of a set lookup must share an SRID.')
+            self.collection = GeometryCollection(
+                geoms, srid=srids.pop() if srids else field.srid)
+
+    def as_sql(self, connection):
+        """
+        Returns the SQL for a table of the members, `members`, with a
+        `geom` column, and its parameters.
+        """
+        if self.queryset is None:
+            placeholder = connection.ops.get_geom_placeholder(self.field, self.collection)
+            return ('%s AS members' % (MEMBERS_SQL % placeholder),
+                    [connection.ops.Adapter(self.collection)])
+
+        qs = self.queryset.order_by()
+        geo_field = qs.query._geo_field()
+        geo_col = qs._geocol_select(geo_field, None)
+        qs = qs.extra(select={'_member': geo_col}).values_list('_member')
+        sql, params = qs.query.get_compiler(connection=connection).as_sql()
+        return '(%s) AS members (geom)' % sql, list(params)
+
+
+class MSSqlGeoWhereNode(GeoWhereNode):
+    """
+    Adds the set lookups, which are compiled by the operations'
+    spatial_set_sql().
+    """
+
+    def _prepare_data(self, data):
+        if isinstance(data, (list, tuple)):
+            obj, lookup_type, value = data
+            if lookup_type in SET_LOOKUPS and isinstance(obj, Constraint) and \
+                    isinstance(obj.field, GeometryField):
+                # The value isn't a geometry, so GeometryField can't
+                # prepare it, and an empty set is still a set.
+                return (GeoConstraint(obj), lookup_type, True, GeometrySet(obj.field, value))
+        return super(MSSqlGeoWhereNode, self)._prepare_data(data)
+
+    def make_atom(self, child, qn, connection):
+        lvalue, lookup_type, value_annot, value = child
+        if isinstance(lvalue, GeoConstraint) and lookup_type in SET_LOOKUPS:
+            db_type = lvalue.field.db_type(connection=connection)
+            return connection.ops.spatial_set_sql(
+                (lvalue.alias, lvalue.col, db_type), lookup_type, value, lvalue.field, qn)
+        return super(MSSqlGeoWhereNode, self).make_atom(child, qn, connection)
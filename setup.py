@@ -15,7 +15,9 @@ setup(
     license="BSD",
     keywords="django mssql gis",
     url="https://www.github.com/condense/django-pyodbc-gis",
-    packages=['django_pyodbc_gis'],
+    packages=['django_pyodbc_gis',
+              'django_pyodbc_gis.management',
+              'django_pyodbc_gis.management.commands'],
     long_description=read('README.rst'),
     classifiers=[
         "Development Status :: 1 - Planning",
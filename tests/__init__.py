@@ -0,0 +1,21 @@
+"""
+Tests that need no SQL Server: the decoding of serialized instances,
+the SQL that lookups compile to, and reading rows through the cursor.
+Run with
+
+    python -m unittest discover tests
+
+(GeoDjango, django-pyodbc-azure and pyodbc must be installed).
+"""
+from django.conf import settings
+
+if not settings.configured:
+    # Nothing connects to this database; it only supplies the backend.
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django_pyodbc_gis',
+                'NAME': 'test',
+            },
+        },
+    )
@@ -0,0 +1,23 @@
+from django.contrib.gis.db import models
+
+from django_pyodbc_gis.manager import MSSqlGeoManager
+
+
+class Zone(models.Model):
+    name = models.CharField(max_length=50)
+    geom = models.PolygonField(srid=4326)
+
+    objects = MSSqlGeoManager()
+
+    class Meta:
+        app_label = 'tests'
+
+
+class Parcel(models.Model):
+    zone = models.ForeignKey(Zone, null=True)
+    geom = models.PolygonField(srid=4326)
+
+    objects = MSSqlGeoManager()
+
+    class Meta:
+        app_label = 'tests'
@@ -0,0 +1,52 @@
+"""
+The offset arrays built by CoordinateFetcher, from serialized
+instances (see test_serialization).
+"""
+import unittest
+
+from django_pyodbc_gis import columnar
+from django_pyodbc_gis.columnar import LAYOUTS, Buffer, CoordinateFetcher
+
+from tests.test_serialization import (
+    EMPTY_POLYGON_SAMPLE, MULTIPOLYGON_SAMPLE, POLYGON_SAMPLE, sample)
+
+# geometry::Parse('MULTIPOLYGON EMPTY')
+EMPTY_MULTIPOLYGON_SAMPLE = sample('000000000104000000000000000001000000FFFFFFFFFFFFFFFF06')
+
+# geometry::Parse('MULTILINESTRING EMPTY')
+EMPTY_MULTILINESTRING_SAMPLE = sample('000000000104000000000000000001000000FFFFFFFFFFFFFFFF05')
+
+
+@unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+class OffsetTests(unittest.TestCase):
+
+    def fetch(self, geom_type, values):
+        """Returns the arrays that fetch() would for the values."""
+        fetcher = CoordinateFetcher.__new__(CoordinateFetcher)
+        fetcher.geography = False
+        coords = Buffer('f8', 2)
+        offsets = dict((name, Buffer('i8')) for name in LAYOUTS[geom_type])
+        for buf in offsets.values():
+            buf.append(0)
+        append = getattr(fetcher, '_append_%s' % geom_type.lower())
+        for value in values:
+            append(value, coords, offsets)
+        return dict((name, buf.array().tolist()) for name, buf in offsets.items())
+
+    def test_polygons(self):
+        offsets = self.fetch('POLYGON', [POLYGON_SAMPLE, EMPTY_POLYGON_SAMPLE,
+                                         None, POLYGON_SAMPLE])
+        self.assertEqual(offsets['geom_offsets'], [0, 2, 2, 2, 4])
+        self.assertEqual(offsets['ring_offsets'], [0, 5, 10, 15, 20])
+
+    def test_multipolygons(self):
+        offsets = self.fetch('MULTIPOLYGON', [EMPTY_MULTIPOLYGON_SAMPLE,
+                                              MULTIPOLYGON_SAMPLE])
+        self.assertEqual(offsets['geom_offsets'], [0, 0, 2])
+        self.assertEqual(offsets['polygon_offsets'], [0, 1, 2])
+        self.assertEqual(offsets['ring_offsets'], [0, 4, 8])
+
+    def test_empty_multilinestring(self):
+        offsets = self.fetch('MULTILINESTRING', [EMPTY_MULTILINESTRING_SAMPLE])
+        self.assertEqual(offsets['geom_offsets'], [0, 0])
+        self.assertEqual(offsets['part_offsets'], [0])
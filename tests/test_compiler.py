@@ -0,0 +1,37 @@
+"""
+The SQL of the queryset methods that add hints.
+"""
+import unittest
+
+from django.db import connections
+
+from tests.models import Parcel
+
+
+class HintTests(unittest.TestCase):
+
+    def setUp(self):
+        # Otherwise asked of the server.
+        connections['default'].__dict__['sql_server_version'] = 2012
+
+    def compile(self, queryset):
+        compiler = queryset.query.get_compiler('default')
+        compiler.outermost = True
+        return compiler.as_sql()
+
+    def test_index_hint(self):
+        sql, params = self.compile(Parcel.objects.spatial_index_hint('geom'))
+        self.assertIn(' FROM [tests_parcel] WITH (INDEX([tests_parcel_geom_id]))', sql)
+
+    def test_index_hint_with_join(self):
+        qs = Parcel.objects.filter(zone__name='flood').spatial_index_hint('geom', 'parcels')
+        sql, params = self.compile(qs)
+        self.assertIn(' FROM [tests_parcel] WITH (INDEX([parcels])) '
+                      'INNER JOIN [tests_zone] ON ([tests_parcel].[zone_id] = '
+                      '[tests_zone].[id])', sql)
+        self.assertEqual(sql.count('WITH (INDEX('), 1)
+        self.assertEqual(list(params), ['flood'])
+
+    def test_query_options(self):
+        sql, params = self.compile(Parcel.objects.query_options('MAXDOP 4', 'RECOMPILE'))
+        self.assertTrue(sql.endswith(' OPTION (MAXDOP 4, RECOMPILE)'), sql)
@@ -0,0 +1,59 @@
+"""
+The CREATE SPATIAL INDEX statements made for geometry fields.
+"""
+import unittest
+
+from django.contrib.gis.db.models import PolygonField
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.color import no_style
+from django.db import connections
+
+from tests.models import Parcel
+
+GEOMETRY_FIELD = Parcel._meta.get_field('geom')
+
+GEOGRAPHY_FIELD = PolygonField(srid=4326, geography=True)
+GEOGRAPHY_FIELD.set_attributes_from_name('geom')
+
+
+class SpatialIndexTests(unittest.TestCase):
+
+    def sql(self, field, options=None, **kwargs):
+        creation = connections['default'].creation
+        return creation.sql_spatial_index(Parcel, field, no_style(), options, **kwargs)
+
+    def test_geometry_defaults(self):
+        self.assertEqual(self.sql(GEOMETRY_FIELD),
+                         'CREATE SPATIAL INDEX [tests_parcel_geom_id] ON '
+                         '[tests_parcel]([geom]) USING GEOMETRY_AUTO_GRID '
+                         'WITH (BOUNDING_BOX = (-180.0, -90.0, 180.0, 90.0) )')
+
+    def test_geography(self):
+        self.assertEqual(self.sql(GEOGRAPHY_FIELD),
+                         'CREATE SPATIAL INDEX [tests_parcel_geom_id] ON '
+                         '[tests_parcel]([geom]) USING GEOGRAPHY_AUTO_GRID')
+        self.assertRaises(ImproperlyConfigured, self.sql, GEOGRAPHY_FIELD,
+                          {'bounding_box': (0, 0, 1, 1)})
+
+    def test_grids(self):
+        sql = self.sql(GEOMETRY_FIELD, {
+            'bounding_box': (140, -40, 155, -25),
+            'grids': ('low', 'medium', 'high', 'high'),
+            'cells_per_object': 16,
+        }, drop_existing=True)
+        self.assertEqual(sql, 'CREATE SPATIAL INDEX [tests_parcel_geom_id] ON '
+                              '[tests_parcel]([geom]) USING GEOMETRY_GRID WITH ('
+                              'BOUNDING_BOX = (140.0, -40.0, 155.0, -25.0), '
+                              'GRIDS = (LEVEL_1 = LOW, LEVEL_2 = MEDIUM, '
+                              'LEVEL_3 = HIGH, LEVEL_4 = HIGH), '
+                              'CELLS_PER_OBJECT = 16, DROP_EXISTING = ON )')
+
+    def test_grids_need_grid_tessellation(self):
+        self.assertRaises(ImproperlyConfigured, self.sql, GEOMETRY_FIELD,
+                          {'tessellation': 'auto', 'grids': ('low',)})
+
+    def test_online(self):
+        self.assertTrue(self.sql(GEOMETRY_FIELD, {'online': False})
+                        .endswith(', ONLINE = OFF )'))
+        self.assertRaises(ImproperlyConfigured, self.sql, GEOMETRY_FIELD,
+                          {'online': True})
@@ -0,0 +1,109 @@
+"""
+Reading rows through InstrumentedCursor, against a stand-in for a
+pyodbc cursor.
+"""
+import unittest
+
+from django_pyodbc_gis import signals
+from django_pyodbc_gis.instrumentation import SHOWPLAN_COLUMN, InstrumentedCursor
+
+ROWS = [(1,), (2,), (3,)]
+
+
+class FakeCursor(object):
+    """
+    Serves result sets the way pyodbc does: nextset() moves on to the
+    next one, discarding the rest of the current one.
+    """
+    rowcount = -1
+
+    def __init__(self, plan=False):
+        self.plan = plan
+        self.results = []
+        self.description = None
+
+    def execute(self, sql, params=()):
+        if sql.startswith('SET'):
+            self.results = []
+        else:
+            self.results = [([('id',)], list(ROWS))]
+            if self.plan:
+                self.results.append(([(SHOWPLAN_COLUMN,)], [('<plan/>',)]))
+        self.nextset()
+        return self
+
+    def nextset(self):
+        if not self.results:
+            self.description, self.rows = None, None
+            return False
+        self.description, self.rows = self.results.pop(0)
+        return True
+
+    def check(self):
+        if self.rows is None:
+            raise RuntimeError('No results.  Previous SQL was not a query.')
+
+    def fetchone(self):
+        self.check()
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, chunk):
+        self.check()
+        rows, self.rows = self.rows[:chunk], self.rows[chunk:]
+        return rows
+
+    def fetchall(self):
+        self.check()
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        self.check()
+        return iter(self.fetchone, None)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    driver_charset = None
+    capture_plans = False
+    spatial_labels = None
+
+
+class IterationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+        signals.spatial_query.connect(self.receive)
+
+    def tearDown(self):
+        signals.spatial_query.disconnect(self.receive)
+
+    def receive(self, record, **kwargs):
+        self.records.append(record)
+
+    def cursor(self, spatial=False, plan=False):
+        connection = FakeConnection()
+        connection.capture_plans = plan
+        if spatial:
+            connection.spatial_labels = (['lookup:intersects'], ['tests_parcel'])
+        cursor = InstrumentedCursor(FakeCursor(plan), connection)
+        cursor.execute('SELECT id FROM tests_parcel')
+        return cursor
+
+    def test_plain(self):
+        # e.g. Model.objects.raw(), which iterates the cursor.
+        self.assertEqual(list(self.cursor()), ROWS)
+        self.assertEqual(self.records, [])
+
+    def test_spatial(self):
+        self.assertEqual(list(self.cursor(spatial=True)), ROWS)
+        self.assertEqual([r.rows for r in self.records], [3])
+
+    def test_buffered(self):
+        cursor = self.cursor(spatial=True, plan=True)
+        self.assertEqual(list(cursor), ROWS)
+        self.assertEqual(list(cursor), [])
+        self.assertEqual([r.rows for r in self.records], [3])
+        self.assertEqual(self.records[0].plan, '<plan/>')
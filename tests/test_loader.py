@@ -0,0 +1,43 @@
+"""
+The staging of rows by bulk_load(), and the SQL that converts them.
+"""
+import unittest
+
+from django.contrib.gis.geos import GEOSGeometry
+
+from django_pyodbc_gis.loader import BulkLoader
+
+from tests.models import Parcel
+
+POLYGON = GEOSGeometry('POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))', 4326)
+
+POLYGON_Z = GEOSGeometry('POLYGON ((0 0 1, 10 0 1, 10 10 2, 0 10 2, 0 0 1))', 4326)
+
+
+class StagingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loader = BulkLoader(Parcel, 'default')
+
+    def test_stage(self):
+        self.assertEqual(self.loader.create_stage_sql(),
+                         'SELECT TOP 0 [zone_id], CAST(NULL AS varbinary(max)) AS [geom], '
+                         'CAST(NULL AS nvarchar(max)) AS [geom__wkt] '
+                         'INTO [#stage_tests_parcel] FROM [tests_parcel]')
+
+    def test_rows(self):
+        # WKB or WKT is chosen for each geometry, not for the field.
+        self.assertEqual(self.loader.row(Parcel(geom=POLYGON)),
+                         [None, bytearray(POLYGON.wkb), None])
+        self.assertEqual(self.loader.row(Parcel(geom=POLYGON_Z)),
+                         [None, None, POLYGON_Z.wkt])
+        self.assertEqual(self.loader.row(Parcel(geom=None)), [None, None, None])
+
+    def test_insert(self):
+        self.assertEqual(self.loader.insert_sql(),
+                         'INSERT INTO [tests_parcel] ([zone_id], [geom]) SELECT '
+                         'stage.[zone_id], CASE WHEN stage.[geom] IS NOT NULL '
+                         'THEN geometry::STGeomFromWKB(stage.[geom], 4326) '
+                         'WHEN stage.[geom__wkt] IS NOT NULL '
+                         'THEN geometry::STGeomFromText(stage.[geom__wkt], 4326) '
+                         'END AS [geom] FROM [#stage_tests_parcel] AS stage')
@@ -0,0 +1,150 @@
+"""
+The SQL that spatial lookups compile to.  What matters is the shape:
+SQL Server can only use a spatial index for a predicate method called
+on the bare column, such as col.Filter(g) = 1.
+"""
+import re
+import unittest
+
+from django.contrib.gis.db.models import PolygonField
+from django.contrib.gis.geos import GEOSGeometry
+from django.db import connections
+
+from django_pyodbc_gis.where import MEMBERS_SQL
+
+from tests.models import Parcel, Zone
+
+COLUMN = '[parcel].[geom]'
+
+GEOMETRY = GEOSGeometry('POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))', 4326)
+
+
+class LookupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        connection = connections['default']
+        # Otherwise asked of the server.
+        connection.__dict__['sql_server_version'] = 2012
+        self.ops = connection.ops
+        self.geometry_field = PolygonField(srid=4326)
+        self.geography_field = PolygonField(srid=4326, geography=True)
+
+    def lookup_sql(self, lookup_type, field, value=GEOMETRY):
+        return self.ops.spatial_lookup_sql(
+            ('parcel', 'geom', None), lookup_type, value, field,
+            self.ops.quote_name)
+
+    def column_calls(self, sql):
+        """
+        Returns the methods called on the column, checking that the
+        column isn't used in any other way (e.g. as an argument).
+        """
+        calls = re.findall(r'%s\.(\w+)\(' % re.escape(COLUMN), sql)
+        self.assertEqual(len(calls), sql.count(COLUMN))
+        return calls
+
+
+class BoundingBoxLookupTests(LookupTestCase):
+
+    def check_refined(self, lookup_type, function):
+        sql, params = self.lookup_sql(lookup_type, self.geometry_field)
+        geom = 'geometry::STGeomFromText(%s,4326)'
+        primary = '%s.Filter(%s.STEnvelope()) = 1' % (COLUMN, geom)
+        refinement = '%s.STEnvelope().%s(%s.STEnvelope()) = 1' % (
+            COLUMN, function, geom)
+        self.assertEqual(sql, '(%s AND %s)' % (primary, refinement))
+        # Outside the refinement the column is only filtered.
+        self.assertEqual(self.column_calls(sql.replace(refinement, '')),
+                         ['Filter'])
+        # The lookup supplies the geometry once; these are the copies.
+        self.assertEqual(len(params), 1)
+
+    def test_bbcontains(self):
+        self.check_refined('bbcontains', 'STContains')
+
+    def test_bboverlaps(self):
+        self.check_refined('bboverlaps', 'STOverlaps')
+
+    def test_contained(self):
+        sql, params = self.lookup_sql('contained', self.geometry_field)
+        self.assertEqual(sql, '%s.STWithin(geometry::STGeomFromText(%%s,4326)'
+                              '.STEnvelope()) = 1' % COLUMN)
+        self.assertEqual(self.column_calls(sql), ['STWithin'])
+        self.assertEqual(params, [])
+
+    def test_bbintersects(self):
+        sql, params = self.lookup_sql('bbintersects', self.geometry_field)
+        self.assertEqual(sql, '%s.Filter(geometry::STGeomFromText(%%s,4326)'
+                              '.STEnvelope()) = 1' % COLUMN)
+        self.assertEqual(self.column_calls(sql), ['Filter'])
+        self.assertEqual(params, [])
+
+    def test_geography_bbintersects(self):
+        # Geography has no envelopes, so the geometry itself is used.
+        sql, params = self.lookup_sql('bbintersects', self.geography_field)
+        self.assertEqual(sql, '%s.Filter(geography::STGeomFromText(%%s,4326))'
+                              ' = 1' % COLUMN)
+        self.assertEqual(self.column_calls(sql), ['Filter'])
+        self.assertEqual(params, [])
+
+    def test_geography_bounding_boxes(self):
+        for lookup_type in ('bbcontains', 'bboverlaps', 'contained'):
+            self.assertRaises(TypeError, self.lookup_sql, lookup_type,
+                              self.geography_field)
+
+
+class SetLookupTests(LookupTestCase):
+
+    members = '%s AS members' % (MEMBERS_SQL % 'geometry::STGeomFromText(%s,4326)')
+
+    def compile(self, queryset, outermost=False):
+        compiler = queryset.query.get_compiler('default')
+        compiler.outermost = outermost
+        return compiler.as_sql()
+
+    def test_list(self):
+        sql, params = self.compile(Parcel.objects.filter(
+            geom__intersects_any=[GEOMETRY, GEOMETRY.centroid]))
+        # Valid as it is: a subquery, str(query), or any outer query.
+        self.assertNotIn('DECLARE', sql)
+        self.assertIn('EXISTS (SELECT 1 FROM %s WHERE [tests_parcel].[geom]'
+                      '.STIntersects(members.geom) = 1)' % self.members, sql)
+        self.assertEqual(len(params), 1)
+        self.assertEqual(params[0].srid, 4326)
+
+    def test_list_declared(self):
+        # The statement that is executed gets a table variable instead.
+        sql, params = self.compile(Parcel.objects.filter(
+            geom__within_any=[GEOMETRY]), outermost=True)
+        self.assertTrue(sql.startswith('SET NOCOUNT ON; DECLARE @members1 '
+                                       'TABLE (geom geometry); '))
+        self.assertIn('EXISTS (SELECT 1 FROM @members1 AS members WHERE '
+                      '[tests_parcel].[geom].STWithin(members.geom) = 1)', sql)
+        self.assertNotIn('CROSS APPLY', sql)
+        self.assertEqual(len(params), 1)
+
+    def test_list_in_subquery(self):
+        parcels = Parcel.objects.filter(geom__intersects_any=[GEOMETRY])
+        sql, params = self.compile(Zone.objects.filter(
+            pk__in=parcels.values('zone')), outermost=True)
+        self.assertEqual(sql.count('DECLARE @members1 TABLE'), 1)
+        self.assertIn('FROM @members1 AS members WHERE', sql)
+        self.assertEqual(len(params), 1)
+
+    def test_queryset(self):
+        sql, params = self.compile(Parcel.objects.filter(
+            geom__within_any=Zone.objects.filter(name='flood')), outermost=True)
+        self.assertNotIn('DECLARE', sql)
+        self.assertTrue(re.search(
+            r'EXISTS \(SELECT 1 FROM \(SELECT .*\[tests_zone\]\.\[geom\].* '
+            r'FROM \[tests_zone\] WHERE .*\) AS members \(geom\) '
+            r'WHERE \[tests_parcel\]\.\[geom\]\.STWithin\(members\.geom\) = 1\)',
+            sql), sql)
+        self.assertEqual(list(params), ['flood'])
+
+    def test_column(self):
+        sql, params = self.compile(Parcel.objects.filter(
+            geom__intersects_any=[GEOMETRY]))
+        where = sql[sql.index(' WHERE '):].replace('[tests_parcel].[geom]', COLUMN)
+        # The members are what the index is probed with.
+        self.assertEqual(self.column_calls(where), ['STIntersects'])
@@ -0,0 +1,62 @@
+"""
+The SQL of reduce(), and the tolerance it takes from a zoom level.
+"""
+import unittest
+
+from django.contrib.gis.db.models import PolygonField
+from django.db import connections
+
+from django_pyodbc_gis.manager import EARTH_CIRCUMFERENCE
+
+from tests.models import Parcel
+
+
+def with_units(field, units, units_name):
+    # As get_srid_info() would have them, without asking the server.
+    field._units, field._units_name, field._spheroid = units, units_name, None
+    return field
+
+
+class ReduceTests(unittest.TestCase):
+
+    def setUp(self):
+        connection = connections['default']
+        # Otherwise asked of the server.
+        connection.__dict__['sql_server_version'] = 2012
+        connection.ops.geography_unit_factor = lambda field: 1.0
+        self.addCleanup(delattr, connection.ops, 'geography_unit_factor')
+        with_units(Parcel._meta.get_field('geom'), 0.0174532925199433, 'Decimal Degree')
+
+    def tolerance(self, field, zoom, tile_size=256):
+        return Parcel.objects.all()._zoom_tolerance(field, zoom, tile_size)
+
+    def compile(self, queryset):
+        return queryset.query.get_compiler('default').as_sql()
+
+    def test_geography_tolerance(self):
+        # In the unit of measure of the SRID, metres for 4326.
+        field = PolygonField(srid=4326, geography=True)
+        self.assertEqual(self.tolerance(field, 0), EARTH_CIRCUMFERENCE / 256)
+
+    def test_geodetic_tolerance(self):
+        field = with_units(PolygonField(srid=4326), 0.0174532925199433, 'Decimal Degree')
+        self.assertEqual(self.tolerance(field, 1), 360.0 / 512)
+
+    def test_projected_tolerance(self):
+        field = with_units(PolygonField(srid=3857), 1.0, 'metre')
+        self.assertEqual(self.tolerance(field, 2, 512), EARTH_CIRCUMFERENCE / 2048)
+        # US survey feet.
+        field = with_units(PolygonField(srid=2236), 0.3048006096012192, 'US survey foot')
+        self.assertEqual(self.tolerance(field, 0),
+                         EARTH_CIRCUMFERENCE / 256 / 0.3048006096012192)
+
+    def test_reduce(self):
+        sql, params = self.compile(Parcel.objects.reduce(0.5))
+        self.assertIn('[tests_parcel].[geom].Reduce(0.5)', sql)
+
+    def test_reduce_zoom(self):
+        sql, params = self.compile(Parcel.objects.reduce(zoom=1))
+        self.assertIn('[tests_parcel].[geom].Reduce(%r)' % (360.0 / 512), sql)
+
+    def test_reduce_needs_tolerance(self):
+        self.assertRaises(TypeError, Parcel.objects.reduce)
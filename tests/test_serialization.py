@@ -0,0 +1,187 @@
+"""
+Decoding of SQL Server's serialization of spatial instances.  The
+samples are serialized as SQL Server does it ([MS-SSCLRT], version 1),
+for the WKT given with each of them.
+"""
+import binascii
+import struct
+import unittest
+
+from django_pyodbc_gis import serialization
+from django_pyodbc_gis.serialization import (
+    POINT, LINESTRING, POLYGON, MULTIPOLYGON, GEOMETRYCOLLECTION,
+    WKB_SRID, WKB_Z, decode, to_ewkb, to_geojson)
+
+
+def sample(text):
+    return bytearray(binascii.unhexlify(text))
+
+
+# geometry::Parse('POINT (5 10)')
+POINT_SAMPLE = sample('00000000010C00000000000014400000000000002440')
+
+# geometry::Parse('LINESTRING (0 0 1 5, 3 4 2 6, 6 8 3 7)'), with Z and M
+LINE_ZM_SAMPLE = sample(
+    '0000000001070300000000000000000000000000000000000000000000000000'
+    '0840000000000000104000000000000018400000000000002040000000000000'
+    'F03F000000000000004000000000000008400000000000001440000000000000'
+    '18400000000000001C4001000000010000000001000000FFFFFFFF0000000002')
+
+# geometry::Parse('POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0),
+#                           (2 2, 2 4, 4 4, 4 2, 2 2))')
+POLYGON_SAMPLE = sample(
+    '0000000001040A00000000000000000000000000000000000000000000000000'
+    '2440000000000000000000000000000024400000000000002440000000000000'
+    '0000000000000000244000000000000000000000000000000000000000000000'
+    '0040000000000000004000000000000000400000000000001040000000000000'
+    '1040000000000000104000000000000010400000000000000040000000000000'
+    '00400000000000000040020000000200000000000500000001000000FFFFFFFF'
+    '0000000003')
+
+# geometry::Parse('MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)),
+#                                ((2 2, 3 2, 3 3, 2 2)))')
+MULTIPOLYGON_SAMPLE = sample(
+    '0000000001040800000000000000000000000000000000000000000000000000'
+    'F03F0000000000000000000000000000F03F000000000000F03F000000000000'
+    '0000000000000000000000000000000000400000000000000040000000000000'
+    '0840000000000000004000000000000008400000000000000840000000000000'
+    '00400000000000000040020000000200000000020400000003000000FFFFFFFF'
+    '0000000006000000000000000003000000000100000003')
+
+# geometry::Parse('GEOMETRYCOLLECTION (POINT (1 2), LINESTRING (3 4, 5 6))')
+COLLECTION_SAMPLE = sample(
+    '00000000010403000000000000000000F03F0000000000000040000000000000'
+    '0840000000000000104000000000000014400000000000001840020000000100'
+    '000000010100000003000000FFFFFFFF00000000070000000000000000010000'
+    '00000100000002')
+
+# geography::Point(47.65, -122.35, 4326), stored Lat/Long
+GEOGRAPHY_POINT_SAMPLE = sample('E6100000010C3333333333D347406666666666965EC0')
+
+# geography::Parse('LINESTRING (-122.36 47.656, -122.343 47.656)')
+GEOGRAPHY_LINE_SAMPLE = sample(
+    'E610000001148716D9CEF7D34740D7A3703D0A975EC08716D9CEF7D34740CBA1'
+    '45B6F3955EC0')
+
+# geometry::Parse('POLYGON EMPTY')
+EMPTY_POLYGON_SAMPLE = sample('000000000104000000000000000001000000FFFFFFFFFFFFFFFF03')
+
+# geometry::Parse('POINT EMPTY')
+EMPTY_POINT_SAMPLE = sample('000000000104000000000000000001000000FFFFFFFFFFFFFFFF01')
+
+
+# The EWKB the samples should come out as, written out independently
+# of the decoder.
+
+def header(shape_type, srid=None, z=False):
+    shape_type |= WKB_Z if z else 0
+    if srid is None:
+        return struct.pack('<BI', 1, shape_type)
+    return struct.pack('<BIi', 1, shape_type | WKB_SRID, srid)
+
+
+def points(*coords):
+    return b''.join(struct.pack('<%dd' % len(c), *c) for c in coords)
+
+
+def ring(*coords):
+    return struct.pack('<I', len(coords)) + points(*coords)
+
+
+class DecoderTests(object):
+    """
+    Checks every sample; mixed into a test case per decoding path.
+    """
+
+    def check(self, data, srid, ewkb, geojson, geography=False):
+        self.assertEqual(to_ewkb(data, geography), (srid, ewkb))
+        self.assertEqual(to_geojson(data, geography), geojson)
+
+    def test_point(self):
+        self.check(POINT_SAMPLE, 0,
+                   header(POINT, 0) + points((5, 10)),
+                   '{"type":"Point","coordinates":[5.0,10.0]}')
+
+    def test_linestring_with_z_and_m(self):
+        # The measures are dropped.
+        self.check(LINE_ZM_SAMPLE, 0,
+                   header(LINESTRING, 0, z=True) +
+                   ring((0, 0, 1), (3, 4, 2), (6, 8, 3)),
+                   '{"type":"LineString","coordinates":'
+                   '[[0.0,0.0,1.0],[3.0,4.0,2.0],[6.0,8.0,3.0]]}')
+
+    def test_polygon_with_hole(self):
+        self.check(POLYGON_SAMPLE, 0,
+                   header(POLYGON, 0) + struct.pack('<I', 2) +
+                   ring((0, 0), (10, 0), (10, 10), (0, 10), (0, 0)) +
+                   ring((2, 2), (2, 4), (4, 4), (4, 2), (2, 2)),
+                   '{"type":"Polygon","coordinates":'
+                   '[[[0.0,0.0],[10.0,0.0],[10.0,10.0],[0.0,10.0],[0.0,0.0]],'
+                   '[[2.0,2.0],[2.0,4.0],[4.0,4.0],[4.0,2.0],[2.0,2.0]]]}')
+
+    def test_multipolygon(self):
+        self.check(MULTIPOLYGON_SAMPLE, 0,
+                   header(MULTIPOLYGON, 0) + struct.pack('<I', 2) +
+                   header(POLYGON) + struct.pack('<I', 1) +
+                   ring((0, 0), (1, 0), (1, 1), (0, 0)) +
+                   header(POLYGON) + struct.pack('<I', 1) +
+                   ring((2, 2), (3, 2), (3, 3), (2, 2)),
+                   '{"type":"MultiPolygon","coordinates":'
+                   '[[[[0.0,0.0],[1.0,0.0],[1.0,1.0],[0.0,0.0]]],'
+                   '[[[2.0,2.0],[3.0,2.0],[3.0,3.0],[2.0,2.0]]]]}')
+
+    def test_geometry_collection(self):
+        self.check(COLLECTION_SAMPLE, 0,
+                   header(GEOMETRYCOLLECTION, 0) + struct.pack('<I', 2) +
+                   header(POINT) + points((1, 2)) +
+                   header(LINESTRING) + ring((3, 4), (5, 6)),
+                   '{"type":"GeometryCollection","geometries":['
+                   '{"type":"Point","coordinates":[1.0,2.0]},'
+                   '{"type":"LineString","coordinates":[[3.0,4.0],[5.0,6.0]]}]}')
+
+    def test_geography_point(self):
+        # Stored as Lat/Long, written as X = Long, Y = Lat.
+        self.check(GEOGRAPHY_POINT_SAMPLE, 4326,
+                   header(POINT, 4326) + points((-122.35, 47.65)),
+                   '{"type":"Point","coordinates":[-122.35,47.65]}',
+                   geography=True)
+
+    def test_geography_linestring(self):
+        self.check(GEOGRAPHY_LINE_SAMPLE, 4326,
+                   header(LINESTRING, 4326) +
+                   ring((-122.36, 47.656), (-122.343, 47.656)),
+                   '{"type":"LineString","coordinates":'
+                   '[[-122.36,47.656],[-122.343,47.656]]}',
+                   geography=True)
+
+    def test_empty_polygon(self):
+        self.check(EMPTY_POLYGON_SAMPLE, 0,
+                   header(POLYGON, 0) + struct.pack('<I', 0),
+                   '{"type":"Polygon","coordinates":[]}')
+
+    def test_empty_point(self):
+        # WKB has no empty point; GEOS reads NaN coordinates as one.
+        nan = float('nan')
+        self.check(EMPTY_POINT_SAMPLE, 0,
+                   header(POINT, 0) + points((nan, nan)),
+                   '{"type":"Point","coordinates":[]}')
+
+    def test_decode_geography(self):
+        geom = decode(GEOGRAPHY_POINT_SAMPLE, geography=True)
+        self.assertEqual(geom.srid, 4326)
+        self.assertEqual(geom.coords, (-122.35, 47.65))
+
+
+@unittest.skipIf(serialization.numpy is None, 'numpy is not installed')
+class NumpyDecoderTests(DecoderTests, unittest.TestCase):
+    pass
+
+
+class StructDecoderTests(DecoderTests, unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = serialization.numpy
+        serialization.numpy = None
+
+    def tearDown(self):
+        serialization.numpy = self.numpy